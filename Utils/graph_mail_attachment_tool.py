@@ -38,11 +38,25 @@ from __future__ import annotations
 import os
 import time
 import json
+import heapq
+import itertools
+import queue
+import zlib
 import base64
+import shutil
+import struct
+import zipfile
+import hashlib
+import sqlite3
+import tempfile
+import threading
 import datetime as dt
-from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Iterable, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import quote
 
 import requests
 
@@ -65,49 +79,258 @@ class AuthConfig:
     token_cache: str = "graph_token_cache.json"
 
 
-class GraphMailAttachmentTool:
-    """Microsoft Graph 邮件附件下载器（带 Token 缓存）。"""
+class _FileLock:
+    """跨进程互斥文件锁（Windows: msvcrt.locking；其他: fcntl.flock）。"""
 
-    GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+    def __init__(self, path: str | os.PathLike, timeout: float = 960, poll: float = 0.2):
+        self.path = str(path)
+        self.timeout = timeout
+        self.poll = poll
+        self._fh = None
 
-    def __init__(self, tenant_id: str, client_id: str, *,
-                 scopes: str = "Mail.Read offline_access",
-                 token_cache: str = "graph_token_cache.json",
-                 session: Optional[requests.Session] = None,
-                 request_timeout: int = 60):
-        self.auth = AuthConfig(tenant_id=tenant_id, client_id=client_id,
-                               scopes=scopes, token_cache=token_cache)
-        self.request_timeout = int(request_timeout)
+    def _try_lock(self) -> bool:
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except OSError:
+            return False
 
-        # AAD endpoints
-        self.auth_base = f"https://login.microsoftonline.com/{self.auth.tenant_id}/oauth2/v2.0"
-        self.device_code_url = f"{self.auth_base}/devicecode"
-        self.token_url = f"{self.auth_base}/token"
+    def __enter__(self) -> "_FileLock":
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "a+b")
+        deadline = time.time() + self.timeout
+        while not self._try_lock():
+            if time.time() > deadline:
+                self._fh.close()
+                self._fh = None
+                raise TimeoutError(f"等待文件锁超时 / Timeout waiting for file lock: {self.path}")
+            time.sleep(self.poll)
+        return self
 
-        # HTTP session（带重试）
-        self.session = session or self._build_session()
+    def __exit__(self, *exc) -> None:
+        try:
+            if os.name == "nt":
+                import msvcrt
+                self._fh.seek(0)
+                msvcrt.locking(self._fh.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        except OSError:
+            pass
+        finally:
+            self._fh.close()
+            self._fh = None
 
-    # ---------- Session & helpers ----------
-    def _build_session(self) -> requests.Session:
+
+class _AdaptiveLimiter:
+    """
+    Graph 请求限流器（令牌桶 + 自适应并发）：
+    - 令牌桶控制每秒请求数，并发上限控制同时在途的请求数；
+    - 遇到 429/503 时按 Retry-After 暂停所有请求，并将速率与并发减半（乘性减）；
+    - 连续正常响应时逐步恢复（加性增），不超过初始上限；
+    - Retry-After 暂停时间写入共享状态文件，同一租户下的其他进程也会一并避让。
+    """
+
+    def __init__(self, max_rps: float = 10.0, max_concurrency: int = 4,
+                 state_path: Optional[str] = None, min_rps: float = 0.5):
+        self.max_rps = max(min_rps, float(max_rps))
+        self.min_rps = float(min_rps)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.rate = self.max_rps
+        self.concurrency = float(self.max_concurrency)
+        self.state_path = state_path
+        self._cond = threading.Condition()
+        self._tokens = self.rate
+        self._last = time.monotonic()
+        self._in_flight = 0
+        self._blocked_until = 0.0  # time.time() 时间戳，便于跨进程共享
+        self._state_checked = 0.0
+        self.requests = 0
+        self.throttles = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        # 桶容量至少 1：速率降到 1 rps 以下时仍能攒够一个令牌（否则 acquire 永远等不到 _tokens >= 1）
+        self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _read_shared_block(self) -> None:
+        """每秒至多读一次共享状态文件，获取其他进程记录的 Retry-After 截止时间。"""
+        now = time.time()
+        if not self.state_path or now - self._state_checked < 1.0:
+            return
+        self._state_checked = now
+        try:
+            until = float(json.loads(Path(self.state_path).read_text("utf-8")).get("blocked_until", 0))
+        except Exception:
+            return
+        self._blocked_until = max(self._blocked_until, until)
+
+    def acquire(self) -> None:
+        with self._cond:
+            while True:
+                self._read_shared_block()
+                wait = self._blocked_until - time.time()
+                if wait <= 0 and self._in_flight < int(self.concurrency):
+                    self._refill()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        self._in_flight += 1
+                        self.requests += 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                self._cond.wait(timeout=min(max(wait, 0.05), 1.0))
+
+    def release(self, status: int = 0, retry_after: Optional[float] = None) -> None:
+        with self._cond:
+            self._in_flight = max(0, self._in_flight - 1)
+            if status in (429, 503):
+                self._throttled(retry_after)
+            elif 200 <= status < 400:
+                # 加性增：每个并发窗口的正常响应恢复 1 个并发；速率约 20 次正常响应回到上限
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1.0 / max(1.0, self.concurrency))
+                self.rate = min(self.max_rps, self.rate + self.max_rps / 20)
+            self._cond.notify_all()
+
+    def note_throttle(self, retry_after: Optional[float] = None) -> None:
+        """记录一次非独立请求的限流（如 $batch 子请求 429）。"""
+        with self._cond:
+            self._throttled(retry_after)
+            self._cond.notify_all()
+
+    def _throttled(self, retry_after: Optional[float]) -> None:
+        self.throttles += 1
+        self.concurrency = max(1.0, self.concurrency / 2)
+        self.rate = max(self.min_rps, self.rate / 2)
+        self._tokens = min(self._tokens, 0.0)
+        pause = retry_after if retry_after is not None else 1.0
+        until = time.time() + max(0.0, pause)
+        if until > self._blocked_until:
+            self._blocked_until = until
+            if self.state_path:
+                try:
+                    Path(self.state_path).write_text(json.dumps({"blocked_until": until}), encoding="utf-8")
+                except OSError:
+                    pass
+
+    def snapshot(self) -> dict:
+        with self._cond:
+            return {
+                "rate_rps": round(self.rate, 2),
+                "concurrency": int(self.concurrency),
+                "in_flight": self._in_flight,
+                "requests": self.requests,
+                "throttles": self.throttles,
+                "blocked_for_s": round(max(0.0, self._blocked_until - time.time()), 1),
+            }
+
+
+class _TokenManager:
+    """
+    Graph Token 管理器：
+    - 进程内缓存：token 有效期内不再读写缓存文件；
+    - 跨进程：刷新/登录在 <token_cache>.lock 文件锁内进行，拿到锁后先重读缓存，
+      若其他进程刚刷新过则直接复用，避免并发刷新互相作废 refresh_token；
+    - 后台在 expires_at 前 REFRESH_MARGIN 秒提前刷新；
+    - 按 (缓存路径, tenant, client) 共享，同一缓存的所有工具实例共用一个；
+      只保存认证配置与 AAD 端点，用自己的 Session 请求 token，不引用任何工具实例
+      （首个实例关闭 Session 或被回收都不影响其他实例）。
+    """
+
+    REFRESH_MARGIN = 300
+
+    _registry: Dict[Tuple[str, str, str], "_TokenManager"] = {}
+    _registry_lock = threading.Lock()
+
+    @classmethod
+    def for_tool(cls, tool: "GraphMailAttachmentTool") -> "_TokenManager":
+        key = (os.path.normcase(os.path.abspath(tool.auth.token_cache)), tool.auth.tenant_id, tool.auth.client_id)
+        with cls._registry_lock:
+            mgr = cls._registry.get(key)
+            if mgr is None:
+                mgr = cls._registry[key] = cls(tool)
+            return mgr
+
+    def __init__(self, tool: "GraphMailAttachmentTool"):
+        self.auth = tool.auth
+        self.request_timeout = tool.request_timeout
+        auth_base = f"https://login.microsoftonline.com/{self.auth.tenant_id}/oauth2/v2.0"
+        self.device_code_url = f"{auth_base}/devicecode"
+        self.token_url = f"{auth_base}/token"
+        self.session = self._build_session(tool.session)
+        self._lock = threading.RLock()
+        self._file_lock_path = f"{self.auth.token_cache}.lock"
+        self._tok: Optional[dict] = None
+        self._timer: Optional[threading.Timer] = None
+
+    @staticmethod
+    def _build_session(like: requests.Session) -> requests.Session:
+        """认证专用 Session：沿用创建者 Session 的代理/证书设置（公司网络常需要），连接与生命周期独立。"""
         s = requests.Session()
-        s.headers.update({
-            "User-Agent": "GraphMailAttachmentTool/1.0 (+https://microsoft.com/graph)",
-        })
+        s.headers.update({"User-Agent": like.headers.get("User-Agent", "GraphMailAttachmentTool/1.0")})
+        s.proxies.update(like.proxies)
+        s.verify, s.cert, s.trust_env = like.verify, like.cert, like.trust_env
         if HTTPAdapter and Retry:
-            retry = Retry(
-                total=5,
-                backoff_factor=0.6,
-                status_forcelist=[429, 500, 502, 503, 504],
-                allowed_methods=["GET", "POST"],
-            )
-            adapter = HTTPAdapter(max_retries=retry)
-            s.mount("https://", adapter)
-            s.mount("http://", adapter)
+            retry = Retry(total=5, backoff_factor=0.6, status_forcelist=[500, 502, 504],
+                          allowed_methods=["GET", "POST"], respect_retry_after_header=False)
+            s.mount("https://", HTTPAdapter(max_retries=retry))
+            s.mount("http://", HTTPAdapter(max_retries=retry))
         return s
 
-    @staticmethod
-    def _now() -> int:
-        return int(time.time())
+    def _covers(self, tok: Optional[dict]) -> bool:
+        """
+        缓存的 token 是否含本次要求的全部权限（AAD 响应的 scope 字段，可能带资源前缀）。
+        例如先前只授权了 Mail.Read，现在要读共享邮箱（Mail.Read.Shared）时需重新获取。没有 scope 字段时视为满足。
+        """
+        if not tok or not tok.get("scope"):
+            return True
+        granted = {sc.rsplit("/", 1)[-1].lower() for sc in str(tok["scope"]).split()}
+        wanted = {sc.lower() for sc in self.auth.scopes.split()} - {"offline_access", "openid", "profile"}
+        return wanted <= granted
+
+    def _usable(self, tok: Optional[dict], skew: int = 60) -> bool:
+        return GraphMailAttachmentTool._valid(tok, skew=skew) and self._covers(tok)
+
+    def get(self) -> str:
+        with self._lock:
+            if not self._usable(self._tok):
+                with _FileLock(self._file_lock_path):
+                    self._tok = self._acquire_token()
+                self._schedule()
+            return self._tok["access_token"]
+
+    def _schedule(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        delay = float(self._tok.get("expires_at", 0)) - time.time() - self.REFRESH_MARGIN
+        if delay <= 0 or "refresh_token" not in self._tok:
+            self._timer = None
+            return
+        self._timer = threading.Timer(delay, self._background_refresh)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _background_refresh(self) -> None:
+        """后台提前刷新：只走 refresh_token，失败不打扰，留给下次 get() 兜底。"""
+        try:
+            with self._lock:
+                with _FileLock(self._file_lock_path, timeout=60):
+                    tok = self._load_tok()
+                    # 其他进程已刷新且未进入提前刷新窗口时直接采用
+                    if not self._usable(tok, skew=self.REFRESH_MARGIN):
+                        tok = self._refresh(tok)
+                if tok and "access_token" in tok:
+                    self._tok = tok
+                    self._schedule()
+        except Exception:
+            pass
 
     def _load_tok(self) -> Optional[dict]:
         p = Path(self.auth.token_cache)
@@ -119,13 +342,9 @@ class GraphMailAttachmentTool:
             return None
 
     def _save_tok(self, tok: dict) -> None:
-        Path(self.auth.token_cache).write_text(
-            json.dumps(tok, ensure_ascii=False, indent=2), encoding="utf-8"
-        )
-
-    @staticmethod
-    def _valid(tok: Optional[dict], skew: int = 60) -> bool:
-        return bool(tok and "access_token" in tok and tok.get("expires_at", 0) - GraphMailAttachmentTool._now() > skew)
+        # 原子写入：其他进程读到的要么是旧文件要么是新文件，不会读到半截 JSON
+        data = json.dumps(tok, ensure_ascii=False, indent=2).encode("utf-8")
+        GraphMailAttachmentTool._atomic_write(Path(self.auth.token_cache), [data])
 
     def _refresh(self, tok: Optional[dict]) -> Optional[dict]:
         if not tok or "refresh_token" not in tok:
@@ -139,7 +358,7 @@ class GraphMailAttachmentTool:
         if r.status_code != 200:
             return None
         d = r.json()
-        d["expires_at"] = self._now() + int(d.get("expires_in", 3600))
+        d["expires_at"] = GraphMailAttachmentTool._now() + int(d.get("expires_in", 3600))
         # 有些情况下返回不会携带新的 refresh_token，需保留旧的
         d.setdefault("refresh_token", tok.get("refresh_token"))
         self._save_tok(d)
@@ -165,7 +384,7 @@ class GraphMailAttachmentTool:
             }, timeout=self.request_timeout)
             d = r.json()
             if "access_token" in d:
-                d["expires_at"] = self._now() + int(d.get("expires_in", 3600))
+                d["expires_at"] = GraphMailAttachmentTool._now() + int(d.get("expires_in", 3600))
                 self._save_tok(d)
                 print("[LOGIN] ✅ 首次授权成功，已获取 Access Token / First authorization succeeded; access token obtained")
                 return d
@@ -174,29 +393,1411 @@ class GraphMailAttachmentTool:
                 continue
             raise RuntimeError(f"Token error: {d}")
 
-    def get_access_token(self) -> str:
+    def _acquire_token(self) -> dict:
+        """读缓存 → refresh_token 刷新 → Device Code 登录（在文件锁内调用）。"""
         tok = self._load_tok()
-        if self._valid(tok):
-            return tok["access_token"]
+        if self._usable(tok):
+            return tok
         tok2 = self._refresh(tok)
         if tok2 and "access_token" in tok2:
             print("[LOGIN] 🔄 已刷新 Access Token / Access token refreshed")
-            return tok2["access_token"]
-        tok3 = self._device_login()
-        return tok3["access_token"]
+            return tok2
+        return self._device_login()
+
+
+@dataclass
+class AttachmentSpec:
+    """一组附件筛选条件（download_many / --manifest 使用）。"""
+    contains: Optional[str] = None
+    equals: Optional[str] = None
+    ext: Optional[str] = None
+    need_count: int = 1
+    key: Optional[str] = None  # 结果字典的键；默认取 equals/contains/ext
+
+    @property
+    def label(self) -> str:
+        return self.key or self.equals or self.contains or self.ext or "*"
+
+    def matches(self, name: str) -> bool:
+        low = (name or "").lower()
+        if self.equals:
+            return name == self.equals
+        ok = True
+        if self.contains:
+            ok = (self.contains.lower() in low)
+        if ok and self.ext:
+            ok = low.endswith(self.ext.lower())
+        return ok
+
+
+class _MailIndex:
+    """
+    本地邮件/附件元数据索引（SQLite），由 Graph delta 查询增量维护。
+    - sync_state：每个文件夹保存 deltaLink 与同步窗口起点；
+    - messages：邮件基础字段；attachments：已读取过的附件元数据（收到的邮件附件不会再变化）。
+    每次操作单独开连接，SQLite 自带文件锁，多个脚本同时运行也安全。
+    """
+
+    def __init__(self, path: str | os.PathLike):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    folder     TEXT PRIMARY KEY,
+                    delta_link TEXT,
+                    since_iso  TEXT NOT NULL,
+                    synced_at  INTEGER
+                );
+                CREATE TABLE IF NOT EXISTS messages (
+                    id                 TEXT PRIMARY KEY,
+                    folder             TEXT NOT NULL,
+                    received           TEXT NOT NULL,
+                    subject            TEXT,
+                    has_attachments    INTEGER NOT NULL DEFAULT 0,
+                    attachments_loaded INTEGER NOT NULL DEFAULT 0
+                );
+                CREATE INDEX IF NOT EXISTS ix_messages_folder_received ON messages(folder, received);
+                CREATE TABLE IF NOT EXISTS attachments (
+                    message_id TEXT NOT NULL,
+                    id         TEXT NOT NULL,
+                    name       TEXT,
+                    size       INTEGER,
+                    is_inline  INTEGER NOT NULL DEFAULT 0,
+                    odata_type TEXT,
+                    PRIMARY KEY (message_id, id)
+                );
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(str(self.path), timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def get_state(self, folder: str) -> Optional[Tuple[Optional[str], str]]:
+        with self._connect() as con:
+            row = con.execute("SELECT delta_link, since_iso FROM sync_state WHERE folder = ?", (folder,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def reset_folder(self, folder: str, since_iso: str) -> None:
+        with self._connect() as con:
+            con.execute("DELETE FROM attachments WHERE message_id IN (SELECT id FROM messages WHERE folder = ?)", (folder,))
+            con.execute("DELETE FROM messages WHERE folder = ?", (folder,))
+            con.execute(
+                "INSERT OR REPLACE INTO sync_state (folder, delta_link, since_iso, synced_at) VALUES (?, NULL, ?, NULL)",
+                (folder, since_iso),
+            )
+
+    def apply_changes(self, folder: str, items: List[dict], delta_link: Optional[str]) -> None:
+        """写入一页 delta 变更；最后一页带 deltaLink 时一并保存。"""
+        with self._connect() as con:
+            for m in items:
+                mid = m.get("id")
+                if not mid:
+                    continue
+                if "@removed" in m:
+                    con.execute("DELETE FROM attachments WHERE message_id = ?", (mid,))
+                    con.execute("DELETE FROM messages WHERE id = ?", (mid,))
+                    continue
+                con.execute(
+                    """
+                    INSERT INTO messages (id, folder, received, subject, has_attachments)
+                    VALUES (?, ?, ?, ?, ?)
+                    ON CONFLICT(id) DO UPDATE SET
+                        folder = excluded.folder,
+                        received = excluded.received,
+                        subject = excluded.subject,
+                        has_attachments = excluded.has_attachments
+                    """,
+                    (mid, folder, m.get("receivedDateTime") or "", m.get("subject"),
+                     1 if m.get("hasAttachments") else 0),
+                )
+            if delta_link:
+                con.execute(
+                    "UPDATE sync_state SET delta_link = ?, synced_at = ? WHERE folder = ?",
+                    (delta_link, int(time.time()), folder),
+                )
+
+    def query(self, folder: str, since_iso: str) -> List[dict]:
+        """按接收时间倒序返回窗口内的邮件；已缓存的附件元数据放在 "attachments" 键里。"""
+        with self._connect() as con:
+            rows = con.execute(
+                """
+                SELECT id, received, subject, has_attachments, attachments_loaded
+                FROM messages
+                WHERE folder = ? AND received >= ?
+                ORDER BY received DESC
+                """,
+                (folder, since_iso),
+            ).fetchall()
+            atts: dict = {}
+            for r in con.execute(
+                """
+                SELECT a.message_id, a.id, a.name, a.size, a.is_inline, a.odata_type
+                FROM attachments AS a JOIN messages AS m ON a.message_id = m.id
+                WHERE m.folder = ? AND m.received >= ? AND m.attachments_loaded = 1
+                """,
+                (folder, since_iso),
+            ):
+                atts.setdefault(r[0], []).append({
+                    "id": r[1], "name": r[2], "size": r[3], "isInline": bool(r[4]), "@odata.type": r[5] or "",
+                })
+        out = []
+        for mid, received, subject, has_att, loaded in rows:
+            m = {"id": mid, "receivedDateTime": received, "subject": subject, "hasAttachments": bool(has_att)}
+            if loaded:
+                m["attachments"] = atts.get(mid, [])
+            out.append(m)
+        return out
+
+    def store_attachments(self, message_id: str, atts: List[dict]) -> None:
+        with self._connect() as con:
+            con.execute("DELETE FROM attachments WHERE message_id = ?", (message_id,))
+            con.executemany(
+                "INSERT INTO attachments (message_id, id, name, size, is_inline, odata_type) VALUES (?, ?, ?, ?, ?, ?)",
+                [(message_id, a.get("id"), a.get("name"), a.get("size"), 1 if a.get("isInline") else 0,
+                  a.get("@odata.type", "")) for a in atts if a.get("id")],
+            )
+            con.execute("UPDATE messages SET attachments_loaded = 1 WHERE id = ?", (message_id,))
+
+
+class _AttachmentCache:
+    """
+    内容寻址的本地附件缓存：
+    - entries 表记录 (message_id, attachment_id) → sha256/size；
+    - 内容按 sha256 存在 blobs/ 下，同一报表被不同邮件重复发送时只存一份；
+    - 落地到 save_dir 时总是复制（不用硬链接：下游脚本常就地改写保存的工作簿，链接会连带改坏 blob），
+      blob 设为只读、取用前核对大小；目标文件已存在且大小一致时直接复用（重跑为 no-op）。
+    """
+
+    def __init__(self, root: str | os.PathLike):
+        self.root = Path(root)
+        self.blob_dir = self.root / "blobs"
+        self.tmp_dir = self.root / "tmp"
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.root / "cache.sqlite"
+        with self._connect() as con:
+            con.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    message_id    TEXT NOT NULL,
+                    attachment_id TEXT NOT NULL,
+                    sha256        TEXT NOT NULL,
+                    size          INTEGER NOT NULL,
+                    cached_at     INTEGER,
+                    PRIMARY KEY (message_id, attachment_id)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        con = sqlite3.connect(str(self.db_path), timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def blob_path(self, sha256: str) -> Path:
+        return self.blob_dir / sha256[:2] / sha256
+
+    def lookup(self, message_id: str, attachment_id: str) -> Optional[Tuple[Path, int]]:
+        with self._connect() as con:
+            row = con.execute(
+                "SELECT sha256, size FROM entries WHERE message_id = ? AND attachment_id = ?",
+                (message_id, attachment_id),
+            ).fetchone()
+        if not row:
+            return None
+        blob = self.blob_path(row[0])
+        try:
+            # 大小不符说明 blob 被改过（旧版本硬链接落地后被就地改写），按未命中处理、重新下载
+            return (blob, int(row[1])) if blob.stat().st_size == int(row[1]) else None
+        except OSError:
+            return None
+
+    def new_tmp(self, message_id: str, attachment_id: str) -> Path:
+        # 按附件定名，中断后重跑可在同一临时文件上断点续传
+        key = hashlib.sha1(f"{message_id}\0{attachment_id}".encode("utf-8")).hexdigest()
+        return self.tmp_dir / f"{key}.bin"
+
+    def ingest(self, message_id: str, attachment_id: str, tmp: Path, sha256: str, size: int) -> Path:
+        """把已写完的临时文件收进 blob 仓库（内容已存在则丢弃临时文件），并登记映射。"""
+        blob = self.blob_path(sha256)
+        if blob.is_file() and blob.stat().st_size == size:
+            tmp.unlink(missing_ok=True)
+            print(f"[CACHE] 内容与已缓存附件相同，不重复存储 / Identical content already cached: {sha256[:12]}")
+        else:
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            if blob.exists():
+                os.chmod(blob, 0o644)  # Windows 上只读文件不能被 os.replace 覆盖
+            os.replace(tmp, blob)
+            os.chmod(blob, 0o444)
+        with self._connect() as con:
+            con.execute(
+                "INSERT OR REPLACE INTO entries (message_id, attachment_id, sha256, size, cached_at) VALUES (?, ?, ?, ?, ?)",
+                (message_id, attachment_id, sha256, int(size), int(time.time())),
+            )
+        return blob
+
+    @staticmethod
+    def materialize(blob: Path, target: Path, size: int) -> bool:
+        """把 blob 复制为 target；target 已是同样大小的文件时不动它。返回是否实际写入。"""
+        try:
+            if target.stat().st_size == size:
+                return False
+        except OSError:
+            pass
+        tmp = target.with_name(f".{target.name}.{time.time_ns()}.part")
+        try:
+            shutil.copyfile(blob, tmp)  # copyfile 不复制权限位，target 保持可写
+            os.replace(tmp, target)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return True
+
+
+@dataclass
+class DownloadStats:
+    """
+    单次 download_many / download_latest_attachments 的运行统计（return_stats=True 时随结果返回）。
+    计数在下载线程间共享，统一经 add() 累加。
+    """
+    pages: int = 0              # 拉取的邮件列表页（含 delta 页）
+    messages_scanned: int = 0   # 逐封检查过的邮件
+    metadata_calls: int = 0     # 附件元数据查询（逐封 /attachments 与 $batch 内的子请求）
+    batch_requests: int = 0     # $batch POST 次数
+    requests: int = 0           # 发往 Graph 的 HTTP 请求总数（含重发）
+    files_downloaded: int = 0
+    cache_hits: int = 0
+    bytes_downloaded: int = 0
+    retries: int = 0            # 重发次数（HTTP 适配器重试、429/503 重发、$batch 子请求重试、断点续传）
+    throttles: int = 0          # 收到 429/503 的次数
+    auth_seconds: float = 0.0
+    list_seconds: float = 0.0   # 列邮件 + 读附件元数据 + 匹配
+    download_seconds: float = 0.0
+    total_seconds: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for k, v in counts.items():
+                setattr(self, k, getattr(self, k) + v)
+
+    def to_dict(self) -> dict:
+        return {k: (round(v, 3) if isinstance(v, float) else v)
+                for k, v in self.__dict__.items() if not k.startswith("_")}
+
+
+@dataclass
+class AttachmentFile:
+    """
+    iter_attachments 产出的内存附件：file 是已回到开头的 SpooledTemporaryFile（小于阈值时在内存，
+    超过后自动转存本地临时文件），可直接交给 pandas.read_excel 等解析；用完请 close()。
+    """
+    labels: List[str]             # 命中的筛选条件 key
+    name: str                     # 原附件名
+    received: dt.datetime
+    message_id: str
+    attachment_id: str
+    size: int
+    file: tempfile.SpooledTemporaryFile
+    archive_path: Optional[Path] = None
+    archive: Optional[Future] = None  # 后台归档写入；result() 返回写入字节数或抛出写入异常
+
+    @property
+    def label(self) -> str:
+        return self.labels[0]
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> "AttachmentFile":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class _ZipDirectory:
+    """
+    解析 zip 尾部的中央目录（EOCD + central directory，不含 ZIP64），
+    得到各成员在压缩包中的字节区间，以便按 Range 只下载命中的成员。
+    """
+    EOCD_SIG = b"PK\x05\x06"
+    CENTRAL_SIG = b"PK\x01\x02"
+    LOCAL_SIG = b"PK\x03\x04"
+    # EOCD 固定 22 字节 + 最长 65535 字节注释
+    TAIL_BYTES = 22 + 65535
+    CENTRAL_FMT = "<4sHHHHHHIIIHHHHHII"  # 46 字节
+    LOCAL_FMT = "<4sHHHHHIIIHH"          # 30 字节
+
+    @classmethod
+    def parse_eocd(cls, tail: bytes) -> Optional[Tuple[int, int]]:
+        """返回 (中央目录大小, 中央目录偏移)；找不到或为 ZIP64 时返回 None。"""
+        pos = tail.rfind(cls.EOCD_SIG)
+        if pos < 0 or len(tail) - pos < 22:
+            return None
+        entries, cd_size, cd_offset = struct.unpack_from("<HII", tail, pos + 10)
+        if entries == 0xFFFF or 0xFFFFFFFF in (cd_size, cd_offset):
+            return None
+        return cd_size, cd_offset
+
+    @classmethod
+    def parse_entries(cls, cd: bytes, cd_offset: int) -> List[dict]:
+        """解析中央目录；跳过目录项与加密成员。每个成员的 end 为下一个本地头（或中央目录）的偏移。"""
+        entries, offsets = [], {cd_offset}
+        pos = 0
+        size = struct.calcsize(cls.CENTRAL_FMT)
+        while pos + size <= len(cd) and cd[pos:pos + 4] == cls.CENTRAL_SIG:
+            (_, _, _, flags, method, _, _, crc, comp_size, file_size,
+             nlen, xlen, clen, _, _, _, offset) = struct.unpack_from(cls.CENTRAL_FMT, cd, pos)
+            name = cd[pos + size:pos + size + nlen].decode("utf-8" if flags & 0x800 else "cp437")
+            pos += size + nlen + xlen + clen
+            offsets.add(offset)
+            if name.endswith("/") or flags & 0x1:
+                continue
+            entries.append({"kind": "zip", "name": name, "method": method, "crc": crc,
+                            "comp_size": comp_size, "size": file_size, "offset": offset})
+        ordered = sorted(offsets)
+        for e in entries:
+            e["end"] = next(o for o in ordered if o > e["offset"])
+        return entries
+
+
+@dataclass
+class _ScanState:
+    """一次扫描的匹配状态：未满足的条件、各条件命中的附件键、待下载附件。"""
+    specs: List[AttachmentSpec]
+    open_specs: List[AttachmentSpec]
+    hits: Dict[str, List[Tuple[str, str]]]
+    pending: Dict[Tuple[str, str], "_PendingAttachment"] = field(default_factory=dict)
+    scanned: int = 0
+
+    @classmethod
+    def start(cls, specs: List[AttachmentSpec]) -> "_ScanState":
+        return cls(specs=list(specs), open_specs=[sp for sp in specs if sp.need_count > 0],
+                   hits={sp.label: [] for sp in specs})
+
+    def reopen(self, specs: List[AttachmentSpec]) -> None:
+        """清掉这些条件的命中（及只被它们引用的待下载附件），以便重新扫描。"""
+        for sp in specs:
+            self.hits[sp.label] = []
+        keep = {k for keys in self.hits.values() for k in keys}
+        self.pending = {k: v for k, v in self.pending.items() if k in keep}
+        self.open_specs = [sp for sp in self.specs if sp in specs and sp.need_count > 0]
+        self.scanned = 0
+
+
+@dataclass
+class _PendingAttachment:
+    """扫描阶段命中、等待下载的附件。"""
+    received: dt.datetime
+    message_id: str
+    attachment: dict
+    filepath: Path
+    mailbox: str = "/me"  # 邮件所在邮箱的路径前缀（/me 或 /users/{upn}）
+    member: Optional[dict] = None  # 压缩包内的成员（unpack_archives 模式），None 表示附件本身
+
+    @property
+    def cache_id(self) -> str:
+        """附件缓存用的 id：成员用 "<attachment id>#<成员名>" 区分。"""
+        aid = self.attachment.get("id", "")
+        return f"{aid}#{self.member['name']}" if self.member else aid
+
+
+class GraphMailAttachmentTool:
+    """Microsoft Graph 邮件附件下载器（带 Token 缓存）。"""
+
+    GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+    # 附件元数据字段（@odata.type 会自动返回，不需要也不能 $select）
+    ATTACHMENT_META_SELECT = "id,name,size,isInline"
+    # 流式下载/解码的分块大小（字节）
+    STREAM_CHUNK = 1024 * 1024
+    # JSON $batch：单次最多 20 个子请求；不超过该大小的附件内容也走 $batch
+    BATCH_LIMIT = 20
+    BATCH_VALUE_MAX_BYTES = 1024 * 1024
+    BATCH_RETRIES = 4
+    # 429/503 在限流器暂停后重发的次数
+    THROTTLE_RETRIES = 6
+    # $value 下载中断后按 Range 续传的次数
+    RESUME_RETRIES = 5
+    # 断点续传的目标锁：固定数量的锁文件（不同目标偶尔共用一个锁，只是短暂排队）
+    RESUME_LOCK_STRIPES = 64
+    # iter_attachments：单个附件在内存中保留的上限，超过后转存本地临时文件
+    SPOOL_MAX_BYTES = 32 * 1024 * 1024
+    # iter_attachments 后台归档：每个下载与其归档线程之间最多排队的数据块数（× STREAM_CHUNK 即内存上限）
+    ARCHIVE_QUEUE_CHUNKS = 8
+    # 读共享邮箱/他人邮箱（/users/{upn}/...）所需的委托权限
+    SHARED_MAILBOX_SCOPE = "Mail.Read.Shared"
+
+    def __init__(self, tenant_id: str, client_id: str, *,
+                 scopes: str = "Mail.Read offline_access",
+                 token_cache: str = "graph_token_cache.json",
+                 session: Optional[requests.Session] = None,
+                 request_timeout: int = 60,
+                 max_workers: int = 4,
+                 index_path: Optional[str] = None,
+                 cache_dir: Optional[str] = None,
+                 max_rps: float = 10.0,
+                 max_concurrency: int = 4,
+                 graph_base: Optional[str] = None):
+        self.auth = AuthConfig(tenant_id=tenant_id, client_id=client_id,
+                               scopes=scopes, token_cache=token_cache)
+        self.request_timeout = int(request_timeout)
+        self.max_workers = max(1, int(max_workers))
+        # 可指向本地模拟服务（见 graph_mock_server.py）做离线测试/基准
+        if graph_base:
+            self.GRAPH_BASE = graph_base.rstrip("/")
+        # 本地邮件索引默认与 token 缓存放在同一目录
+        self.index_path = index_path or str(Path(token_cache).with_name("graph_mail_index.sqlite"))
+        self._index: Optional[_MailIndex] = None
+        # 附件内容缓存目录（use_cache=True 时启用）
+        self.cache_dir = cache_dir or str(Path(token_cache).with_name("graph_attachment_cache"))
+        self._cache: Optional[_AttachmentCache] = None
+
+        # HTTP session（带重试）
+        self.session = session or self._build_session()
+
+        # Graph 限流器：429/503 由它按 Retry-After 统一处理（Graph 单邮箱默认最多 4 个并发请求）
+        self.limiter = _AdaptiveLimiter(max_rps=max_rps, max_concurrency=max_concurrency,
+                                        state_path=f"{token_cache}.throttle")
+
+        # 同一缓存文件的所有实例共享一个 Token 管理器（进程内缓存 + 跨进程文件锁）
+        self._tokens = _TokenManager.for_tool(self)
+
+        # 当前/最近一次下载的统计（每次 download_many 重新创建）
+        self._stats = DownloadStats()
+        # 子文件夹路径 → 文件夹 id（"inbox/Supply" 形式按 displayName 解析后缓存）
+        self._folder_ids: Dict[Tuple[str, str], str] = {}
+        # unpack_archives 回退时整包下载的压缩附件所在临时目录（每次下载结束后删除）
+        self._archive_tmp: Optional[Path] = None
+
+    # ---------- Session & helpers ----------
+    def _build_session(self) -> requests.Session:
+        s = requests.Session()
+        s.headers.update({
+            "User-Agent": "GraphMailAttachmentTool/1.0 (+https://microsoft.com/graph)",
+        })
+        if HTTPAdapter and Retry:
+            # 429/503 不在此重试，交给 _request + 限流器按 Retry-After 处理
+            retry = Retry(
+                total=5,
+                backoff_factor=0.6,
+                status_forcelist=[500, 502, 504],
+                allowed_methods=["GET", "POST"],
+                respect_retry_after_header=False,
+            )
+            # 连接池需容纳并发下载线程，否则多出的连接会被丢弃重建
+            pool = max(10, self.max_workers * 2)
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=pool, pool_maxsize=pool)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+        return s
+
+    @staticmethod
+    def _now() -> int:
+        return int(time.time())
+
+    @staticmethod
+    def _valid(tok: Optional[dict], skew: int = 60) -> bool:
+        return bool(tok and "access_token" in tok and tok.get("expires_at", 0) - GraphMailAttachmentTool._now() > skew)
+
+    def get_access_token(self) -> str:
+        return self._tokens.get()
 
     # ---------- HTTP wrappers ----------
-    def _gget(self, url: str, token: str, params: Optional[dict] = None) -> dict:
-        r = self.session.get(url, headers={"Authorization": f"Bearer {token}"}, params=params, timeout=self.request_timeout)
-        if r.status_code >= 400:
-            msg = f"{r.status_code} GET {url}\n{r.text[:500]}"
-            raise requests.HTTPError(msg)
-        return r.json()
-
-    def _download_value(self, url: str, token: str) -> bytes:
-        r = self.session.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=max(180, self.request_timeout))
-        r.raise_for_status()
-        return r.content
+    @staticmethod
+    def _retry_after(r: requests.Response) -> Optional[float]:
+        try:
+            return float(r.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+    @contextmanager
+    def _request(self, method: str, url: str, **kwargs) -> Iterator[requests.Response]:
+        """
+        所有 Graph 请求的统一入口：先向限流器申请配额，响应（含流式下载的响应体）处理完才归还；
+        429/503 时限流器按 Retry-After 暂停并降速，本方法随后重发。
+        带 Authorization 的请求每次发出（含重发）前都换成 get_access_token() 的当前值，
+        调用方传入的 token 只用来标记需要鉴权；长时间扫描/下载因此能用上后台提前刷新的新 token。
+        """
+        attempt = 0
+        while True:
+            self.limiter.acquire()
+            status, retry_after = 0, None
+            try:
+                if "Authorization" in (kwargs.get("headers") or {}):
+                    kwargs["headers"] = {**kwargs["headers"], "Authorization": f"Bearer {self.get_access_token()}"}
+                r = self.session.request(method, url, **kwargs)
+                status = r.status_code
+                # 适配器层（urllib3 Retry）已经重发过的次数
+                history = getattr(getattr(r.raw, "retries", None), "history", None) or ()
+                self._stats.add(requests=1 + len(history), retries=len(history))
+                if status in (429, 503):
+                    self._stats.add(throttles=1)
+                    retry_after = self._retry_after(r)
+                    if attempt < self.THROTTLE_RETRIES:
+                        self._stats.add(retries=1)
+                        r.close()
+                        attempt += 1
+                        continue
+                try:
+                    yield r
+                finally:
+                    r.close()
+                return
+            finally:
+                self.limiter.release(status, retry_after)
+
+    def metrics(self) -> dict:
+        """当前限流状态（速率、并发、请求数、限流次数）。"""
+        return {"limiter": self.limiter.snapshot()}
+
+    def _gget(self, url: str, token: str, params: Optional[dict] = None,
+              headers: Optional[dict] = None) -> dict:
+        h = {"Authorization": f"Bearer {token}"}
+        if headers:
+            h.update(headers)
+        with self._request("GET", url, headers=h, params=params, timeout=self.request_timeout) as r:
+            if r.status_code >= 400:
+                msg = f"{r.status_code} GET {url}\n{r.text[:500]}"
+                raise requests.HTTPError(msg, response=r)
+            return r.json()
+
+    def _batch_get(self, urls: Dict[str, str], token: str) -> Dict[str, dict]:
+        """
+        用 JSON $batch 合并 GET 请求（每个 POST 最多 BATCH_LIMIT 个子请求）。
+        :param urls: {子请求 id: 相对 GRAPH_BASE 的 URL，如 "/me/messages/{id}/attachments"}
+        :return:     {子请求 id: {"status", "headers", "body"}}；
+                     429/5xx 的子请求按 Retry-After（或指数退避）单独重试，最终仍失败的保留原状态。
+        """
+        results: Dict[str, dict] = {}
+        todo = list(urls)
+        for attempt in range(self.BATCH_RETRIES + 1):
+            for i in range(0, len(todo), self.BATCH_LIMIT):
+                chunk = todo[i:i + self.BATCH_LIMIT]
+                self._stats.add(batch_requests=1)
+                with self._request(
+                    "POST",
+                    f"{self.GRAPH_BASE}/$batch",
+                    headers={"Authorization": f"Bearer {token}"},
+                    json={"requests": [{"id": rid, "method": "GET", "url": urls[rid]} for rid in chunk]},
+                    timeout=max(180, self.request_timeout),
+                ) as r:
+                    if r.status_code >= 400:
+                        raise requests.HTTPError(f"{r.status_code} POST $batch\n{r.text[:500]}", response=r)
+                    for resp in r.json().get("responses", []):
+                        results[str(resp.get("id"))] = resp
+            retry = [rid for rid in todo
+                     if int(results.get(rid, {}).get("status", 599)) in (429, 500, 502, 503, 504)]
+            throttled = sum(1 for rid in retry if int(results.get(rid, {}).get("status", 0)) in (429, 503))
+            self._stats.add(throttles=throttled)
+            if not retry or attempt >= self.BATCH_RETRIES:
+                break
+            self._stats.add(retries=len(retry))
+            waits = []
+            for rid in retry:
+                ra = (results[rid].get("headers") or {}).get("Retry-After") if rid in results else None
+                try:
+                    waits.append(float(ra))
+                except (TypeError, ValueError):
+                    pass
+            if any(int(results.get(rid, {}).get("status", 0)) in (429, 503) for rid in retry):
+                # 子请求被限流：交给限流器暂停并降速，下一轮 POST 申请配额时自然等待
+                self.limiter.note_throttle(max(waits) if waits else None)
+            else:
+                time.sleep(0.6 * (2 ** attempt))
+            todo = retry
+        return results
+
+    def _batch_list_attachments(self, messages: List[dict], token: str) -> Dict[str, List[dict]]:
+        """批量读取多封邮件（可来自不同邮箱）的附件元数据，按邮件 id 返回；批内失败的邮件回退为单独请求。"""
+        urls = {str(i): f"{m.get('_mailbox', '/me')}/messages/{m['id']}/attachments"
+                        f"?$select={self.ATTACHMENT_META_SELECT}"
+                for i, m in enumerate(messages)}
+        self._stats.add(metadata_calls=len(urls))
+        results = self._batch_get(urls, token)
+        out: Dict[str, List[dict]] = {}
+        for i, m in enumerate(messages):
+            resp = results.get(str(i)) or {}
+            body = resp.get("body")
+            if int(resp.get("status", 0)) == 200 and isinstance(body, dict):
+                out[m["id"]] = body.get("value", [])
+            else:
+                out[m["id"]] = self._list_attachments(m["id"], token, m.get("_mailbox", "/me"))
+        return out
+
+    def _scan_pages(self, url: str, params: Optional[dict], token: str, *,
+                    prefetch: bool = False, since_iso: Optional[str] = None,
+                    max_items: Optional[int] = None) -> Iterator[List[dict]]:
+        """
+        按 @odata.nextLink 逐页返回邮件列表。
+        prefetch=True 时，在调用方处理当前页（读附件元数据等）的同时后台请求下一页；
+        若当前页已越过时间窗口（since_iso）或已达 max_items，则不再预取。
+        调用方提前结束时应 close() 生成器：未开始的预取会被取消，进行中的结果直接丢弃。
+        """
+        if not prefetch:
+            while url:
+                data = self._gget(url, token, params=params)
+                self._stats.add(pages=1)
+                params = None  # nextLink 已经包含分页参数
+                msgs = data.get("value", [])
+                if not msgs:
+                    return
+                yield msgs
+                url = data.get("@odata.nextLink")
+            return
+
+        ex = ThreadPoolExecutor(max_workers=1, thread_name_prefix="graph-page")
+        try:
+            fut = ex.submit(self._gget, url, token, params)
+            seen = 0
+            while fut is not None:
+                data = fut.result()
+                self._stats.add(pages=1)
+                fut = None
+                msgs = data.get("value", [])
+                if not msgs:
+                    return
+                seen += len(msgs)
+                next_url = data.get("@odata.nextLink")
+                oldest = msgs[-1].get("receivedDateTime") or ""
+                crossed = bool(since_iso and oldest and oldest < since_iso)
+                if next_url and not crossed and (max_items is None or seen < max_items):
+                    fut = ex.submit(self._gget, next_url, token)
+                yield msgs
+        finally:
+            ex.shutdown(wait=False, cancel_futures=True)
+
+    # ---------- Local index (delta) ----------
+    def _get_index(self) -> _MailIndex:
+        if self._index is None:
+            self._index = _MailIndex(self.index_path)
+        return self._index
+
+    def _sync_index(self, mail_folder: str, since_iso: str, token: str, page_size: int = 200) -> _MailIndex:
+        """
+        用 /mailFolders/{id}/messages/delta 把本地索引追平。
+        - 首次或需要更早的时间窗口：清空该文件夹后按 receivedDateTime 过滤全量同步；
+        - 之后只请求保存的 deltaLink，无变化时仅一次往返；
+        - deltaLink 失效（410）时自动全量重建。
+        """
+        index = self._get_index()
+        state = index.get_state(mail_folder)
+        delta_link = state[0] if state and state[1] <= since_iso else None
+        if not delta_link:
+            index.reset_folder(mail_folder, since_iso)
+            url: Optional[str] = f"{self.GRAPH_BASE}/me/mailFolders/{mail_folder}/messages/delta"
+            params: Optional[dict] = {
+                "$select": "id,subject,receivedDateTime,hasAttachments",
+                "$filter": f"receivedDateTime ge {since_iso}",
+            }
+            print(f"[INDEX] 全量同步 {mail_folder} / Full index sync for {mail_folder} (since {since_iso})")
+        else:
+            url, params = delta_link, None
+        headers = {"Prefer": f"odata.maxpagesize={int(page_size)}"}
+
+        changes = 0
+        while url:
+            try:
+                data = self._gget(url, token, params=params, headers=headers)
+            except requests.HTTPError as e:
+                if delta_link and e.response is not None and e.response.status_code == 410:
+                    print("[INDEX] deltaLink 已失效，重建索引 / deltaLink expired, rebuilding index")
+                    index.reset_folder(mail_folder, since_iso)
+                    return self._sync_index(mail_folder, since_iso, token, page_size)
+                raise
+            params = None
+            self._stats.add(pages=1)
+            items = data.get("value", [])
+            changes += len(items)
+            index.apply_changes(mail_folder, items, data.get("@odata.deltaLink"))
+            url = data.get("@odata.nextLink")
+        print(f"[INDEX] {mail_folder} 已同步，变更 {changes} 条 / {mail_folder} synced, {changes} change(s)")
+        return index
+
+    def _index_pages(self, mail_folders: List[str], since_iso: str, token: str) -> Iterator[List[dict]]:
+        """索引模式：先逐个文件夹增量同步，再直接从本地索引返回窗口内的邮件（按接收时间归并为一页）。"""
+        per_folder = []
+        for mail_folder in mail_folders:
+            index = self._sync_index(mail_folder, since_iso, token)
+            per_folder.append(index.query(mail_folder, since_iso))
+        msgs = list(heapq.merge(*per_folder, key=lambda m: m.get("receivedDateTime") or "", reverse=True))
+        if msgs:
+            yield msgs
+
+    @staticmethod
+    def _mailbox_base(mailbox: Optional[str]) -> str:
+        """None/"me" → /me；其他视为共享邮箱或他人邮箱的 UPN/id → /users/{upn}。"""
+        if not mailbox or mailbox.lower() == "me":
+            return "/me"
+        return f"/users/{quote(mailbox, safe='@')}"
+
+    def _resolve_folder(self, mailbox: str, folder: str, token: str) -> str:
+        """
+        "inbox" 等知名文件夹名或文件夹 id 原样返回；
+        "inbox/Supply/KKAQ" 形式从第一段起按 displayName 逐级查子文件夹，返回最终的文件夹 id（进程内缓存）。
+        """
+        parts = [p for p in folder.split("/") if p]
+        if len(parts) <= 1:
+            return folder
+        key = (mailbox, folder)
+        if key not in self._folder_ids:
+            fid = parts[0]
+            for name in parts[1:]:
+                data = self._gget(
+                    f"{self.GRAPH_BASE}{mailbox}/mailFolders/{fid}/childFolders",
+                    token,
+                    params={"$filter": "displayName eq '%s'" % name.replace("'", "''"), "$select": "id,displayName"},
+                )
+                found = data.get("value", [])
+                if not found:
+                    raise ValueError(f"找不到邮件文件夹 / Mail folder not found: {mailbox} {folder}")
+                fid = found[0]["id"]
+            self._folder_ids[key] = fid
+        return self._folder_ids[key]
+
+    def _merged_pages(self, sources: List[Tuple[str, str]], params: Optional[dict], token: str, *,
+                      since_iso: str, max_items: int, page_size: int) -> Iterator[List[dict]]:
+        """
+        多个文件夹/邮箱并发分页，按 receivedDateTime 倒序归并成一个有序流（每页 page_size 封）。
+        :param sources: [(邮箱前缀 /me 或 /users/{upn}, messages URL), ...]
+        每个来源一个后台线程各自翻页，越过时间窗口或达到 max_items 即停；归并结果与把所有来源的邮件
+        按接收时间排好后顺序扫描一致（时间相同按来源顺序），列表耗时取决于最慢的来源而不是各来源之和。
+        邮件带上 "_mailbox" 字段，后续附件请求据此拼 URL。调用方提前结束时应 close() 生成器。
+        """
+        stop = threading.Event()
+        end = object()
+        queues: List[queue.Queue] = [queue.Queue(maxsize=2) for _ in sources]
+
+        def put(q: queue.Queue, item) -> None:
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.2)
+                    return
+                except queue.Full:
+                    continue
+
+        def produce(mailbox: str, url: str, q: queue.Queue) -> None:
+            last = end
+            try:
+                seen = 0
+                for msgs in self._scan_pages(url, params, token):
+                    for m in msgs:
+                        m["_mailbox"] = mailbox
+                    put(q, msgs)
+                    seen += len(msgs)
+                    oldest = msgs[-1].get("receivedDateTime") or ""
+                    if stop.is_set() or (oldest and oldest < since_iso) or seen >= max_items:
+                        break
+            except BaseException as e:  # 交给消费方抛出
+                last = e
+            put(q, last)
+
+        def drain(q: queue.Queue) -> Iterator[dict]:
+            while True:
+                item = q.get()
+                if item is end:
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield from item
+
+        for (mailbox, url), q in zip(sources, queues):
+            threading.Thread(target=produce, args=(mailbox, url, q), daemon=True, name="graph-folder").start()
+        try:
+            merged = heapq.merge(*(drain(q) for q in queues),
+                                 key=lambda m: m.get("receivedDateTime") or "", reverse=True)
+            seen_ids = set()
+            page: List[dict] = []
+            for m in merged:
+                key = (m["_mailbox"], m["id"])
+                if key in seen_ids:  # 同一邮件被重复指定的来源列出（如 /messages 与其下的文件夹）
+                    continue
+                seen_ids.add(key)
+                page.append(m)
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            stop.set()
+
+    def _list_attachments(self, message_id: str, token: str, mailbox: str = "/me") -> List[dict]:
+        """只取附件元数据（不含 contentBytes），内容留到命中筛选后再经 $value 下载。"""
+        self._stats.add(metadata_calls=1)
+        data = self._gget(
+            f"{self.GRAPH_BASE}{mailbox}/messages/{message_id}/attachments",
+            token,
+            params={"$select": self.ATTACHMENT_META_SELECT},
+        )
+        return data.get("value", [])
+
+    def _download_value_to(self, url: str, token: str, filepath: Path, digest=None,
+                           expected_size: Optional[int] = None) -> int:
+        """
+        流式下载 $value 到 filepath，支持断点续传：
+        - 数据写入同目录下固定名的 .{name}.resume.part，旁边的 .resume.json 记录来源 URL 与总长度；
+        - 连接中断/读超时后用 Range: bytes=<已写字节>- 继续；重跑时同一目标也从断点继续；
+        - 写完后按 Content-Range/Content-Length 给出的总长度校验（Graph 的 size 含编码开销，只作上限），
+          通过后才原子改名为目标文件。
+        digest（hashlib 对象）不为空时，改名前按完整文件计算摘要。返回字节数。
+        """
+        part = filepath.with_name(f".{filepath.name}.resume.part")
+        meta_path = filepath.with_name(f".{filepath.name}.resume.json")
+        # 同一目标同时只允许一个下载者写 .part（多进程/多线程重跑同一报表时）；
+        # 锁文件放在 token 缓存旁、按目标路径哈希分到固定的 RESUME_LOCK_STRIPES 个文件上
+        # （不删除，避免删锁与抢锁竞争；数量固定，不随下载过的文件增长），不污染下载目录
+        stripe = int(hashlib.sha1(str(part.resolve()).encode("utf-8")).hexdigest(), 16) % self.RESUME_LOCK_STRIPES
+        lock_path = Path(self.auth.token_cache).with_name("graph_resume_locks") / f"stripe_{stripe:02d}.lock"
+        with _FileLock(lock_path):
+            meta = self._load_resume_meta(meta_path, url)
+            if meta is None:
+                part.unlink(missing_ok=True)
+                meta = {"url": url, "total": None}
+                self._save_resume_meta(meta_path, meta)
+            failures = 0
+            while True:
+                offset = part.stat().st_size if part.exists() else 0
+                total = meta.get("total")
+                if total is not None and offset == total:
+                    break
+                if total is not None and offset > total:
+                    part.unlink(missing_ok=True)
+                    offset = 0
+                headers = {"Authorization": f"Bearer {token}"}
+                if offset:
+                    headers["Range"] = f"bytes={offset}-"
+                try:
+                    # 读超时按单次 socket 读计，断线后续传而不是从 0 重来
+                    with self._request("GET", url, headers=headers, stream=True,
+                                       timeout=(self.request_timeout, max(180, self.request_timeout))) as r:
+                        if r.status_code == 416 and offset:
+                            # 断点越过了内容末尾（源已变化）：丢弃 .part 从头下载
+                            part.unlink(missing_ok=True)
+                            meta["total"] = None
+                            failures += 1
+                            if failures > self.RESUME_RETRIES:
+                                r.raise_for_status()
+                            continue
+                        r.raise_for_status()
+                        if offset and r.status_code == 206:
+                            start, total = self._content_range(r)
+                            if start != offset:
+                                raise IOError(f"Content-Range 起点不符 / Unexpected Content-Range start: {start} != {offset}")
+                        else:
+                            # 服务器忽略了 Range（返回 200 全量）：从头写
+                            offset = 0
+                            length = r.headers.get("Content-Length")
+                            total = int(length) if length and length.isdigit() else None
+                        if total is not None and expected_size and total > expected_size:
+                            raise IOError(f"内容长度超过附件 size / Content length {total} exceeds attachment size {expected_size}")
+                        if total != meta.get("total"):
+                            meta["total"] = total
+                            self._save_resume_meta(meta_path, meta)
+                        with open(part, "r+b" if offset else "wb") as f:
+                            f.seek(offset)
+                            f.truncate()
+                            try:
+                                for chunk in r.iter_content(chunk_size=self.STREAM_CHUNK):
+                                    if chunk:
+                                        f.write(chunk)
+                            finally:
+                                f.flush()
+                                os.fsync(f.fileno())
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                    done = part.stat().st_size if part.exists() else 0
+                    # 只累计“没有任何进展”的连续失败；每次都有进展的慢链路可以一直续传下去
+                    failures = 1 if done > offset else failures + 1
+                    if failures > self.RESUME_RETRIES:
+                        raise
+                    self._stats.add(retries=1)
+                    print(f"[RESUME] 连接中断，{done} 字节处续传 / Connection dropped, resuming at byte {done}: "
+                          f"{type(e).__name__}")
+                    time.sleep(min(30.0, 0.5 * (2 ** failures)))
+                    continue
+                size = part.stat().st_size
+                if total is None or size == total:
+                    break
+                # 响应正常结束但字节数不足（代理截断等）：按断点继续
+                failures += 1
+                if failures > self.RESUME_RETRIES:
+                    raise IOError(f"下载不完整 / Incomplete download: {size}/{total} bytes: {filepath.name}")
+
+            size = part.stat().st_size
+            if expected_size and size > expected_size:
+                raise IOError(f"下载大小超过附件 size / Downloaded {size} bytes > attachment size {expected_size}")
+            if digest is not None:
+                with open(part, "rb") as f:
+                    for chunk in iter(lambda: f.read(self.STREAM_CHUNK), b""):
+                        digest.update(chunk)
+            os.replace(part, filepath)
+            meta_path.unlink(missing_ok=True)
+        return size
+
+    @staticmethod
+    def _content_range(r: requests.Response) -> Tuple[int, Optional[int]]:
+        """解析 Content-Range: bytes <start>-<end>/<total>，返回 (start, total)；total 为 * 时返回 None。"""
+        value = (r.headers.get("Content-Range") or "").strip()
+        try:
+            unit, _, rest = value.partition(" ")
+            rng, _, total = rest.partition("/")
+            if unit != "bytes":
+                raise ValueError(value)
+            return int(rng.split("-")[0]), (None if total == "*" else int(total))
+        except ValueError:
+            raise IOError(f"无法解析 Content-Range / Bad Content-Range: {value!r}")
+
+    @staticmethod
+    def _load_resume_meta(path: Path, url: str) -> Optional[dict]:
+        """读取续传记录；不存在、损坏或来源 URL 不同（同名目标换了附件）时返回 None。"""
+        try:
+            meta = json.loads(path.read_text("utf-8"))
+        except (OSError, ValueError):
+            return None
+        return meta if isinstance(meta, dict) and meta.get("url") == url else None
+
+    @classmethod
+    def _save_resume_meta(cls, path: Path, meta: dict) -> None:
+        cls._atomic_write(path, [json.dumps(meta).encode("utf-8")])
+
+    def _write_content(self, item: _PendingAttachment, token: str, filepath: Path, digest=None) -> int:
+        a = item.attachment
+        if item.member is not None:
+            # 压缩包成员：边下载边解压，只写出成员本身
+            return self._atomic_write(filepath, self._member_chunks(item, token), digest=digest)
+        # 下载内容：元数据若带 contentBytes 则直接用，否则 $value 按需拉取
+        content_b64 = a.get("contentBytes")
+        if content_b64:
+            return self._atomic_write(filepath, self._b64_chunks(content_b64), digest=digest)
+        return self._download_value_to(
+            f"{self.GRAPH_BASE}{item.mailbox}/messages/{item.message_id}/attachments/{a['id']}/$value",
+            token,
+            filepath,
+            digest=digest,
+            expected_size=int(a.get("size") or 0) or None,
+        )
+
+    def _download_one(self, item: _PendingAttachment, token: str,
+                      cache: Optional[_AttachmentCache] = None) -> Tuple[dt.datetime, Path]:
+        if cache is None:
+            size = self._write_content(item, token, item.filepath)
+        else:
+            # 先下载到缓存临时区并计算 sha256，收进 blob 仓库后再落地到 save_dir
+            digest = hashlib.sha256()
+            tmp = cache.new_tmp(item.message_id, item.cache_id)
+            size = self._write_content(item, token, tmp, digest=digest)
+            blob = cache.ingest(item.message_id, item.cache_id, tmp, digest.hexdigest(), size)
+            cache.materialize(blob, item.filepath, size)
+        self._stats.add(files_downloaded=1, bytes_downloaded=size)
+        print(f"[SAVE] {item.filepath}")
+        return item.received, item.filepath
+
+    def _get_cache(self) -> _AttachmentCache:
+        if self._cache is None:
+            self._cache = _AttachmentCache(self.cache_dir)
+        return self._cache
+
+    def _batch_fetch_small(self, pending: List[_PendingAttachment], token: str) -> None:
+        """
+        小附件（size ≤ BATCH_VALUE_MAX_BYTES）经 $batch 合并拉取 $value；
+        批量响应里的二进制 body 为 base64，直接填入 contentBytes，交给常规写盘流程。
+        """
+        small = [p for p in pending
+                 if p.member is None and not p.attachment.get("contentBytes")
+                 and 0 < int(p.attachment.get("size") or 0) <= self.BATCH_VALUE_MAX_BYTES]
+        if len(small) < 2:
+            return
+        # 按大小分组，控制单个 $batch 响应体积
+        group: List[_PendingAttachment] = []
+        group_bytes = 0
+        groups: List[List[_PendingAttachment]] = []
+        for p in small:
+            size = int(p.attachment.get("size") or 0)
+            if group and (len(group) >= self.BATCH_LIMIT or group_bytes + size > 4 * self.BATCH_VALUE_MAX_BYTES):
+                groups.append(group)
+                group, group_bytes = [], 0
+            group.append(p)
+            group_bytes += size
+        if group:
+            groups.append(group)
+
+        for g in groups:
+            urls = {str(i): f"{p.mailbox}/messages/{p.message_id}/attachments/{p.attachment['id']}/$value"
+                    for i, p in enumerate(g)}
+            results = self._batch_get(urls, token)
+            for i, p in enumerate(g):
+                resp = results.get(str(i)) or {}
+                body = resp.get("body")
+                if int(resp.get("status", 0)) == 200 and isinstance(body, str):
+                    p.attachment = {**p.attachment, "contentBytes": body}
+                # 其余情况保持原样，由 _download_one 单独走 $value
+
+    def _download_pending(self, pending: List[_PendingAttachment], token: str,
+                          workers: int, use_batch: bool = False,
+                          use_cache: bool = False) -> List[Tuple[dt.datetime, Path]]:
+        """下载阶段：各附件相互独立，用有界线程池共享同一个 Session 并发拉取。"""
+        results: List[Optional[Tuple[dt.datetime, Path]]] = [None] * len(pending)
+        cache = self._get_cache() if use_cache else None
+        todo: List[int] = []
+        for i, p in enumerate(pending):
+            hit = cache.lookup(p.message_id, p.cache_id) if cache else None
+            if hit:
+                # 已缓存：不再请求 Graph，目标文件已存在且一致时连写盘也省掉
+                wrote = cache.materialize(hit[0], p.filepath, hit[1])
+                print(f"[CACHE] {'已从缓存恢复' if wrote else '已存在，跳过'} / "
+                      f"{'restored from cache' if wrote else 'up to date'}: {p.filepath}")
+                results[i] = (p.received, p.filepath)
+                self._stats.add(cache_hits=1)
+            else:
+                todo.append(i)
+
+        if use_batch:
+            self._batch_fetch_small([pending[i] for i in todo], token)
+        workers = min(max(1, int(workers)), len(todo))
+        if workers <= 1:
+            for i in todo:
+                results[i] = self._download_one(pending[i], token, cache)
+        else:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph-dl") as ex:
+                for i, r in zip(todo, ex.map(lambda i: self._download_one(pending[i], token, cache), todo)):
+                    results[i] = r
+        return [r for r in results if r is not None]
+
+    def _spool_one(self, item: _PendingAttachment, token: str, labels: List[str], spool_max_bytes: int,
+                   archiver: Optional[ThreadPoolExecutor]) -> AttachmentFile:
+        """
+        把一个附件下载进 SpooledTemporaryFile；archiver 不为空时同时把同一批数据块
+        交给后台线程原子写入 item.filepath（归档写盘不阻塞调用方解析）。
+        数据块队列有上限（ARCHIVE_QUEUE_CHUNKS）：归档尚未开始或写盘较慢时下载随之等待，内存不随附件大小增长。
+        """
+        a = item.attachment
+        spool = tempfile.SpooledTemporaryFile(max_size=spool_max_bytes)
+        chunk_q: Optional[queue.Queue] = None
+        archive: Optional[Future] = None
+        if archiver is not None:
+            chunk_q = queue.Queue(maxsize=self.ARCHIVE_QUEUE_CHUNKS)
+            archive = archiver.submit(self._atomic_write, item.filepath, self._queued_chunks(chunk_q))
+
+        def put(item) -> None:
+            # 归档写入已失败（不再取队列）时丢弃数据块，下载本身照常完成；错误由 archive.result() 报告
+            while not archive.done():
+                try:
+                    chunk_q.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def emit(chunk: bytes) -> None:
+            spool.write(chunk)
+            if chunk_q is not None:
+                put(chunk)
+
+        try:
+            content_b64 = a.get("contentBytes")
+            if item.member is not None:
+                for chunk in self._member_chunks(item, token):
+                    emit(chunk)
+            elif content_b64:
+                for chunk in self._b64_chunks(content_b64):
+                    emit(chunk)
+            else:
+                self._stream_value(
+                    f"{self.GRAPH_BASE}{item.mailbox}/messages/{item.message_id}/attachments/{a['id']}/$value",
+                    token, emit, expected_size=int(a.get("size") or 0) or None,
+                )
+        except BaseException as e:
+            spool.close()
+            if chunk_q is not None:
+                put(e)  # 让后台归档放弃并删除临时文件
+            raise
+        if chunk_q is not None:
+            put(None)
+        size = spool.tell()
+        spool.seek(0)
+        self._stats.add(files_downloaded=1, bytes_downloaded=size)
+        name = item.member["name"].rsplit("/", 1)[-1] if item.member else a.get("name") or item.filepath.name
+        print(f"[MEM] {name} ({size:,} bytes){' → ' + str(item.filepath) if archive else ''}")
+        return AttachmentFile(labels=labels, name=name, received=item.received,
+                              message_id=item.message_id, attachment_id=a.get("id", ""), size=size, file=spool,
+                              archive_path=item.filepath if archive else None, archive=archive)
+
+    def _stream_value(self, url: str, token: str, emit, expected_size: Optional[int] = None) -> int:
+        """
+        流式读取 $value 并逐块交给 emit；连接中断时用 Range 从已收到的字节处继续（不落盘的续传）。
+        服务器在续传时不支持 Range（返回 200）则报错，避免重复数据。返回字节数。
+        """
+        n = 0
+        for chunk in self._ranged_chunks(url, token):
+            emit(chunk)
+            n += len(chunk)
+        if expected_size and n > expected_size:
+            raise IOError(f"下载大小超过附件 size / Downloaded {n} bytes > attachment size {expected_size}")
+        return n
+
+    def _ranged_chunks(self, url: str, token: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+        """
+        逐块产出 $value 的 [start, end) 字节（end 为 None 表示到末尾）；连接中断时按 Range 从已产出的位置续传，
+        只有连续多次毫无进展才放弃。需要 Range 时服务器返回 200 则报错，避免重复/错位数据。
+        """
+        offset, failures, total = start, 0, None
+        while True:
+            headers = {"Authorization": f"Bearer {token}"}
+            if offset or end is not None:
+                headers["Range"] = f"bytes={offset}-{'' if end is None else end - 1}"
+            begin = offset
+            try:
+                with self._request("GET", url, headers=headers, stream=True,
+                                   timeout=(self.request_timeout, max(180, self.request_timeout))) as r:
+                    r.raise_for_status()
+                    if "Range" in headers:
+                        if r.status_code != 206:
+                            raise IOError(f"服务器忽略了 Range / Server ignored Range: {url}")
+                        got, size = self._content_range(r)
+                        if got != offset:
+                            raise IOError(f"Content-Range 起点不符 / Unexpected Content-Range start: {got} != {offset}")
+                        total = size if end is None or size is None else min(end, size)
+                    else:
+                        length = r.headers.get("Content-Length")
+                        total = int(length) if length and length.isdigit() else None
+                    for chunk in r.iter_content(chunk_size=self.STREAM_CHUNK):
+                        if chunk:
+                            offset += len(chunk)
+                            yield chunk
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                failures = 1 if offset > begin else failures + 1
+                if failures > self.RESUME_RETRIES:
+                    raise
+                self._stats.add(retries=1)
+                print(f"[RESUME] 连接中断，{offset} 字节处续传 / Connection dropped, resuming at byte {offset}: "
+                      f"{type(e).__name__}")
+                time.sleep(min(30.0, 0.5 * (2 ** failures)))
+                continue
+            if total is not None and offset != total:
+                raise IOError(f"下载不完整 / Incomplete download: {offset}/{total} bytes: {url}")
+            return
+
+    @staticmethod
+    def _queued_chunks(q: queue.Queue) -> Iterator[bytes]:
+        """从队列取数据块直到 None；取到异常对象则抛出（上游下载失败）。"""
+        while True:
+            item = q.get()
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise IOError(f"下载失败，放弃归档 / Download failed, archive abandoned: {item}")
+            yield item
+
+    # ---------- Archives (zip / gzip) ----------
+    @staticmethod
+    def _archive_kind(name: str) -> Optional[str]:
+        low = name.lower()
+        if low.endswith(".zip"):
+            return "zip"
+        if low.endswith(".gz") and not low.endswith(".tar.gz"):
+            return "gzip"
+        return None
+
+    @classmethod
+    def _wants_archive(cls, spec: AttachmentSpec, name: str) -> bool:
+        """unpack_archives 时，条件是否明确要压缩包本身（equals 为包名，或 ext 为 .zip/.gz 且命中）。"""
+        if spec.equals:
+            return spec.equals == name
+        return bool(spec.ext and cls._archive_kind(spec.ext) and spec.matches(name))
+
+    def _value_url(self, mailbox: str, message_id: str, attachment_id: str) -> str:
+        return f"{self.GRAPH_BASE}{mailbox}/messages/{message_id}/attachments/{attachment_id}/$value"
+
+    def _archive_members(self, mailbox: str, message_id: str, a: dict, token: str) -> List[dict]:
+        """
+        列出压缩附件中的成员（不下载整个压缩包）：
+        - gzip：成员名即去掉 .gz 的附件名；
+        - zip：Range 读取尾部 EOCD 与中央目录；服务器不支持 Range、ZIP64 等情况下
+          把整个压缩包流式下载到本地临时文件（不进内存）再用 zipfile 列目录。
+        """
+        name = a.get("name") or ""
+        kind = self._archive_kind(name)
+        if kind == "gzip":
+            return [{"kind": "gzip", "name": name[:-3]}]
+        url = self._value_url(mailbox, message_id, a["id"])
+        size = int(a.get("size") or 0)
+        tail_len = min(size, _ZipDirectory.TAIL_BYTES) if size else _ZipDirectory.TAIL_BYTES
+        try:
+            tail = self._read_range(url, token, f"bytes=-{tail_len}")
+            located = _ZipDirectory.parse_eocd(tail[1]) if tail else None
+            if located is not None:
+                cd_size, cd_offset = located
+                rel = cd_offset - tail[0]
+                if rel >= 0:
+                    cd = tail[1][rel:rel + cd_size]
+                else:
+                    got = self._read_range(url, token, f"bytes={cd_offset}-{cd_offset + cd_size - 1}")
+                    cd = got[1] if got else b""
+                if len(cd) == cd_size:
+                    members = _ZipDirectory.parse_entries(cd, cd_offset)
+                    if all(m["method"] in (0, 8) for m in members):  # stored / deflate 可直接流式解压
+                        return members
+        except IOError as e:
+            print(f"[ZIP] 无法按 Range 读取 zip 目录，改为整包下载 / Cannot read zip directory by Range, "
+                  f"downloading whole archive: {e}")
+        local = self._local_archive(url, token, name)
+        with zipfile.ZipFile(local) as zf:
+            return [{"kind": "zip", "name": info.filename, "size": info.file_size, "local": str(local)}
+                    for info in zf.infolist() if not info.is_dir() and not info.flag_bits & 0x1]
+
+    def _read_range(self, url: str, token: str, spec: str) -> Optional[Tuple[int, bytes]]:
+        """读取一小段 Range（整段放内存），返回 (起始偏移, 数据)；服务器不支持 Range 时返回 None。断线重试。"""
+        failures = 0
+        while True:
+            try:
+                with self._request("GET", url, headers={"Authorization": f"Bearer {token}", "Range": spec},
+                                   stream=True, timeout=max(180, self.request_timeout)) as r:
+                    r.raise_for_status()
+                    if r.status_code != 206:
+                        return None
+                    return self._content_range(r)[0], r.content
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                failures += 1
+                if failures > self.RESUME_RETRIES:
+                    raise
+                self._stats.add(retries=1)
+                time.sleep(min(30.0, 0.5 * (2 ** failures)))
+
+    def _local_archive(self, url: str, token: str, name: str) -> Path:
+        """把整个压缩包流式下载到本次运行的临时目录（同一附件只下载一次）。"""
+        if self._archive_tmp is None:
+            self._archive_tmp = Path(tempfile.mkdtemp(prefix="graph_archives_"))
+        path = self._archive_tmp / f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}{Path(name).suffix}"
+        if not path.exists():
+            self._download_value_to(url, token, path)
+        return path
+
+    def _cleanup_archives(self) -> None:
+        if self._archive_tmp is not None:
+            shutil.rmtree(self._archive_tmp, ignore_errors=True)
+            self._archive_tmp = None
+
+    def _member_chunks(self, item: _PendingAttachment, token: str) -> Iterator[bytes]:
+        """逐块产出压缩包成员解压后的内容。"""
+        m = item.member
+        url = self._value_url(item.mailbox, item.message_id, item.attachment["id"])
+        if m["kind"] == "gzip":
+            yield from self._gunzip_chunks(url, token)
+        elif m.get("local"):
+            with zipfile.ZipFile(m["local"]) as zf, zf.open(m["name"]) as f:
+                yield from iter(lambda: f.read(self.STREAM_CHUNK), b"")
+        else:
+            yield from self._zip_member_chunks(url, token, m)
+
+    def _gunzip_chunks(self, url: str, token: str) -> Iterator[bytes]:
+        """流式下载 .gz 并解压（支持多成员拼接的 gzip；CRC/长度由 zlib 校验）。"""
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        fed = False
+        for chunk in self._ranged_chunks(url, token):
+            while chunk:
+                fed = True
+                out = d.decompress(chunk)
+                if out:
+                    yield out
+                if d.eof:
+                    # 当前 gzip 成员结束，剩余数据属于下一个成员
+                    chunk, d, fed = d.unused_data, zlib.decompressobj(16 + zlib.MAX_WBITS), False
+                else:
+                    chunk = b""
+        if fed and not d.eof:
+            raise IOError(f"gzip 数据不完整 / Truncated gzip stream: {url}")
+
+    def _zip_member_chunks(self, url: str, token: str, m: dict) -> Iterator[bytes]:
+        """只 Range 下载一个 zip 成员（本地头 + 压缩数据），边下载边解压并校验 CRC32 与长度；断线从断点续传。"""
+        it = self._ranged_chunks(url, token, m["offset"], m["end"])
+        buf = b""
+
+        def take(n: int) -> bytes:
+            nonlocal buf
+            while len(buf) < n:
+                c = next(it, b"")
+                if not c:
+                    raise IOError(f"zip 成员数据不完整 / Truncated zip member: {m['name']}")
+                buf += c
+            head, buf = buf[:n], buf[n:]
+            return head
+
+        header = struct.unpack(_ZipDirectory.LOCAL_FMT, take(struct.calcsize(_ZipDirectory.LOCAL_FMT)))
+        if header[0] != _ZipDirectory.LOCAL_SIG:
+            raise IOError(f"zip 本地头无效 / Bad zip local header: {m['name']}")
+        take(header[9] + header[10])  # 跳过本地头里的文件名与扩展字段
+
+        d = zlib.decompressobj(-zlib.MAX_WBITS) if m["method"] == 8 else None
+        remaining, crc, size = m["comp_size"], 0, 0
+        try:
+            for c in itertools.chain([buf], it):
+                c = c[:remaining]
+                remaining -= len(c)
+                out = d.decompress(c) if d is not None else c
+                if out:
+                    crc, size = zlib.crc32(out, crc), size + len(out)
+                    yield out
+                if remaining <= 0:
+                    break
+        finally:
+            it.close()  # 数据描述符等尾部字节不再需要，释放连接
+        if d is not None:
+            out = d.flush()
+            if out:
+                crc, size = zlib.crc32(out, crc), size + len(out)
+                yield out
+        if remaining > 0 or size != m["size"] or crc != m["crc"]:
+            raise IOError(f"zip 成员校验失败 / zip member check failed (CRC/size): {m['name']}")
+
+    # ---------- File writing ----------
+    @staticmethod
+    def _atomic_write(filepath: Path, chunks: Iterable[bytes], digest=None) -> int:
+        """
+        先写同目录下的隐藏临时文件（.xxx.part），完整写完并落盘后再 os.replace 到目标名；
+        中途异常会删掉临时文件，目标目录里不会出现写了一半的 .xlsx。
+        digest（hashlib 对象）不为空时边写边更新摘要。
+        """
+        fd, tmp = tempfile.mkstemp(dir=str(filepath.parent), prefix=f".{filepath.name}.", suffix=".part")
+        written = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    if chunk:
+                        f.write(chunk)
+                        written += len(chunk)
+                        if digest is not None:
+                            digest.update(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, filepath)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return written
+
+    @classmethod
+    def _b64_chunks(cls, data: str) -> Iterator[bytes]:
+        """按 4 字符对齐分段解码 base64，避免整段解码后的二次整块拷贝。"""
+        step = cls.STREAM_CHUNK - cls.STREAM_CHUNK % 4
+        for i in range(0, len(data), step):
+            yield base64.b64decode(data[i:i + step])
 
     # ---------- Utilities ----------
     @staticmethod
@@ -216,6 +1817,259 @@ class GraphMailAttachmentTool:
     def _safe_name(n: str) -> str:
         return "".join(ch for ch in n if ch not in '\\/:*?"<>|')
 
+    # ---------- Matching ----------
+    def _match_pages(self, pages: Iterator[List[dict]], state: _ScanState, *, token: str, since_iso: str,
+                     max_scan: int, save_path: Path, use_batch: bool = False,
+                     index: Optional[_MailIndex] = None, unpack_archives: bool = False) -> None:
+        """逐页读取附件元数据并按 state.open_specs 登记命中，直到条件全部满足/越过时间窗口/达到扫描上限。"""
+        since_dt = self._parse_graph_dt(since_iso)
+        scanned0 = state.scanned
+        try:
+            for msgs in pages:
+                done = not state.open_specs
+                for pos, m in enumerate(msgs):
+                    state.scanned += 1
+                    rdt_str = m.get("receivedDateTime") or ""
+                    if not rdt_str:
+                        continue
+                    rdt = self._parse_graph_dt(rdt_str)
+                    if rdt < since_dt:
+                        done = True  # 时间更老，无需继续分页
+                        break
+                    if not m.get("hasAttachments"):
+                        continue
+
+                    mid = m["id"]
+                    # 读取附件元数据（server_filter 模式下已随列表 $expand 返回，索引模式下可能已缓存）
+                    atts = m.get("attachments")
+                    if atts is None and use_batch:
+                        # 从当前邮件起，把本页后续待查元数据的邮件按 BATCH_LIMIT 合并成一次 $batch
+                        ahead = [x for x in msgs[pos:]
+                                 if x.get("hasAttachments") and x.get("attachments") is None
+                                 and (x.get("receivedDateTime") or "") >= since_iso][:self.BATCH_LIMIT]
+                        fetched = self._batch_list_attachments(ahead, token)
+                        for x in ahead:
+                            x["attachments"] = fetched[x["id"]]
+                            if index is not None:
+                                index.store_attachments(x["id"], x["attachments"])
+                        atts = m["attachments"]
+                    elif atts is None:
+                        atts = self._list_attachments(mid, token, m.get("_mailbox", "/me"))
+                        if index is not None:
+                            index.store_attachments(mid, atts)
+                    for a in atts:
+                        if a.get("isInline"):
+                            continue
+                        otype = a.get("@odata.type", "")
+                        if otype and not otype.endswith("fileAttachment"):
+                            continue
+
+                        # 候选：附件本身；unpack_archives 时压缩包改由其成员代表（同名成员只取第一个），
+                        # 包本身只提供给明确要压缩包的条件（见 _wants_archive），读不出成员时才整体作为候选
+                        att_name = a.get("name") or "attachment.bin"
+                        candidates: List[Tuple[str, Optional[dict]]] = [(att_name, None)]
+                        unpack = unpack_archives and self._archive_kind(att_name) is not None
+                        # zip 列成员需要 Range 读取：只有存在可能命中成员的条件时才读
+                        if unpack and any(not self._wants_archive(sp, att_name) for sp in state.open_specs):
+                            try:
+                                members = self._archive_members(m.get("_mailbox", "/me"), mid, a, token)
+                            except (IOError, zipfile.BadZipFile) as e:
+                                print(f"[WARN] 无法读取压缩附件 / Cannot read archive {att_name}: {e}")
+                                unpack = False
+                            else:
+                                seen_names: set = set()
+                                for mb in members:
+                                    base_name = Path(mb["name"]).name.lower()
+                                    if base_name not in seen_names:
+                                        seen_names.add(base_name)
+                                        candidates.append((mb["name"], mb))
+
+                        for name, member in candidates:
+                            if not state.open_specs:
+                                break
+                            if unpack and member is None:
+                                matched = [sp for sp in state.open_specs if self._wants_archive(sp, name)]
+                            else:
+                                matched = [sp for sp in state.open_specs if sp.matches(Path(name).name)]
+                            if not matched:
+                                continue
+
+                            key = (mid, a.get("id") or name)
+                            if member is not None:
+                                key = (mid, f"{key[1]}#{member['name']}")
+                            if key not in state.pending:
+                                # 以邮件接收时间戳重命名（压缩包成员只取成员文件名，不保留包内目录）
+                                ts = rdt_str.replace(":", "").replace("-", "")[:15]  # e.g. 20250921T103000
+                                safe = self._safe_name(Path(name).name)
+                                base, extname = os.path.splitext(safe)
+                                filepath = save_path / f"{base}_{ts}{extname}"
+                                # 先只登记，内容在扫描结束后统一（并发）下载
+                                state.pending[key] = _PendingAttachment(received=rdt, message_id=mid,
+                                                                        attachment=a, filepath=filepath,
+                                                                        mailbox=m.get("_mailbox", "/me"),
+                                                                        member=member)
+                            for sp in matched:
+                                state.hits[sp.label].append(key)
+                                if len(state.hits[sp.label]) >= sp.need_count:
+                                    state.open_specs.remove(sp)
+                        if not state.open_specs:
+                            break
+                    if not state.open_specs or state.scanned >= max_scan:
+                        done = True
+                        break
+                if done:
+                    break
+        finally:
+            self._stats.add(messages_scanned=state.scanned - scanned0)
+            # 提前结束（条件已满足/越过时间窗口）时关闭生成器，取消尚未发出的预取请求
+            close = getattr(pages, "close", None)
+            if close is not None:
+                close()
+
+    @staticmethod
+    def _search_kql(specs: List[AttachmentSpec], since_iso: str) -> Optional[str]:
+        """由筛选条件生成 KQL；只有扩展名条件时无法缩小范围，返回 None。"""
+        terms = []
+        for sp in specs:
+            kw = (sp.equals or sp.contains or "").replace('"', "").strip()
+            if not kw:
+                return None
+            terms.append(f"attachment:'{kw}'" if " " in kw else f"attachment:{kw}")
+        names = terms[0] if len(terms) == 1 else "(" + " OR ".join(terms) + ")"
+        return f"hasattachments:true AND {names} AND received>={since_iso[:10]}"
+
+    def _search_messages(self, messages_url: str, specs: List[AttachmentSpec], since_iso: str,
+                         page_size: int, max_scan: int, token: str) -> Optional[List[dict]]:
+        """
+        用 $search（KQL attachment:/hasattachments:）取候选邮件，按接收时间倒序返回。
+        $search 不能与 $orderby/$filter 同用，故时间窗口与排序在本地完成；出错返回 None。
+        $search 按相关度而非时间返回，窗口内命中超过 max_scan 时截断会丢掉较新的邮件，
+        此时同样返回 None，回退到按时间排序的 $filter 扫描。
+        """
+        kql = self._search_kql(specs, since_iso)
+        if not kql:
+            return None
+        params = {
+            "$search": f'"{kql}"',
+            "$select": "id,subject,receivedDateTime,hasAttachments",
+            "$top": str(int(page_size)),
+        }
+        msgs: List[dict] = []
+        try:
+            for page in self._scan_pages(messages_url, params, token):
+                msgs.extend(m for m in page if (m.get("receivedDateTime") or "") >= since_iso)
+                if len(msgs) > max_scan:
+                    print(f"[SEARCH] $search 命中超过 max_scan={max_scan}，改用扫描 / "
+                          f"$search hits exceed max_scan={max_scan}, falling back to scan")
+                    return None
+        except requests.HTTPError as e:
+            print(f"[SEARCH] $search 失败 / $search failed: {str(e).splitlines()[0]}")
+            return None
+        msgs.sort(key=lambda m: m.get("receivedDateTime") or "", reverse=True)
+        return msgs
+
+    def _search_sources(self, sources: List[Tuple[str, Optional[str], str]], specs: List[AttachmentSpec],
+                        since_iso: str, page_size: int, max_scan: int, token: str) -> Optional[List[dict]]:
+        """对每个来源并发执行 $search，合并后按接收时间倒序返回；任一来源出错即返回 None（回退扫描）。"""
+        def one(src: Tuple[str, Optional[str], str]) -> Optional[List[dict]]:
+            msgs = self._search_messages(src[2], specs, since_iso, page_size, max_scan, token)
+            for m in msgs or []:
+                m["_mailbox"] = src[0]
+            return msgs
+
+        if len(sources) == 1:
+            return one(sources[0])
+        with ThreadPoolExecutor(max_workers=min(len(sources), self.max_workers),
+                                thread_name_prefix="graph-search") as ex:
+            found = list(ex.map(one, sources))
+        if any(f is None for f in found):
+            return None
+        return list(heapq.merge(*found, key=lambda m: m.get("receivedDateTime") or "", reverse=True))
+
+    def _scan(self, spec_list: List[AttachmentSpec], token: str, *, days_back: int, page_size: int,
+              max_scan: int, save_path: Path, mail_folder: Optional[str | List[str]],
+              mailboxes: Optional[List[str]], server_filter: bool, use_index: bool, use_batch: bool,
+              prefetch_pages: bool, search: bool, unpack_archives: bool = False) -> _ScanState:
+        """扫描阶段：按各开关列邮件、读附件元数据并登记命中，返回待下载附件（不下载内容）。"""
+        since_iso = self._iso_utc_minus_days(days_back)
+
+        # Messages endpoint：邮箱 × 文件夹，每个组合一个来源（可选限定到文件夹）
+        folders = [mail_folder] if isinstance(mail_folder, str) else list(mail_folder or [None])
+        sources: List[Tuple[str, Optional[str], str]] = []  # (邮箱前缀, 文件夹 id, messages URL)
+        for mailbox in dict.fromkeys(self._mailbox_base(mb) for mb in (mailboxes or [None])):
+            for folder in folders:
+                if folder:
+                    try:
+                        fid = self._resolve_folder(mailbox, folder, token)
+                    except ValueError as e:
+                        # 邮箱 × 文件夹组合里某个邮箱没有该子文件夹：跳过该组合，其余照常扫描
+                        print(f"[WARN] {e}")
+                        continue
+                    sources.append((mailbox, fid, f"{self.GRAPH_BASE}{mailbox}/mailFolders/{fid}/messages"))
+                else:
+                    sources.append((mailbox, None, f"{self.GRAPH_BASE}{mailbox}/messages"))
+        if not sources:
+            raise ValueError(f"没有可扫描的邮件文件夹 / No mail folder to scan: {mail_folder}")
+        if (any(mailbox != "/me" for mailbox, _, _ in sources)
+                and self.SHARED_MAILBOX_SCOPE.lower() not in self.auth.scopes.lower().split()):
+            print(f"[WARN] 读取共享邮箱需要 {self.SHARED_MAILBOX_SCOPE} 权限，当前 scopes 为 '{self.auth.scopes}'，"
+                  f"可能返回 403；请在构造时传 scopes=\"... {self.SHARED_MAILBOX_SCOPE}\" / "
+                  f"Shared mailboxes need the {self.SHARED_MAILBOX_SCOPE} scope (current: '{self.auth.scopes}'); "
+                  f"expect 403 unless scopes includes it")
+        # 只有当前用户的单个来源时沿用原来的顺序分页（可选预取）；否则并发分页后归并
+        single = len(sources) == 1 and sources[0][0] == "/me"
+
+        params = {
+            "$select": "id,subject,receivedDateTime,hasAttachments",
+            "$orderby": "receivedDateTime desc",
+            "$top": str(int(page_size)),
+        }
+        if server_filter:
+            # $orderby 的字段需先出现在 $filter 中，故 receivedDateTime 放在最前
+            params["$filter"] = f"receivedDateTime ge {since_iso} and hasAttachments eq true"
+            params["$expand"] = f"attachments($select={self.ATTACHMENT_META_SELECT})"
+
+        index: Optional[_MailIndex] = None
+        state = _ScanState.start(spec_list)
+        match_kw = dict(token=token, since_iso=since_iso, max_scan=max_scan, save_path=save_path,
+                        use_batch=use_batch, unpack_archives=unpack_archives)
+
+        # delta 索引只支持当前用户邮箱下的指定文件夹；不满足时回退在线扫描（此时 $search 照常生效）
+        index_ok = use_index and all(fid and mailbox == "/me" for mailbox, fid, _ in sources)
+        if search and index_ok:
+            print("[SEARCH] 已使用本地 delta 索引，忽略 search（筛选在本地索引中完成） / "
+                  "search is ignored with the local delta index (filtering is done locally)")
+        elif search:
+            # 先用 $search 拿到小候选集；未能满足全部条件（无结果/出错/不完整）时回退到常规扫描
+            found = self._search_sources(sources, spec_list, since_iso, page_size, max_scan, token)
+            if found:
+                self._match_pages(iter([found]), state, **match_kw)
+            if state.open_specs:
+                print("[SEARCH] $search 未能满足全部条件，回退到常规扫描 / "
+                      "$search did not satisfy every spec; falling back to scan")
+                state.reopen(state.open_specs)
+            else:
+                print(f"[SEARCH] $search 命中，候选邮件 {len(found or [])} 封 / "
+                      f"$search satisfied all specs from {len(found or [])} candidate message(s)")
+
+        if state.open_specs:
+            if index_ok:
+                index = self._get_index()
+                pages = self._index_pages([fid for _, fid, _ in sources], since_iso, token)
+            else:
+                if use_index:
+                    print("[INDEX] delta 索引需指定 mail_folder 且只支持当前用户邮箱，改用在线扫描 / "
+                          "Delta index needs mail_folder on the signed-in mailbox; falling back to online scan")
+                if single:
+                    pages = self._scan_pages(sources[0][2], params, token, prefetch=prefetch_pages,
+                                             since_iso=since_iso, max_items=max_scan)
+                else:
+                    pages = self._merged_pages([(mailbox, url) for mailbox, _, url in sources], params, token,
+                                               since_iso=since_iso, max_items=max_scan, page_size=page_size)
+            self._match_pages(pages, state, index=index, **match_kw)
+
+        return state
+
     # ---------- Public API ----------
     def download_latest_attachments(
         self,
@@ -228,8 +2082,18 @@ class GraphMailAttachmentTool:
         page_size: int = 50,
         max_scan: int = 800,
         save_dir: str | os.PathLike = ".",
-        mail_folder: Optional[str] = None,  # e.g. "inbox"；默认所有文件夹
-    ) -> List[Path]:
+        mail_folder: Optional[str | List[str]] = None,  # e.g. "inbox"；默认所有文件夹
+        mailboxes: Optional[List[str]] = None,
+        server_filter: bool = False,
+        download_workers: Optional[int] = None,
+        use_index: bool = False,
+        use_batch: bool = False,
+        prefetch_pages: bool = False,
+        use_cache: bool = False,
+        search: bool = False,
+        unpack_archives: bool = False,
+        return_stats: bool = False,
+    ) -> List[Path] | Tuple[List[Path], DownloadStats]:
         """
         下载符合筛选条件的最新 N 个附件，并返回保存路径列表（按接收时间新→旧）。
 
@@ -241,114 +2105,226 @@ class GraphMailAttachmentTool:
         :param page_size:  每页抓取邮件数（默认 50）。
         :param max_scan:   最多扫描的邮件数（默认 800）。
         :param save_dir:   保存目录（不存在将自动创建）。
-        :param mail_folder:指定邮件夹（如 "inbox"），不传则扫描所有文件夹。
+        :param mail_folder:指定邮件夹（如 "inbox"，子文件夹可写 "inbox/Supply"），不传则扫描所有文件夹；
+                           传列表时各文件夹并发扫描，按接收时间归并后再取最新 N 个。
+        :param mailboxes:  要扫描的邮箱（共享邮箱/他人邮箱的 UPN，"me" 为当前用户），默认只扫当前用户；
+                           与 mail_folder 组合为"邮箱 × 文件夹"，全部并发扫描并按接收时间归并。
+        :param server_filter: 服务端过滤模式：把时间窗口与 hasAttachments 放进 $filter，
+                           并用 $expand 随邮件列表一起取回附件元数据，省去逐封 /attachments 请求。
+        :param download_workers: 并发下载线程数（默认取构造参数 max_workers，1 为串行）。
+        :param use_index:  使用本地 delta 索引（需指定 mail_folder）：只向 Graph 请求增量变更与附件内容，
+                           邮件筛选直接查本地 SQLite。
+        :param use_batch:  用 JSON $batch 合并附件元数据请求与小附件（≤ BATCH_VALUE_MAX_BYTES）内容下载，
+                           每次最多 20 个子请求；子请求 429/5xx 单独重试。
+        :param prefetch_pages: 处理当前页附件的同时后台预取下一页邮件列表（深度扫描时隐藏列表延迟）。
+        :param use_cache:  启用本地内容缓存（按 message id + attachment id，sha256 去重）：
+                           重跑时不再下载，目标文件已存在则直接返回。
+        :param search:     先用 Graph $search（KQL attachment:/hasattachments:）取小候选集，
+                           无结果/出错/未满足条件时回退到常规扫描。注意 $search 依赖邮箱索引，
+                           刚到达的邮件可能尚未被索引。
+        :param unpack_archives: 筛选条件同时匹配 .zip/.gz 附件内的成员文件名，命中的成员单独解压保存
+                           （文件名为成员名 + 时间戳）。zip 只按 Range 读取中央目录与命中成员的数据，
+                           边下载边解压并校验 CRC；服务器不支持 Range、ZIP64 或非 deflate 压缩时
+                           整包流式下载到临时文件后解压。
+        :param return_stats: 为 True 时返回 (paths, DownloadStats)：页数、扫描邮件数、元数据请求数、
+                           下载字节数、认证/列表/下载各阶段耗时、重试与限流次数。
         :return:           List[Path] 已保存文件路径，按邮件接收时间降序。
         """
-        save_path = Path(save_dir)
-        save_path.mkdir(parents=True, exist_ok=True)
+        spec = AttachmentSpec(contains=contains, equals=equals, ext=ext, need_count=need_count)
+        result = self.download_many(
+            [spec],
+            days_back=days_back,
+            page_size=page_size,
+            max_scan=max_scan,
+            save_dir=save_dir,
+            mail_folder=mail_folder,
+            mailboxes=mailboxes,
+            server_filter=server_filter,
+            download_workers=download_workers,
+            use_index=use_index,
+            use_batch=use_batch,
+            prefetch_pages=prefetch_pages,
+            use_cache=use_cache,
+            search=search,
+            unpack_archives=unpack_archives,
+            return_stats=return_stats,
+        )
+        if return_stats:
+            result, stats = result
+            return result[spec.label], stats
+        return result[spec.label]
 
-        token = self.get_access_token()
-        since_iso = self._iso_utc_minus_days(days_back)
-        since_dt = self._parse_graph_dt(since_iso)
+    def download_many(
+        self,
+        specs: Iterable[AttachmentSpec | dict],
+        *,
+        days_back: int = 90,
+        page_size: int = 50,
+        max_scan: int = 800,
+        save_dir: str | os.PathLike = ".",
+        mail_folder: Optional[str | List[str]] = None,
+        mailboxes: Optional[List[str]] = None,
+        server_filter: bool = False,
+        download_workers: Optional[int] = None,
+        use_index: bool = False,
+        use_batch: bool = False,
+        prefetch_pages: bool = False,
+        use_cache: bool = False,
+        search: bool = False,
+        unpack_archives: bool = False,
+        return_stats: bool = False,
+    ) -> Dict[str, List[Path]] | Tuple[Dict[str, List[Path]], DownloadStats]:
+        """
+        一次扫描邮箱同时满足多组筛选条件（每组各取最新 need_count 个）。
+        同一附件命中多组时只下载一次；全部满足或到达扫描上限/时间窗口即停止。
 
-        # Messages endpoint（可选限定到某个文件夹）
-        if mail_folder:
-            messages_url = f"{self.GRAPH_BASE}/me/mailFolders/{mail_folder}/messages"
-        else:
-            messages_url = f"{self.GRAPH_BASE}/me/messages"
+        :param specs:  AttachmentSpec 或等价 dict（contains/equals/ext/need_count/key）。
+        :return:       {spec.label: [Path, ...]}，每组按邮件接收时间降序；
+                       return_stats=True 时返回 ({...}, DownloadStats)。
+        其余参数同 download_latest_attachments。
+        """
+        spec_list = [sp if isinstance(sp, AttachmentSpec) else AttachmentSpec(**sp) for sp in specs]
+        labels = [sp.label for sp in spec_list]
+        if len(set(labels)) != len(labels):
+            raise ValueError(f"筛选条件的 key 重复 / Duplicate spec keys: {labels}")
 
-        params = {
-            "$select": "id,subject,receivedDateTime,hasAttachments",
-            "$orderby": "receivedDateTime desc",
-            "$top": str(int(page_size)),
-        }
+        save_path = Path(save_dir)
+        save_path.mkdir(parents=True, exist_ok=True)
 
-        def _name_match(name: str) -> bool:
-            low = (name or "").lower()
-            if equals:
-                return name == equals
-            ok = True
-            if contains:
-                ok = (contains.lower() in low)
-            if ok and ext:
-                ok = low.endswith(ext.lower())
-            return ok
-
-        saved: List[Tuple[dt.datetime, Path]] = []
-        found = scanned = 0
-        url = messages_url
-        local_params = params
-        while url and scanned < max_scan and found < need_count:
-            data = self._gget(url, token, params=local_params)
-            local_params = None  # nextLink 已经包含分页参数
-            msgs = data.get("value", [])
-            if not msgs:
-                break
+        stats = self._stats = DownloadStats()
+        t_start = time.perf_counter()
+        token = self.get_access_token()
+        t_listed = time.perf_counter()
+        stats.auth_seconds = t_listed - t_start
+        try:
+            state = self._scan(spec_list, token, days_back=days_back, page_size=page_size, max_scan=max_scan,
+                               save_path=save_path, mail_folder=mail_folder, mailboxes=mailboxes,
+                               server_filter=server_filter, use_index=use_index, use_batch=use_batch,
+                               prefetch_pages=prefetch_pages, search=search, unpack_archives=unpack_archives)
 
-            for m in msgs:
-                scanned += 1
-                rdt_str = m.get("receivedDateTime") or ""
-                if not rdt_str:
-                    continue
-                rdt = self._parse_graph_dt(rdt_str)
-                if rdt < since_dt:
-                    url = None  # 时间更老，无需继续分页
-                    break
-                if not m.get("hasAttachments"):
-                    continue
+            pending, hits = state.pending, state.hits
+            items = list(pending.values())
+            t_download = time.perf_counter()
+            stats.list_seconds = t_download - t_listed
+            saved = self._download_pending(items, token, workers=download_workers or self.max_workers,
+                                           use_batch=use_batch, use_cache=use_cache)
+        finally:
+            self._cleanup_archives()
+        stats.download_seconds = time.perf_counter() - t_download
+        stats.total_seconds = time.perf_counter() - t_start
+        by_key = {key: rp for key, rp in zip(pending.keys(), saved)}
 
-                mid = m["id"]
-                # 读取附件元数据
-                atts = self._gget(f"{self.GRAPH_BASE}/me/messages/{mid}/attachments", token)
-                for a in atts.get("value", []):
-                    if a.get("isInline"):
-                        continue
-                    otype = a.get("@odata.type", "")
-                    if otype and not otype.endswith("fileAttachment"):
-                        continue
+        out: Dict[str, List[Path]] = {}
+        for sp in spec_list:
+            # 按时间排序（新→旧），仅返回路径
+            rows = sorted((by_key[k] for k in hits[sp.label]), key=lambda t: t[0], reverse=True)
+            out_paths = [p for _, p in rows][:sp.need_count]
+            out[sp.label] = out_paths
+            if not out_paths:
+                print(f"[WARN] [{sp.label}] 未找到匹配附件。请检查关键词/扩展名或增大 days_back。"
+                      " / No matching attachments found. Check keywords/extensions or increase days_back.")
+            else:
+                print(f"[OK] [{sp.label}] 下载完成，共 {len(out_paths)} 个。目录: {save_path.resolve()} / "
+                      f"Download complete, total {len(out_paths)}. Folder: {save_path.resolve()}")
+        if return_stats:
+            return out, stats
+        return out
 
-                    name = a.get("name") or "attachment.bin"
-                    if not _name_match(name):
-                        continue
+    def iter_attachments(
+        self,
+        specs: Iterable[AttachmentSpec | dict],
+        *,
+        days_back: int = 90,
+        page_size: int = 50,
+        max_scan: int = 800,
+        mail_folder: Optional[str | List[str]] = None,
+        mailboxes: Optional[List[str]] = None,
+        server_filter: bool = False,
+        download_workers: Optional[int] = None,
+        use_index: bool = False,
+        use_batch: bool = False,
+        prefetch_pages: bool = False,
+        search: bool = False,
+        unpack_archives: bool = False,
+        archive_dir: Optional[str | os.PathLike] = None,
+        wait_archive: bool = True,
+        spool_max_bytes: Optional[int] = None,
+    ) -> Iterator[AttachmentFile]:
+        """
+        与 download_many 相同的扫描/筛选，但附件内容不落盘：逐个产出 AttachmentFile（按接收时间新→旧），
+        file 为 SpooledTemporaryFile（不超过 spool_max_bytes 时在内存），可直接交给 pandas 等解析。
 
-                    # 以邮件接收时间戳重命名
-                    ts = rdt_str.replace(":", "").replace("-", "")[:15]  # e.g. 20250921T103000
-                    safe = self._safe_name(name)
-                    base, extname = os.path.splitext(safe)
-                    filepath = save_path / f"{base}_{ts}{extname}"
+        :param archive_dir:     不为空时在后台把附件另存到该目录（文件名同 download_many，原子写入），
+                                不阻塞解析。
+        :param wait_archive:    True（默认）时全部产出后等待归档完成，归档失败在迭代结束处抛出；
+                                False 时迭代结束即返回，由调用方稍后检查各 AttachmentFile.archive.result()。
+        :param spool_max_bytes: 单个附件在内存中的上限（默认 SPOOL_MAX_BYTES），超过后转存本地临时文件。
+        同一附件命中多组条件时只产出一次（labels 列出全部命中的 key）。调用方负责 close() 每个文件；
+        提前结束迭代时，尚未产出的附件会被关闭，未开始的下载会被取消。
+        其余参数同 download_latest_attachments。
+        """
+        spec_list = [sp if isinstance(sp, AttachmentSpec) else AttachmentSpec(**sp) for sp in specs]
+        labels = [sp.label for sp in spec_list]
+        if len(set(labels)) != len(labels):
+            raise ValueError(f"筛选条件的 key 重复 / Duplicate spec keys: {labels}")
+        archive_path = Path(archive_dir) if archive_dir else None
+        if archive_path is not None:
+            archive_path.mkdir(parents=True, exist_ok=True)
 
-                    # 下载内容：优先 contentBytes，否则 $value
-                    content_b64 = a.get("contentBytes")
-                    if content_b64:
-                        content = base64.b64decode(content_b64)
-                    else:
-                        att_id = a["id"]
-                        content = self._download_value(
-                            f"{self.GRAPH_BASE}/me/messages/{mid}/attachments/{att_id}/$value",
-                            token,
-                        )
-
-                    filepath.write_bytes(content)
-                    print(f"[SAVE] {filepath}")
-                    saved.append((rdt, filepath))
-                    found += 1
-                    if found >= need_count:
-                        break
-                if found >= need_count or scanned >= max_scan:
-                    break
-            url = data.get("@odata.nextLink")
+        self._stats = DownloadStats()
+        token = self.get_access_token()
+        state = self._scan(spec_list, token, days_back=days_back, page_size=page_size, max_scan=max_scan,
+                           save_path=archive_path or Path("."), mail_folder=mail_folder, mailboxes=mailboxes,
+                           server_filter=server_filter, use_index=use_index, use_batch=use_batch,
+                           prefetch_pages=prefetch_pages, search=search, unpack_archives=unpack_archives)
 
-        # 按时间排序（新→旧），仅返回路径
-        saved.sort(key=lambda t: t[0], reverse=True)
-        out_paths = [p for _, p in saved][:need_count]
+        # 每组条件取最新 need_count 个，合并去重后整体按时间新→旧
+        key_labels: Dict[Tuple[str, str], List[str]] = {}
+        for sp in spec_list:
+            keys = sorted(state.hits[sp.label], key=lambda k: state.pending[k].received, reverse=True)
+            for k in keys[:sp.need_count]:
+                key_labels.setdefault(k, []).append(sp.label)
+            if not keys:
+                print(f"[WARN] [{sp.label}] 未找到匹配附件。请检查关键词/扩展名或增大 days_back。"
+                      " / No matching attachments found. Check keywords/extensions or increase days_back.")
+        keys = sorted(key_labels, key=lambda k: state.pending[k].received, reverse=True)
+        items = [state.pending[k] for k in keys]
+        if use_batch:
+            self._batch_fetch_small(items, token)
 
-        if not out_paths:
-            print("[WARN] 未找到匹配附件。请检查关键词/扩展名或增大 days_back。"
-                  " / No matching attachments found. Check keywords/extensions or increase days_back.")
-        else:
-            print(f"[OK] 下载完成，共 {len(out_paths)} 个。目录: {save_path.resolve()} / "
-                  f"Download complete, total {len(out_paths)}. Folder: {save_path.resolve()}")
-        return out_paths
+        spool_max = int(spool_max_bytes or self.SPOOL_MAX_BYTES)
+        workers = max(1, min(int(download_workers or self.max_workers), len(items) or 1))
+        # 每个下载线程对应一个归档线程：进行中的下载都有归档在取队列，不会因排队而卡住
+        archiver = (ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph-archive")
+                    if archive_path is not None else None)
+        ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="graph-dl")
+        futures = [ex.submit(self._spool_one, item, token, key_labels[k], spool_max, archiver)
+                   for k, item in zip(keys, items)]
+        archives: List[Future] = []
+        handed = 0
+        try:
+            for fut in futures:
+                af = fut.result()
+                if af.archive is not None:
+                    archives.append(af.archive)
+                handed += 1
+                yield af
+        finally:
+            ex.shutdown(wait=True, cancel_futures=True)
+            self._cleanup_archives()
+            # 提前结束/出错：关闭已下载但未交给调用方的文件（其后台归档照常完成）
+            for fut in futures[handed:]:
+                if fut.done() and not fut.cancelled() and fut.exception() is None:
+                    fut.result().close()
+            if archiver is not None:
+                archiver.shutdown(wait=wait_archive)
+        if not wait_archive:
+            return
+        errors = [f.exception() for f in archives if f.exception() is not None]
+        if errors:
+            raise errors[0]
+        if archive_path is not None:
+            print(f"[OK] 已归档 {len(archives)} 个附件 / Archived {len(archives)} attachment(s): {archive_path.resolve()}")
 
 
 # =========================
@@ -366,32 +2342,92 @@ if __name__ == "__main__":
     parser.add_argument("--equals", default=None, help="文件名精确等于（优先级更高）")
     parser.add_argument("--ext", default=None, help="扩展名过滤，如 .xlsx")
     parser.add_argument("--need-count", type=int, default=2)
+    parser.add_argument("--manifest", default=None,
+                        help="JSON 文件：筛选条件列表（contains/equals/ext/need_count/key），一次扫描全部满足")
     parser.add_argument("--days-back", type=int, default=90)
     parser.add_argument("--page-size", type=int, default=50)
     parser.add_argument("--max-scan", type=int, default=800)
     parser.add_argument("--save-dir", default=".")
     parser.add_argument("--token-cache", default="graph_token_cache.json")
-    parser.add_argument("--mail-folder", default=None, help="指定文件夹（如 inbox），默认为所有文件夹")
+    parser.add_argument("--mail-folder", action="append", default=None,
+                        help="指定文件夹（如 inbox、inbox/Supply，可重复，并发扫描），默认为所有文件夹")
+    parser.add_argument("--mailbox", action="append", default=None,
+                        help="共享邮箱/他人邮箱的 UPN（可重复，me 为当前用户），默认当前用户")
+    parser.add_argument("--scopes", default=None,
+                        help="委托权限（空格分隔）；默认 Mail.Read offline_access，指定了共享邮箱时自动加 Mail.Read.Shared")
     parser.add_argument("--timeout", type=int, default=60, help="请求超时时间（秒）")
+    parser.add_argument("--workers", type=int, default=4, help="并发下载线程数")
+    parser.add_argument("--max-rps", type=float, default=10.0, help="Graph 请求速率上限（次/秒）")
+    parser.add_argument("--max-concurrency", type=int, default=4, help="Graph 在途请求并发上限")
+    parser.add_argument("--server-filter", action="store_true",
+                        help="服务端 $filter + $expand 附件元数据，减少逐封请求")
+    parser.add_argument("--use-index", action="store_true",
+                        help="使用本地 delta 索引（需 --mail-folder），热启动只需一次增量请求")
+    parser.add_argument("--index-path", default=None, help="本地索引 SQLite 路径（默认与 token 缓存同目录）")
+    parser.add_argument("--batch", action="store_true",
+                        help="用 JSON $batch 合并附件元数据请求与小附件下载（每批最多 20 个）")
+    parser.add_argument("--prefetch-pages", action="store_true", help="后台预取下一页邮件列表")
+    parser.add_argument("--use-cache", action="store_true", help="启用本地附件内容缓存，重跑不重复下载")
+    parser.add_argument("--search", action="store_true", help="先用 $search 缩小候选邮件，失败回退扫描")
+    parser.add_argument("--unpack-archives", action="store_true",
+                        help="筛选条件同时匹配 zip/gz 附件内的文件，只解压保存命中的成员")
+    parser.add_argument("--cache-dir", default=None, help="附件缓存目录（默认与 token 缓存同目录）")
+    parser.add_argument("--stats-json", default=None,
+                        help="把本次运行统计（请求数/字节数/各阶段耗时等）写入该 JSON 文件，- 表示输出到屏幕")
 
     args = parser.parse_args()
 
+    scopes = args.scopes
+    if scopes is None:
+        scopes = "Mail.Read offline_access"
+        if any(mb.lower() != "me" for mb in args.mailbox or []):
+            scopes += f" {GraphMailAttachmentTool.SHARED_MAILBOX_SCOPE}"
+
     tool = GraphMailAttachmentTool(
         tenant_id=args.tenant_id,
         client_id=args.client_id,
-        scopes="Mail.Read offline_access",
+        scopes=scopes,
         token_cache=args.token_cache,
         request_timeout=args.timeout,
+        max_workers=args.workers,
+        index_path=args.index_path,
+        cache_dir=args.cache_dir,
+        max_rps=args.max_rps,
+        max_concurrency=args.max_concurrency,
     )
 
-    tool.download_latest_attachments(
-        contains=args.contains,
-        equals=args.equals,
-        ext=args.ext,
-        need_count=args.need_count,
+    common = dict(
         days_back=args.days_back,
         page_size=args.page_size,
         max_scan=args.max_scan,
         save_dir=args.save_dir,
         mail_folder=args.mail_folder,
+        mailboxes=args.mailbox,
+        server_filter=args.server_filter,
+        use_index=args.use_index,
+        use_batch=args.batch,
+        prefetch_pages=args.prefetch_pages,
+        use_cache=args.use_cache,
+        search=args.search,
+        unpack_archives=args.unpack_archives,
+        return_stats=True,
     )
+    if args.manifest:
+        manifest = json.loads(Path(args.manifest).read_text("utf-8"))
+        results, stats = tool.download_many(manifest, **common)
+        print(json.dumps({k: [str(p) for p in v] for k, v in results.items()}, ensure_ascii=False, indent=2))
+    else:
+        _, stats = tool.download_latest_attachments(
+            contains=args.contains,
+            equals=args.equals,
+            ext=args.ext,
+            need_count=args.need_count,
+            **common,
+        )
+    if args.stats_json:
+        stats_text = json.dumps(stats.to_dict(), ensure_ascii=False, indent=2)
+        if args.stats_json == "-":
+            print(stats_text)
+        else:
+            Path(args.stats_json).write_text(stats_text, encoding="utf-8")
+            print(f"[SAVE] {args.stats_json}")
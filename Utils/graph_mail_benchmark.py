@@ -0,0 +1,202 @@
+"""
+Graph Mail Benchmark
+---------------------------------
+用本地模拟 Graph（graph_mock_server.py）对 GraphMailAttachmentTool 的各种开关做可重复的基准测量，
+对比请求数、响应字节数、耗时与峰值内存（RSS），用于验证/回归各项优化。
+
+- 每个场景单独起一个模拟服务；每个组合（场景 × 开关）在独立子进程中运行，峰值 RSS 互不影响
+- 不需要登录：子进程使用预置的假 token 缓存
+- 使用本地索引的组合（index）在同一工作目录再跑一次，记为 "<variant>_warm"：首次为冷启动全量同步，
+  第二次只有一次 delta 请求
+
+场景
+-----------------
+- deep2:  800 封邮件，仅 2 封（较旧的）带目标附件，need_count=2
+- kkaq10: 800 封邮件，一次拉取 10 个站点的 KKAQ_* 各最新一份（download_many）
+
+命令行：
+python graph_mail_benchmark.py
+python graph_mail_benchmark.py --scenario deep2 --variant default --variant batch --latency 0.05 --json bench.json
+"""
+
+from __future__ import annotations
+
+import os
+import sys
+import json
+import time
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    from graph_mock_server import MockGraphServer, MockMailbox
+except ImportError:  # 作为 Utils.graph_mail_benchmark 导入时
+    from Utils.graph_mock_server import MockGraphServer, MockMailbox
+
+
+KKAQ_SITES = ["US0X", "MY0X", "SG04", "CN01", "JP02", "KR03", "TW05", "TH06", "IN07", "DE08"]
+
+# 场景：模拟邮箱 + 下载条件
+SCENARIOS: Dict[str, dict] = {
+    "deep2": {
+        "desc": "2 matches in 800 messages",
+        "mailbox": {"messages": 800,
+                    "matches": {610: "ZMRP_WATERFALL_Run_B.xlsx", 700: "ZMRP_WATERFALL_Run_A.xlsx"}},
+        "specs": [{"contains": "ZMRP_WATERFALL", "ext": ".xlsx", "need_count": 2}],
+    },
+    "kkaq10": {
+        "desc": "10 KKAQ specs in one pass",
+        "mailbox": {"messages": 800, "match_size": 512 * 1024,
+                    "matches": {40 + i * 37: f"KKAQ_{site}_Weekly.xlsx" for i, site in enumerate(KKAQ_SITES)}},
+        "specs": [{"contains": f"KKAQ_{site}_", "ext": ".xlsx", "need_count": 1, "key": site}
+                  for site in KKAQ_SITES],
+    },
+}
+
+# 开关组合：对应 download_many 的关键字参数
+VARIANTS: Dict[str, dict] = {
+    "default": {},
+    "server_filter": {"server_filter": True},
+    "batch": {"use_batch": True, "prefetch_pages": True},
+    "index": {"use_index": True, "mail_folder": "inbox"},  # 索引需指定文件夹，否则回退为在线扫描
+    "search": {"search": True},
+    "all": {"server_filter": True, "use_batch": True, "prefetch_pages": True, "search": True},
+}
+
+
+def _peak_rss_mb() -> Optional[float]:
+    """当前进程的峰值 RSS（MB）；无法获取时返回 None。"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 单位为 KB，macOS 为字节
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil  # Windows：peak_wset 即峰值工作集
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+
+# =========================
+# 子进程：实际跑一次下载
+# =========================
+def _run_child(graph_base: str, scenario: str, variant: str, workdir: str, max_rps: float) -> dict:
+    try:
+        from graph_mail_attachment_tool import GraphMailAttachmentTool
+    except ImportError:
+        from Utils.graph_mail_attachment_tool import GraphMailAttachmentTool
+
+    token_cache = os.path.join(workdir, "graph_token_cache.json")
+    with open(token_cache, "w", encoding="utf-8") as f:
+        json.dump({"access_token": "benchmark", "expires_at": time.time() + 24 * 3600}, f)
+
+    tool = GraphMailAttachmentTool(tenant_id="benchmark", client_id="benchmark",
+                                   token_cache=token_cache, graph_base=graph_base, max_rps=max_rps)
+    t0 = time.perf_counter()
+    results, stats = tool.download_many(SCENARIOS[scenario]["specs"], days_back=90,
+                                        save_dir=os.path.join(workdir, "out"), return_stats=True,
+                                        **VARIANTS[variant])
+    wall = time.perf_counter() - t0
+    return {
+        "wall_s": round(wall, 3),
+        "peak_rss_mb": _peak_rss_mb(),
+        "files": sum(len(v) for v in results.values()),
+        "missing": [k for k, v in results.items() if not v],
+        "tool_stats": stats.to_dict(),
+    }
+
+
+# =========================
+# 主进程：起模拟服务，逐个组合测量
+# =========================
+def run_benchmark(scenarios: List[str], variants: List[str], *, latency: float = 0.02,
+                  throttle_rate: float = 0.0, drop_rate: float = 0.0, max_rps: float = 50.0, verbose: bool = False) -> List[dict]:
+    rows = []
+    for name in scenarios:
+        sc = SCENARIOS[name]
+        box = MockMailbox.generate(**sc["mailbox"])
+        with MockGraphServer(box, latency=latency, throttle_rate=throttle_rate, drop_rate=drop_rate) as srv:
+            for variant in variants:
+                # 本地索引：同一工作目录（同一索引文件）再跑一次，测热启动
+                runs = [variant, f"{variant}_warm"] if VARIANTS[variant].get("use_index") else [variant]
+                with tempfile.TemporaryDirectory(prefix="graph_bench_") as workdir:
+                    for label in runs:
+                        srv.reset_stats()
+                        cmd = [sys.executable, os.path.abspath(__file__), "--child",
+                               "--graph-base", srv.graph_base, "--scenario", name, "--variant", variant,
+                               "--workdir", workdir, "--max-rps", str(max_rps)]
+                        proc = subprocess.run(cmd, capture_output=True, text=True,
+                                              cwd=str(Path(__file__).resolve().parent))
+                        if verbose or proc.returncode != 0:
+                            print(proc.stdout)
+                            print(proc.stderr, file=sys.stderr)
+                        if proc.returncode != 0:
+                            print(f"[WARN] {name}/{label} 失败 / failed (exit {proc.returncode})")
+                            break
+                        child = json.loads(proc.stdout.strip().splitlines()[-1])
+                        st = srv.stats()
+                        rows.append({
+                            "scenario": name,
+                            "variant": label,
+                            "requests": st["requests"],
+                            "batch_subrequests": st["batch_subrequests"],
+                            "throttled": st["throttled"],
+                            "dropped": st["dropped"],
+                            "mb_out": round(st["bytes_out"] / (1024 * 1024), 2),
+                            "by_endpoint": st["by_endpoint"],
+                            **child,
+                        })
+    return rows
+
+
+def print_table(rows: List[dict]) -> None:
+    cols = ["scenario", "variant", "requests", "batch_subrequests", "throttled", "dropped", "mb_out",
+            "wall_s", "peak_rss_mb", "files"]
+    widths = {c: max(len(c), *(len(str(r.get(c))) for r in rows)) if rows else len(c) for c in cols}
+    print("  ".join(c.ljust(widths[c]) for c in cols))
+    for r in rows:
+        print("  ".join(str(r.get(c)).ljust(widths[c]) for c in cols))
+        if r.get("missing"):
+            print(f"    [WARN] 未找到 / missing: {', '.join(r['missing'])}")
+
+
+# =========================
+# CLI 入口
+# =========================
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark GraphMailAttachmentTool against a local mock Graph server.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="可重复；默认全部")
+    parser.add_argument("--variant", action="append", choices=list(VARIANTS), help="可重复；默认全部")
+    parser.add_argument("--latency", type=float, default=0.02, help="模拟每个请求的延迟（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="模拟 429 的概率")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="模拟 $value 中途断线的概率")
+    parser.add_argument("--max-rps", type=float, default=50.0, help="传给工具的每秒请求上限")
+    parser.add_argument("--json", default=None, help="把结果写入该 JSON 文件")
+    parser.add_argument("--verbose", action="store_true", help="打印子进程输出")
+    # 内部使用：子进程模式
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--graph-base", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        res = _run_child(args.graph_base, args.scenario[0], args.variant[0], args.workdir, args.max_rps)
+        print(json.dumps(res))
+        sys.exit(0)
+
+    rows = run_benchmark(args.scenario or list(SCENARIOS), args.variant or list(VARIANTS),
+                         latency=args.latency, throttle_rate=args.throttle_rate,
+                         drop_rate=args.drop_rate, max_rps=args.max_rps, verbose=args.verbose)
+    print()
+    print_table(rows)
+    if args.json:
+        Path(args.json).write_text(json.dumps(rows, ensure_ascii=False, indent=2), encoding="utf-8")
+        print(f"[SAVE] {args.json}")
@@ -0,0 +1,536 @@
+"""
+Graph Mock Server
+---------------------------------
+本地模拟 Microsoft Graph 邮件接口，用于离线测量/回归 GraphMailAttachmentTool：
+- /me 与 /users/{upn}（共享邮箱）下的 /messages、/mailFolders/{id}/messages（$top/$filter/$expand/$search、nextLink 分页）
+- /mailFolders/{id}/childFolders（$filter displayName eq '...'）
+- /me/mailFolders/{id}/messages/delta（Prefer: odata.maxpagesize、deltaLink）
+- /me/messages/{id}/attachments（$select 时不返回 contentBytes）与 /$value
+- /$batch（最多 20 个子请求，子请求同样可能被限流）
+- $value 支持 Range（bytes=N-、N-M、-N；206/416），可按比例在传输中途断开连接；附件可指定真实内容（如 zip/gzip）
+- 可配置的单次请求延迟、附件大小与 429 限流比例；统计请求数与响应字节数
+
+示例（库用法）
+-----------------
+from graph_mock_server import MockGraphServer, MockMailbox
+
+box = MockMailbox.generate(messages=800, matches={700: "ZMRP_WATERFALL_Run_A.xlsx"})
+with MockGraphServer(box, latency=0.02) as srv:
+    tool = GraphMailAttachmentTool(tenant_id="t", client_id="c", graph_base=srv.graph_base, ...)
+    ...
+    print(srv.stats())
+
+命令行（前台运行，Ctrl+C 退出）：
+python graph_mock_server.py --messages 800 --match 700:ZMRP_WATERFALL_Run_A.xlsx --port 8765
+"""
+
+from __future__ import annotations
+
+import re
+import json
+import time
+import base64
+import random
+import threading
+import datetime as dt
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlencode, urlparse
+
+
+# =========================
+# 模拟邮箱数据
+# =========================
+@dataclass
+class MockAttachment:
+    id: str
+    name: str
+    size: int
+    is_inline: bool = False
+    data: Optional[bytes] = None  # 指定真实内容（如 zip/gzip）；为空时按名称生成
+
+    def __post_init__(self):
+        if self.data is not None:
+            self.size = len(self.data)
+
+    def content(self) -> bytes:
+        return b"".join(self.iter_content())
+
+    def iter_content(self, start: int = 0, chunk: int = 256 * 1024, stop: Optional[int] = None) -> Iterator[bytes]:
+        """按名称生成确定性内容（不常驻内存），支持从任意偏移开始、到 stop（不含）为止。"""
+        stop = self.size if stop is None else min(stop, self.size)
+        if self.data is not None:
+            for pos in range(start, stop, chunk):
+                yield self.data[pos:min(pos + chunk, stop)]
+            return
+        block = (self.name.encode("utf-8") + b"|") * 64
+        pos = start
+        while pos < stop:
+            n = min(chunk, stop - pos)
+            off = pos % len(block)
+            buf = (block * (n // len(block) + 2))[off:off + n]
+            yield buf
+            pos += n
+
+    def meta(self) -> dict:
+        return {
+            "@odata.type": "#microsoft.graph.fileAttachment",
+            "id": self.id,
+            "name": self.name,
+            "size": self.size,
+            "isInline": self.is_inline,
+        }
+
+
+@dataclass
+class MockMessage:
+    id: str
+    subject: str
+    received: dt.datetime
+    folder: str = "inbox"
+    attachments: List[MockAttachment] = field(default_factory=list)
+    owner: str = "me"  # 所在邮箱："me" 或共享邮箱 UPN（/users/{upn}）
+    version: int = 0  # delta 用：大于 deltatoken 的邮件视为变更
+
+    @property
+    def received_iso(self) -> str:
+        return self.received.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+    def meta(self) -> dict:
+        return {
+            "id": self.id,
+            "subject": self.subject,
+            "receivedDateTime": self.received_iso,
+            "hasAttachments": bool(self.attachments),
+        }
+
+
+class MockMailbox:
+    """按接收时间倒序保存的模拟邮件集合（可含多个文件夹/用户）。"""
+
+    def __init__(self, messages: Optional[List[MockMessage]] = None):
+        self.messages: List[MockMessage] = []
+        self.version = 0
+        self._lock = threading.Lock()
+        for m in messages or []:
+            self.add(m)
+
+    @classmethod
+    def generate(cls, messages: int = 800, *, every_hours: float = 1.0, noise_every: int = 3,
+                 noise_size: int = 200 * 1024, match_size: int = 2 * 1024 * 1024,
+                 matches: Optional[Dict[int, str]] = None, folder: str = "inbox",
+                 owner: str = "me", offset_hours: float = 0.0) -> "MockMailbox":
+        """
+        生成 N 封邮件（第 0 封最新，间隔 every_hours 小时，整体再往前偏移 offset_hours）：
+        每 noise_every 封带一个无关 .xlsx 附件；matches={序号: 附件名} 指定命中附件的位置。
+        folder 为文件夹 id（子文件夹用 "inbox-supply" 这类 id，见 childFolders），owner 为所在邮箱。
+        """
+        now = dt.datetime.now(dt.timezone.utc).replace(microsecond=0) - dt.timedelta(hours=offset_hours)
+        prefix = f"{owner}.{folder}." if (owner, folder) != ("me", "inbox") else ""
+        out = []
+        for i in range(int(messages)):
+            atts = []
+            if noise_every and i % noise_every == 0:
+                atts.append(MockAttachment(id=f"n{i}", name=f"Other_Report_{i}.xlsx", size=noise_size))
+            if matches and i in matches:
+                atts.append(MockAttachment(id=f"a{i}", name=matches[i], size=match_size))
+            out.append(MockMessage(id=f"{prefix}m{i:05d}", subject=f"Message {i}",
+                                   received=now - dt.timedelta(hours=i * every_hours),
+                                   folder=folder, attachments=atts, owner=owner))
+        return cls(out)
+
+    def add(self, msg: MockMessage) -> MockMessage:
+        with self._lock:
+            msg.version = self.version
+            self.messages.append(msg)
+            self.messages.sort(key=lambda m: m.received, reverse=True)
+        return msg
+
+    def deliver(self, msg: MockMessage) -> MockMessage:
+        """模拟新邮件到达（下一次 delta 会返回它）。"""
+        with self._lock:
+            self.version += 1
+        return self.add(msg)
+
+    def merge(self, other: "MockMailbox") -> "MockMailbox":
+        """并入另一组邮件（如其他文件夹/共享邮箱），返回自身。"""
+        for m in other.messages:
+            self.add(m)
+        return self
+
+    def find(self, mid: str, owner: str = "me") -> Optional[MockMessage]:
+        return next((m for m in self.messages if m.id == mid and m.owner == owner), None)
+
+    def folders(self, owner: str = "me") -> List[str]:
+        return sorted({m.folder for m in self.messages if m.owner == owner})
+
+
+# =========================
+# HTTP 服务
+# =========================
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+    protocol_version = "HTTP/1.1"
+    # 头与正文分两次写出，关闭 Nagle 避免 keep-alive 下的 40ms 延迟确认
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args) -> None:
+        pass
+
+    def _reply(self, status: int, headers: Dict[str, str], body) -> None:
+        chunks = [body] if isinstance(body, (bytes, bytearray)) else body
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        sent = 0
+        try:
+            for c in chunks:
+                self.wfile.write(c)
+                sent += len(c)
+        except ConnectionAbortedError:
+            # 模拟断线：正文未写完就关闭连接
+            self.close_connection = True
+        self.server.owner._count_bytes(sent)
+
+    def do_GET(self) -> None:
+        self._dispatch("GET")
+
+    def do_POST(self) -> None:
+        self._dispatch("POST")
+
+    def _dispatch(self, method: str) -> None:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        status, headers, payload = self.server.owner.handle(method, self.path, dict(self.headers), body)
+        self._reply(status, headers, payload)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    owner: "MockGraphServer"
+
+
+class MockGraphServer:
+    """
+    本地 Graph 替身。
+    :param mailbox:       模拟邮箱。
+    :param latency:       每个 HTTP 请求的固定延迟（秒），模拟代理/网络往返。
+    :param throttle_rate: 请求（含 $batch 子请求）返回 429 的概率。
+    :param retry_after:   429 响应的 Retry-After（秒）。
+    :param drop_rate:     $value 响应在传输一半时断开连接的概率（测试断点续传）。
+    """
+
+    API_PREFIX = "/v1.0"
+
+    def __init__(self, mailbox: MockMailbox, *, host: str = "127.0.0.1", port: int = 0,
+                 latency: float = 0.0, throttle_rate: float = 0.0, retry_after: float = 1.0,
+                 drop_rate: float = 0.0, seed: int = 42):
+        self.mailbox = mailbox
+        self.latency = float(latency)
+        self.throttle_rate = float(throttle_rate)
+        self.retry_after = retry_after
+        self.drop_rate = float(drop_rate)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.owner = self
+        self._thread: Optional[threading.Thread] = None
+        self.reset_stats()
+
+    # ---------- lifecycle ----------
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def graph_base(self) -> str:
+        return self.base_url + self.API_PREFIX
+
+    def start(self) -> "MockGraphServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True, name="mock-graph")
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockGraphServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+    # ---------- stats ----------
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats = {"requests": 0, "batch_subrequests": 0, "throttled": 0, "dropped": 0,
+                           "bytes_out": 0, "by_endpoint": {}}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def _count(self, endpoint: str, sub: bool = False) -> None:
+        with self._lock:
+            self._stats["batch_subrequests" if sub else "requests"] += 1
+            self._stats["by_endpoint"][endpoint] = self._stats["by_endpoint"].get(endpoint, 0) + 1
+
+    def _count_bytes(self, n: int) -> None:
+        with self._lock:
+            self._stats["bytes_out"] += n
+
+    def _should_throttle(self) -> bool:
+        with self._lock:
+            hit = self.throttle_rate > 0 and self._rng.random() < self.throttle_rate
+            if hit:
+                self._stats["throttled"] += 1
+            return hit
+
+    def _should_drop(self) -> bool:
+        with self._lock:
+            hit = self.drop_rate > 0 and self._rng.random() < self.drop_rate
+            if hit:
+                self._stats["dropped"] += 1
+            return hit
+
+    # ---------- routing ----------
+    @staticmethod
+    def _json(status: int, obj) -> Tuple[int, Dict[str, str], bytes]:
+        data = json.dumps(obj).encode("utf-8")
+        return status, {"Content-Type": "application/json", "Content-Length": str(len(data))}, data
+
+    def _throttled(self) -> Tuple[int, Dict[str, str], bytes]:
+        status, headers, data = self._json(429, {"error": {"code": "TooManyRequests",
+                                                           "message": "Application is over its MailboxConcurrency limit."}})
+        headers["Retry-After"] = str(self.retry_after)
+        return status, headers, data
+
+    def handle(self, method: str, raw_path: str, headers: Dict[str, str], body: bytes,
+               sub: bool = False) -> Tuple[int, Dict[str, str], object]:
+        u = urlparse(raw_path)
+        path = u.path
+        if path.startswith(self.API_PREFIX):
+            path = path[len(self.API_PREFIX):]
+        q = {k: v[0] for k, v in parse_qs(u.query, keep_blank_values=True).items()}
+        headers = {k.lower(): v for k, v in headers.items()}
+
+        endpoint = self._endpoint_name(method, path)
+        self._count(endpoint, sub=sub)
+        if not sub and self.latency:
+            time.sleep(self.latency)
+        if self._should_throttle():
+            return self._throttled()
+
+        if method == "POST" and path == "/$batch":
+            return self._batch(body)
+        if method != "GET":
+            return self._json(405, {"error": {"code": "MethodNotAllowed"}})
+
+        # 路径前缀 /me 或 /users/{upn}：决定在哪个邮箱里查
+        m = re.match(r"^/(me|users/([^/]+))(/.*)$", path)
+        if not m:
+            return self._json(404, {"error": {"code": "ResourceNotFound", "message": path}})
+        owner = unquote(m.group(2)) if m.group(2) else "me"
+        rest = m.group(3)
+
+        m = re.match(r"^/messages/([^/]+)/attachments/([^/]+)/\$value$", rest)
+        if m:
+            return self._value(owner, m.group(1), m.group(2), headers, allow_drop=not sub)
+        m = re.match(r"^/messages/([^/]+)/attachments$", rest)
+        if m:
+            return self._attachments(owner, m.group(1), q)
+        m = re.match(r"^/mailFolders/([^/]+)/childFolders$", rest)
+        if m:
+            return self._child_folders(owner, m.group(1), q)
+        m = re.match(r"^/mailFolders/([^/]+)/messages/delta$", rest)
+        if m:
+            return self._delta(owner, m.group(1), q, headers, path)
+        m = re.match(r"^(?:/mailFolders/([^/]+))?/messages$", rest)
+        if m:
+            return self._messages(owner, m.group(1), q, path)
+        return self._json(404, {"error": {"code": "ResourceNotFound", "message": path}})
+
+    @staticmethod
+    def _endpoint_name(method: str, path: str) -> str:
+        if path == "/$batch":
+            return "$batch"
+        if path.endswith("/$value"):
+            return "$value"
+        if path.endswith("/attachments"):
+            return "attachments"
+        if path.endswith("/delta"):
+            return "delta"
+        if path.endswith("/childFolders"):
+            return "childFolders"
+        if path.endswith("/messages"):
+            return "messages"
+        return f"{method} other"
+
+    def _next_link(self, path: str, q: dict, skip: int) -> str:
+        q2 = dict(q)
+        q2["$skip"] = str(skip)
+        return f"{self.graph_base}{path}?{urlencode(q2)}"
+
+    def _messages(self, owner: str, folder: Optional[str], q: dict, path: str):
+        msgs = [m for m in self.mailbox.messages if m.owner == owner and (not folder or m.folder == folder)]
+        flt = q.get("$filter") or ""
+        m = re.search(r"receivedDateTime ge (\S+)", flt)
+        if m:
+            msgs = [x for x in msgs if x.received_iso >= m.group(1)]
+        if "hasAttachments eq true" in flt:
+            msgs = [x for x in msgs if x.attachments]
+        search = q.get("$search")
+        if search is not None:
+            kws = [k.lower() for k in re.findall(r"attachment:'?([^' )\"]+)", search)]
+            msgs = [x for x in msgs if any(k in a.name.lower() for k in kws for a in x.attachments)]
+        top = int(q.get("$top") or 10)
+        skip = int(q.get("$skip") or 0)
+        page = msgs[skip:skip + top]
+        expand = "attachments" in (q.get("$expand") or "")
+        value = []
+        for x in page:
+            d = x.meta()
+            if expand:
+                d["attachments"] = [a.meta() for a in x.attachments]
+            value.append(d)
+        res = {"value": value}
+        if skip + top < len(msgs):
+            res["@odata.nextLink"] = self._next_link(path, q, skip + top)
+        return self._json(200, res)
+
+    def _child_folders(self, owner: str, parent: str, q: dict):
+        """子文件夹 id 约定为 "<父 id>-<显示名小写>"，按 $filter displayName eq '...' 查找。"""
+        m = re.search(r"displayName eq '((?:[^']|'')*)'", q.get("$filter") or "")
+        value = []
+        for fid in self.mailbox.folders(owner):
+            if not fid.startswith(parent + "-") or "-" in fid[len(parent) + 1:]:
+                continue
+            name = fid[len(parent) + 1:]
+            if m and m.group(1).replace("''", "'").lower() != name:
+                continue
+            value.append({"id": fid, "displayName": name})
+        return self._json(200, {"value": value})
+
+    def _delta(self, owner: str, folder: str, q: dict, headers: Dict[str, str], path: str):
+        prefer = headers.get("prefer") or ""
+        m = re.search(r"odata\.maxpagesize=(\d+)", prefer)
+        page_size = int(m.group(1)) if m else 10
+        if "$deltatoken" in q:
+            ver = int(q["$deltatoken"])
+            msgs = [x for x in self.mailbox.messages
+                    if x.owner == owner and x.folder == folder and x.version > ver]
+        else:
+            msgs = [x for x in self.mailbox.messages if x.owner == owner and x.folder == folder]
+            m = re.search(r"receivedDateTime ge (\S+)", q.get("$filter") or "")
+            if m:
+                msgs = [x for x in msgs if x.received_iso >= m.group(1)]
+        skip = int(q.get("$skip") or 0)
+        res = {"value": [x.meta() for x in msgs[skip:skip + page_size]]}
+        if skip + page_size < len(msgs):
+            res["@odata.nextLink"] = self._next_link(path, q, skip + page_size)
+        else:
+            res["@odata.deltaLink"] = f"{self.graph_base}{path}?$deltatoken={self.mailbox.version}"
+        return self._json(200, res)
+
+    def _attachments(self, owner: str, mid: str, q: dict):
+        msg = self.mailbox.find(mid, owner)
+        if msg is None:
+            return self._json(404, {"error": {"code": "ErrorItemNotFound"}})
+        value = []
+        for a in msg.attachments:
+            d = a.meta()
+            if not q.get("$select"):
+                d["contentBytes"] = base64.b64encode(a.content()).decode("ascii")
+            value.append(d)
+        return self._json(200, {"value": value})
+
+    def _value(self, owner: str, mid: str, aid: str, headers: Dict[str, str], allow_drop: bool = True):
+        msg = self.mailbox.find(mid, owner)
+        att = next((a for a in msg.attachments if a.id == aid), None) if msg else None
+        if att is None:
+            return self._json(404, {"error": {"code": "ErrorItemNotFound"}})
+        start, status = 0, 200
+        h = {"Content-Type": "application/octet-stream"}
+        stop = att.size
+        # bytes=N-、bytes=N-M 与后缀形式 bytes=-N（最后 N 字节）
+        m = re.match(r"bytes=(\d*)-(\d*)$", headers.get("range") or "")
+        if m and (m.group(1) or m.group(2)):
+            if not m.group(1):
+                start = max(0, att.size - int(m.group(2)))
+            else:
+                start = int(m.group(1))
+                if m.group(2):
+                    stop = min(att.size, int(m.group(2)) + 1)
+            if start >= att.size or start >= stop:
+                h["Content-Range"] = f"bytes */{att.size}"
+                return 416, {**h, "Content-Length": "0"}, b""
+            status = 206
+            h["Content-Range"] = f"bytes {start}-{stop - 1}/{att.size}"
+        h["Content-Length"] = str(stop - start)
+        body = att.iter_content(start, stop=stop)
+        if allow_drop and self._should_drop():
+            body = self._truncated(body, (stop - start) // 2)
+        return status, h, body
+
+    @staticmethod
+    def _truncated(chunks: Iterator[bytes], limit: int) -> Iterator[bytes]:
+        sent = 0
+        for c in chunks:
+            if sent + len(c) > limit:
+                yield c[:limit - sent]
+                raise ConnectionAbortedError("mock drop")
+            sent += len(c)
+            yield c
+
+    def _batch(self, body: bytes):
+        reqs = json.loads(body or b"{}").get("requests", [])
+        if len(reqs) > 20:
+            return self._json(400, {"error": {"code": "BadRequest", "message": "Too many requests in batch"}})
+        responses = []
+        for r in reqs:
+            status, headers, payload = self.handle(r.get("method", "GET"), self.API_PREFIX + r["url"],
+                                                   r.get("headers") or {}, b"", sub=True)
+            data = payload if isinstance(payload, (bytes, bytearray)) else b"".join(payload)
+            if headers.get("Content-Type") == "application/json":
+                out_body = json.loads(data)
+            else:
+                out_body = base64.b64encode(data).decode("ascii")
+            out_headers = {k: v for k, v in headers.items() if k in ("Retry-After", "Content-Type")}
+            responses.append({"id": r.get("id"), "status": status, "headers": out_headers, "body": out_body})
+        return self._json(200, {"responses": responses})
+
+
+# =========================
+# CLI 入口
+# =========================
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a local mock of the Microsoft Graph mail endpoints.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--messages", type=int, default=800)
+    parser.add_argument("--match", action="append", default=[],
+                        help="命中附件，格式 序号:文件名（可重复），如 700:ZMRP_WATERFALL_Run_A.xlsx")
+    parser.add_argument("--match-size", type=int, default=2 * 1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的延迟（秒）")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="返回 429 的概率")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="$value 中途断开的概率")
+    args = parser.parse_args()
+
+    matches = {}
+    for item in args.match:
+        pos, _, name = item.partition(":")
+        matches[int(pos)] = name
+    box = MockMailbox.generate(args.messages, matches=matches, match_size=args.match_size)
+    srv = MockGraphServer(box, port=args.port, latency=args.latency, throttle_rate=args.throttle_rate,
+                         drop_rate=args.drop_rate).start()
+    print(f"[MOCK] Graph base: {srv.graph_base}  （Ctrl+C 退出 / Ctrl+C to quit）")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        srv.stop()
@@ -6,14 +6,34 @@ SqlAgentTool (Final + step_id support via step_name)
 - 支持 start_step：int(通过 sysjobsteps 解析为 step_name) 或 str(直接作为 step_name)。
 - 若指定的 step 不存在/不可解析：立即报错退出，不再继续执行。
 - 默认启用“文件检测模式”（只要传了 archive_dir），检测新文件/mtime 变化即判定成功。
+- 未启用文件检测时轮询 msdb 作业状态（sysjobactivity / sysjobhistory），作业结束即返回真实结果与耗时。
+- start_job 启动后立即返回 JobHandle（后台等待），可 poll() / wait() / result() 或 await。
+- 会话模式：with SqlAgentTool(...) as tool: 期间所有调用共用一个连接（空闲过久先健康检查），
+  非会话模式每次调用用完即关闭连接（pyodbc 默认开启的 ODBC 连接池可复用）。
+- Job/step 目录缓存：一次读取全部 Job 与 step 到内存（带 TTL，并存盘快照），
+  模糊匹配、step_id → step_name、step 存在性检查都在本地完成；查不到时先刷新一次再报错。
+- 按 sysjobhistory 最近成功执行的耗时（p50/p95）安排轮询：前期稀疏、接近预计完成时密集；
+  未指定 timeout 时据此推算超时，并给出预计完成时间（ETA）。
 """
 
 from __future__ import annotations
 import os
+import re
+import sys
+import json
+import math
 import time
-from glob import glob
-from dataclasses import dataclass
-from typing import Any, Dict, Optional, Union
+import select
+import ctypes
+import fnmatch
+import asyncio
+import threading
+import datetime as dt
+from concurrent.futures import Future, wait as wait_futures
+from contextlib import ExitStack, contextmanager, nullcontext
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple, Union
 import pyodbc
 
 try:
@@ -48,15 +68,423 @@ class SqlConn:
         return ";".join(parts) + ";"
 
 
+# sysjobhistory.run_status → 状态名
+RUN_STATUS = {0: "failed", 1: "succeeded", 2: "retry", 3: "cancelled", 4: "in_progress"}
+
+
+# -------------------- Directory Change Notify --------------------
+class _Inotify:
+    """
+    Linux inotify（ctypes 调用 libc），只用于本地文件系统：网络盘（SMB/NFS 等）上其他机器写入的文件
+    不会产生事件，此时返回 None 由调用方按间隔轮询。事件只用来提前唤醒，是否有新文件仍以目录快照为准。
+    """
+    # IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    MASK = 0x002 | 0x004 | 0x008 | 0x080 | 0x100
+    NETWORK_FS = ("nfs", "nfs4", "cifs", "smb3", "smbfs", "9p", "afs", "ceph", "fuse.sshfs", "davfs")
+
+    def __init__(self, fd: int):
+        self.fd = fd
+
+    @classmethod
+    def _is_local(cls, folder: str) -> bool:
+        """按 /proc/self/mounts 找到目录所在挂载点，判断是否为本地文件系统。"""
+        path = os.path.realpath(folder)
+        best, fstype = "", None
+        try:
+            with open("/proc/self/mounts", encoding="utf-8") as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) < 3:
+                        continue
+                    mnt = parts[1].replace("\\040", " ")
+                    if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) > len(best):
+                        best, fstype = mnt, parts[2]
+        except OSError:
+            return False
+        return fstype is not None and fstype not in cls.NETWORK_FS
+
+    @classmethod
+    def open(cls, folders: List[str]) -> Optional["_Inotify"]:
+        """监视 folders 中的本地目录（一个 inotify 实例可监视多个目录）；没有可监视的目录时返回 None。"""
+        if not sys.platform.startswith("linux"):
+            return None
+        local = [f for f in folders if cls._is_local(f)]
+        if not local:
+            return None
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd < 0:
+                return None
+            # 每个目录都要加监视（不能用 any() 短路）；全部失败时才放弃 inotify
+            watches = [libc.inotify_add_watch(fd, os.fsencode(f), cls.MASK) for f in local]
+            if all(wd < 0 for wd in watches):
+                os.close(fd)
+                return None
+        except (OSError, AttributeError):
+            return None
+        return cls(fd)
+
+    def wait(self, timeout: float) -> bool:
+        """最多等待 timeout 秒；有事件时读空事件队列并返回 True。"""
+        ready, _, _ = select.select([self.fd], [], [], max(0.0, timeout))
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+# -------------------- Job/Step Catalog --------------------
+class _JobCatalog:
+    """
+    msdb 中全部 Job 及其 step 的内存目录（可存为 JSON 快照）。
+    名称匹配沿用原 SQL 语义（不区分大小写）：含 % / _ 时按 LIKE 整体匹配，否则按子串匹配，
+    用三元组（trigram）倒排索引先筛候选；匹配不到时按三元组相似度给出建议。
+    """
+
+    def __init__(self, server: str, jobs: Dict[str, Dict[str, Any]], loaded_at: float, fresh: bool = False):
+        self.server = server
+        self.jobs = jobs  # name -> {"job_id": str, "steps": {step_id: step_name}}
+        self.loaded_at = loaded_at
+        self.fresh = fresh  # 本进程刚从数据库读取（查不到即确实不存在，无需再刷新）
+        self._by_lower = {name.lower(): name for name in jobs}
+        self._index: Dict[str, set] = {}
+        for name in jobs:
+            for tri in self._trigrams(name.lower()):
+                self._index.setdefault(tri, set()).add(name)
+
+    @staticmethod
+    def _trigrams(text: str) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    # ----- 读取 / 快照 -----
+    @classmethod
+    def fetch(cls, cur: pyodbc.Cursor, server: str) -> "_JobCatalog":
+        rows = cur.execute(
+            """
+            SELECT j.job_id, j.name, s.step_id, s.step_name
+            FROM msdb.dbo.sysjobs AS j WITH (NOLOCK)
+            LEFT JOIN msdb.dbo.sysjobsteps AS s WITH (NOLOCK) ON s.job_id = j.job_id
+            """
+        ).fetchall()
+        jobs: Dict[str, Dict[str, Any]] = {}
+        for job_id, name, step_id, step_name in rows:
+            job = jobs.setdefault(name, {"job_id": str(job_id), "steps": {}})
+            if step_id is not None:
+                job["steps"][int(step_id)] = step_name
+        return cls(server, jobs, time.time(), fresh=True)
+
+    @classmethod
+    def load(cls, path: Path, server: str) -> Optional["_JobCatalog"]:
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+            if data.get("server") != server:
+                return None
+            jobs = {name: {"job_id": job["job_id"], "steps": {int(k): v for k, v in job["steps"].items()}}
+                    for name, job in data["jobs"].items()}
+            return cls(server, jobs, float(data["loaded_at"]))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    def save(self, path: Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps({"server": self.server, "loaded_at": self.loaded_at, "jobs": self.jobs},
+                                  ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def expired(self, ttl: float) -> bool:
+        return time.time() - self.loaded_at > ttl
+
+    # ----- 查询 -----
+    def match(self, pattern: str) -> List[str]:
+        """与原 LIKE 查询相同的匹配结果（按名称排序）；不含通配符且有完全同名的 Job 时只返回它。"""
+        if any(c in pattern for c in "%_"):
+            rx = re.compile(self._like_regex(pattern), re.IGNORECASE | re.DOTALL)
+            return sorted(name for name in self.jobs if rx.fullmatch(name))
+        q = pattern.lower()
+        if q in self._by_lower:
+            return [self._by_lower[q]]
+        tris = self._trigrams(q)
+        if tris:
+            # 子串包含 ⇒ 子串的每个三元组都出现在名称中：取倒排表交集作为候选
+            candidates = set.intersection(*(self._index.get(t, set()) for t in tris))
+        else:
+            candidates = set(self.jobs)
+        return sorted(name for name in candidates if q in name.lower())
+
+    def similar(self, text: str, limit: int = 3) -> List[str]:
+        """按三元组 Jaccard 相似度返回最接近的 Job 名（用于"未找到"时的提示）。"""
+        tris = self._trigrams(text.lower())
+        if not tris:
+            return []
+        scores: Dict[str, int] = {}
+        for t in tris:
+            for name in self._index.get(t, ()):
+                scores[name] = scores.get(name, 0) + 1
+        ranked = sorted(scores, key=lambda n: scores[n] / len(tris | self._trigrams(n.lower())), reverse=True)
+        return ranked[:limit]
+
+    def job(self, job_name: str) -> Optional[Dict[str, Any]]:
+        name = self._by_lower.get(job_name.lower())
+        return self.jobs[name] if name else None
+
+    def step_name(self, job_name: str, step_id: int) -> Optional[str]:
+        job = self.job(job_name)
+        return job["steps"].get(int(step_id)) if job else None
+
+    def step_id(self, job_name: str, step_name: str) -> Optional[int]:
+        job = self.job(job_name)
+        for sid, name in (job["steps"].items() if job else ()):
+            if name.lower() == step_name.lower():
+                return sid
+        return None
+
+    def has_step(self, job_name: str, step_name: str) -> bool:
+        job = self.job(job_name)
+        return bool(job) and step_name.lower() in (n.lower() for n in job["steps"].values())
+
+    @staticmethod
+    def _like_regex(pattern: str) -> str:
+        """T-SQL LIKE → 正则：% 任意串，_ 单字符，[...] / [^...] 字符集。"""
+        out, i = [], 0
+        while i < len(pattern):
+            c = pattern[i]
+            if c == "%":
+                out.append(".*")
+            elif c == "_":
+                out.append(".")
+            elif c == "[" and "]" in pattern[i + 1:]:
+                j = pattern.index("]", i + 1)
+                body = pattern[i + 1:j]
+                neg = body.startswith("^")
+                body = body[1:] if neg else body
+                out.append("[" + ("^" if neg else "") + body.replace("\\", "\\\\") + "]")
+                i = j
+            else:
+                out.append(re.escape(c))
+            i += 1
+        return "".join(out)
+
+
+# -------------------- Running Job --------------------
+@dataclass
+class _JobRun:
+    """已启动、等待结束的一个 Job；mode 决定结束判定方式（file_watch / job_status / timeout-fallback）。"""
+    key: str
+    job: str
+    mode: str
+    timeout: float
+    poll_interval: float
+    archive_dir: Optional[str] = None
+    pattern: str = "*.xlsx"
+    requires_new_file: bool = False
+    file_baseline: Optional[Dict[str, Any]] = None
+    job_baseline: Optional[Dict[str, Any]] = None
+    started: float = field(default_factory=time.time)
+    missing_outcome: int = 0
+    expected: Optional[Dict[str, Any]] = None  # 历史耗时 {"p50_s", "p95_s", "runs"}；历史不足时为 None
+    interval: float = 0.0  # 退避中的检查间隔
+    next_check: float = 0.0  # 下次检查时间；0 表示尚未安排
+
+    @property
+    def deadline(self) -> float:
+        return self.started + self.timeout
+
+    @property
+    def eta(self) -> Optional[float]:
+        """按历史 p50 预计的完成时间（时间戳）。"""
+        return self.started + self.expected["p50_s"] if self.expected else None
+
+
+class JobHandle:
+    """
+    start_job 返回的句柄：Job 已启动，结束判定在后台线程中进行（使用独立连接）。
+    - poll()：不阻塞；已结束返回结果 dict（同 run_job），未结束返回 None；
+    - wait(timeout=None)：最多等待 timeout 秒，返回是否已结束；
+    - result(timeout=None)：等待并返回结果；Job 超时/出错时抛出对应异常（TimeoutError 等）；
+    - eta：按历史耗时预计的完成时间（datetime；历史不足时为 None）；
+    - await handle：在 asyncio 中等待结果。
+    """
+
+    def __init__(self, run: _JobRun, future: Future):
+        self.key = run.key
+        self.job = run.job
+        self.mode = run.mode
+        self._run = run
+        self._future = future
+
+    @property
+    def done(self) -> bool:
+        return self._future.done()
+
+    def poll(self) -> Optional[Dict[str, Any]]:
+        if not self._future.done():
+            return None
+        return self._future.result()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        wait_futures([self._future], timeout=timeout)
+        return self._future.done()
+
+    def result(self, timeout: Optional[float] = None) -> Dict[str, Any]:
+        return self._future.result(timeout=timeout)
+
+    def __await__(self):
+        return asyncio.wrap_future(self._future).__await__()
+
+    @property
+    def eta(self) -> Optional[dt.datetime]:
+        """按历史 p50 预计的完成时间；历史不足时为 None。"""
+        return dt.datetime.fromtimestamp(self._run.eta) if self._run.eta else None
+
+    def __repr__(self) -> str:
+        state = "done" if self.done else f"running {time.time() - self._run.started:.0f}s"
+        return f"<JobHandle {self.job!r} mode={self._run.mode} {state}>"
+
+
 # -------------------- Main Tool --------------------
 class SqlAgentTool:
-    def __init__(self, *, server: str, database: str = "msdb"):
+    # 文件检测的自适应轮询：首个间隔（秒）与每次的放大倍数
+    FILE_WATCH_MIN_INTERVAL = 1.0
+    FILE_WATCH_BACKOFF = 1.5
+
+    # 会话连接空闲超过该秒数后，复用前先 SELECT 1 检查
+    HEALTH_CHECK_IDLE = 30.0
+    # Job/step 目录缓存的有效期（秒）
+    CATALOG_TTL = 6 * 3600
+    # 历史耗时：每个 Job/step 取最近多少次成功执行、至少几次才采用、内存缓存有效期（秒）
+    HISTORY_RUNS = 20
+    HISTORY_MIN_RUNS = 3
+    HISTORY_TTL = 3600.0
+    # 按历史安排轮询时，距预计完成尚远阶段的最长检查间隔（秒）
+    HISTORY_SPARSE_MAX = 120.0
+    # 未指定 timeout 时：有历史取 max(p95 × 2, p95 + 300)，否则用该值
+    DEFAULT_TIMEOUT = 1800
+
+    def __init__(self, *, server: str, database: str = "msdb",
+                 catalog_ttl: Optional[float] = CATALOG_TTL, catalog_path: Optional[str] = None):
+        """
+        :param catalog_ttl:  Job/step 目录缓存有效期（秒）；None 或 0 关闭缓存，每次都查 msdb。
+        :param catalog_path: 目录快照文件，默认 ~/.sql_agent_tool/catalog_<server>.json。
+        """
         self.cfg = SqlConn(server=server, database=database)
+        self.catalog_ttl = catalog_ttl
+        if catalog_path is None:
+            safe = re.sub(r"[^A-Za-z0-9]+", "_", server).strip("_")
+            catalog_path = os.path.join(os.path.expanduser("~"), ".sql_agent_tool", f"catalog_{safe}.json")
+        self.catalog_path = Path(catalog_path)
+        self._catalog_cache: Optional[_JobCatalog] = None
+        self._catalog_unavailable = False  # 无权限读取 sysjobs/sysjobsteps 时不再尝试
+        self._history: Dict[Tuple[str, int], Tuple[float, Optional[Dict[str, Any]]]] = {}
+        # 会话模式（with SqlAgentTool(...) as tool）：共用连接、加锁串行使用
+        self._session: Optional[pyodbc.Connection] = None
+        self._session_lock = threading.RLock()
+        self._session_used = 0.0
+        self._session_closing = False
+        self._session_users = 0  # 仍在使用会话连接的后台等待（start_job）
 
     # ----------- Internal Utilities -----------
     def _connect(self) -> pyodbc.Connection:
         return pyodbc.connect(self.cfg.conn_str(), autocommit=self.cfg.autocommit)
 
+    # ----------- Session -----------
+    def __enter__(self) -> "SqlAgentTool":
+        self.open_session()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close_session()
+
+    def open_session(self) -> None:
+        """进入会话模式：之后的解析/启动/状态轮询都复用同一个连接，直到 close_session()。"""
+        with self._session_lock:
+            if self._session is None:
+                self._session = self._connect()
+                self._session_used = time.time()
+            self._session_closing = False
+
+    def close_session(self) -> None:
+        """退出会话模式；仍有 start_job 的后台等待在使用时，由最后一个等待结束后关闭连接。"""
+        with self._session_lock:
+            self._session_closing = True
+            if self._session_users == 0:
+                self._drop_session()
+
+    def _drop_session(self) -> None:
+        if self._session is not None:
+            try:
+                self._session.close()
+            except pyodbc.Error:
+                pass
+        self._session = None
+
+    def _session_alive(self) -> bool:
+        if getattr(self._session, "closed", False):
+            return False
+        try:
+            self._session.cursor().execute("SELECT 1").fetchone()
+            return True
+        except pyodbc.Error:
+            return False
+
+    @contextmanager
+    def _session_cursor(self) -> Iterator[pyodbc.Cursor]:
+        """加锁取会话连接上的游标；空闲过久或上次出错时先做健康检查，失效则重连。"""
+        with self._session_lock:
+            if self._session is None:
+                raise RuntimeError("SqlAgentTool 会话已关闭 / Session is closed")
+            if time.time() - self._session_used > self.HEALTH_CHECK_IDLE and not self._session_alive():
+                print("ℹ️ 会话连接已失效，重新连接 / Session connection is stale; reconnecting")
+                self._drop_session()
+                self._session = self._connect()
+            cur = self._session.cursor()
+            try:
+                yield cur
+                self._session_used = time.time()
+            except pyodbc.Error:
+                self._session_used = 0.0  # 下次使用前强制健康检查
+                raise
+            finally:
+                try:
+                    cur.close()
+                except pyodbc.Error:
+                    pass
+
+    @contextmanager
+    def _cursors(self) -> Iterator[Callable[[], ContextManager[pyodbc.Cursor]]]:
+        """
+        一次操作期间取游标的方式（返回"取游标"的函数，每次使用时 with cursor() as cur）：
+        - 会话模式：每次加锁使用会话连接，多个后台等待可交替使用；
+        - 否则本次操作新建一个连接，结束后关闭。
+        """
+        with self._session_lock:
+            in_session = self._session is not None and not self._session_closing
+            if in_session:
+                self._session_users += 1
+        if in_session:
+            try:
+                yield self._session_cursor
+            finally:
+                with self._session_lock:
+                    self._session_users -= 1
+                    if self._session_closing and self._session_users == 0:
+                        self._drop_session()
+            return
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            yield lambda: nullcontext(cur)
+        finally:
+            conn.close()
+
     @staticmethod
     def _beep_ok():
         if winsound:
@@ -85,10 +513,66 @@ class SqlAgentTool:
         except Exception:
             pass
 
+    # ----------- Job/Step Catalog -----------
+    def _catalog(self, cur: pyodbc.Cursor, refresh: bool = False) -> Optional[_JobCatalog]:
+        """
+        取 Job/step 目录：内存 → 磁盘快照 → msdb（过期或 refresh 时重新读取并存盘）。
+        缓存关闭或无权限读取时返回 None（调用方改用逐条 SQL 查询）。
+        """
+        if not self.catalog_ttl or self._catalog_unavailable:
+            return None
+        catalog = self._catalog_cache
+        if catalog is None and not refresh:
+            catalog = _JobCatalog.load(self.catalog_path, self.cfg.server)
+        if catalog is None or refresh or catalog.expired(self.catalog_ttl):
+            try:
+                catalog = _JobCatalog.fetch(cur, self.cfg.server)
+            except pyodbc.Error as e:
+                print(f"ℹ️ 无法读取 Job 目录，改为逐条查询 / Cannot read job catalog, using per-call queries: {e}")
+                self._catalog_unavailable = True
+                return None
+            try:
+                catalog.save(self.catalog_path)
+            except OSError as e:
+                print(f"⚠️ Job 目录快照写入失败 / Failed to save job catalog snapshot: {e}")
+        self._catalog_cache = catalog
+        return catalog
+
+    def _from_catalog(self, cur: pyodbc.Cursor, lookup: Callable[[_JobCatalog], Any]) -> Tuple[bool, Any]:
+        """
+        在目录缓存中查询；结果为空且缓存不是本进程刚读取的，刷新一次再查（新建/改名的 Job 与 step）。
+        返回 (是否由目录回答, 结果)；目录不可用时返回 (False, None)。
+        """
+        catalog = self._catalog(cur)
+        if catalog is None:
+            return False, None
+        found = lookup(catalog)
+        if not found and not catalog.fresh:
+            catalog = self._catalog(cur, refresh=True)
+            if catalog is None:
+                return False, None
+            found = lookup(catalog)
+        return True, found
+
     # ----------- Job/Step Resolve -----------
     def _resolve_job_name(self, cur: pyodbc.Cursor, job_name: str, fuzzy: bool) -> str:
         if not fuzzy:
             return job_name
+        answered, names = self._from_catalog(cur, lambda c: c.match(job_name))
+        if answered:
+            if not names:
+                hints = ", ".join(self._catalog_cache.similar(job_name)) if self._catalog_cache else ""
+                raise ValueError(
+                    f"未找到匹配 Job: {job_name}{f'（相近：{hints}）' if hints else ''} / "
+                    f"No matching job found: {job_name}{f' (did you mean: {hints})' if hints else ''}"
+                )
+            if len(names) > 1:
+                names = ", ".join(names)
+                raise ValueError(
+                    f"匹配到多个 Job（请改更精确或 fuzzy=False）: {names} / "
+                    f"Multiple jobs matched (use a more specific name or fuzzy=False): {names}"
+                )
+            return names[0]
         like = job_name if any(c in job_name for c in "%_") else f"%{job_name}%"
         try:
             rows = cur.execute(
@@ -112,6 +596,9 @@ class SqlAgentTool:
         将 step_id 解析为 step_name（按 job_name 精确匹配）。
         无权限或未找到时返回 None。
         """
+        answered, name = self._from_catalog(cur, lambda c: c.step_name(job_name, step_id))
+        if answered:
+            return name
         try:
             row = cur.execute(
                 """
@@ -127,6 +614,9 @@ class SqlAgentTool:
             return None
 
     def _step_exists_by_name(self, cur: pyodbc.Cursor, job_name: str, step_name: str) -> bool:
+        answered, exists = self._from_catalog(cur, lambda c: c.has_step(job_name, step_name))
+        if answered:
+            return exists
         try:
             row = cur.execute(
                 """
@@ -144,71 +634,177 @@ class SqlAgentTool:
     # ----------- File Watch Logic -----------
     @staticmethod
     def _latest_file_state(folder: str, pattern: str) -> Dict[str, Any]:
-        files = glob(os.path.join(folder, pattern))
+        """
+        目录快照：一次 os.scandir 枚举，名称按 pattern 匹配（与 glob 相同，默认跳过 . 开头的文件），
+        mtime/size 取自 DirEntry.stat()（Windows/SMB 上随目录枚举返回，不再逐个文件 stat）。
+        """
+        files: Dict[str, Tuple[float, int]] = {}
+        skip_hidden = not pattern.startswith(".")
+        with os.scandir(folder) as it:
+            for entry in it:
+                if skip_hidden and entry.name.startswith("."):
+                    continue
+                if not fnmatch.fnmatch(entry.name, pattern):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    st = entry.stat()
+                except OSError:
+                    continue  # 枚举与读取之间被删除/改名
+                files[entry.name] = (st.st_mtime, st.st_size)
         if not files:
-            return {"count": 0, "latest_mtime": 0.0, "latest_file": None}
-        latest_file = max(files, key=os.path.getmtime)
+            return {"count": 0, "latest_mtime": 0.0, "latest_file": None, "files": files}
+        latest = max(files, key=lambda n: files[n][0])
         return {
             "count": len(files),
-            "latest_mtime": os.path.getmtime(latest_file),
-            "latest_file": latest_file,
+            "latest_mtime": files[latest][0],
+            "latest_file": os.path.join(folder, latest),
+            "files": files,
         }
 
-    def _poll_until_file_appears(
-        self,
-        archive_dir: str,
-        pattern: str,
-        timeout: int,
-        poll_interval: int,
-        requires_new_file: bool,
-        baseline_state: Optional[Dict[str, Any]] = None,
-    ) -> Dict[str, Any]:
-        if not os.path.isdir(archive_dir):
-            raise FileNotFoundError(f"Archive 目录不存在：{archive_dir} / Archive directory not found: {archive_dir}")
+    @staticmethod
+    def _diff_file_state(base: Dict[str, Any], cur: Dict[str, Any], requires_new_file: bool) -> list:
+        """与基线快照比较：新出现的文件；requires_new_file=False 时也包括 mtime 变化的已有文件。"""
+        before = base.get("files") or {}
+        changed = []
+        for name, (mtime, _) in cur["files"].items():
+            old = before.get(name)
+            if old is None or (not requires_new_file and mtime > old[0]):
+                changed.append(name)
+        return sorted(changed, key=lambda n: cur["files"][n][0], reverse=True)
 
-        if baseline_state is None:
-            baseline_state = self._latest_file_state(archive_dir, pattern)
+    # ----------- Job Status Logic -----------
+    @staticmethod
+    def _job_status_baseline(cur: pyodbc.Cursor, job_name: str) -> Optional[Dict[str, Any]]:
+        """
+        启动前记录 job_id 与数据库服务器当前时间（用服务器时间避免客户端时钟偏差），
+        用于之后在 sysjobactivity 中认出本次启动的那一行。无权限读取 msdb 时返回 None。
+        """
+        try:
+            row = cur.execute(
+                "SELECT job_id, GETDATE() AS now FROM msdb.dbo.sysjobs WITH (NOLOCK) WHERE name = ?",
+                job_name,
+            ).fetchone()
+        except pyodbc.Error:
+            return None
+        if not row:
+            return None
+        return {"job_id": row.job_id, "requested_after": row.now}
 
-        base_cnt = baseline_state["count"]
-        base_mtm = baseline_state["latest_mtime"]
-        base_name = baseline_state["latest_file"]
+    @staticmethod
+    def _read_job_activity(cur: pyodbc.Cursor, baseline: Dict[str, Any]):
+        """当前 Agent 会话中本次请求的执行记录（连同作业结果行）；尚未出现时返回 None。"""
+        return cur.execute(
+            """
+            SELECT TOP (1) a.start_execution_date, a.stop_execution_date, a.last_executed_step_id,
+                   h.run_status, h.run_duration, h.message
+            FROM msdb.dbo.sysjobactivity AS a WITH (NOLOCK)
+            LEFT JOIN msdb.dbo.sysjobhistory AS h WITH (NOLOCK) ON h.instance_id = a.job_history_id
+            WHERE a.job_id = ?
+              AND a.session_id = (SELECT MAX(session_id) FROM msdb.dbo.syssessions WITH (NOLOCK))
+              AND a.run_requested_date >= ?
+            ORDER BY a.run_requested_date DESC
+            """,
+            baseline["job_id"], baseline["requested_after"],
+        ).fetchone()
 
-        print(f"⏳ 监控目录：{archive_dir} | 模式：{pattern} / Monitoring folder: {archive_dir} | Pattern: {pattern}")
-        t0 = time.time()
-        while True:
-            cur = self._latest_file_state(archive_dir, pattern)
-            if requires_new_file:
-                if (cur["count"] > base_cnt) or (cur["latest_file"] and cur["latest_file"] != base_name):
-                    return {"ok": True, "detected": cur}
-            else:
-                if cur["latest_mtime"] > base_mtm:
-                    return {"ok": True, "detected": cur}
+    @staticmethod
+    def _run_duration_seconds(run_duration: Optional[int]) -> Optional[int]:
+        """sysjobhistory.run_duration 为 HHMMSS 形式的整数。"""
+        if run_duration is None:
+            return None
+        hh, rest = divmod(int(run_duration), 10000)
+        mm, ss = divmod(rest, 100)
+        return hh * 3600 + mm * 60 + ss
 
-            if time.time() - t0 > timeout:
-                raise TimeoutError(f"等待归档新文件超时（{timeout}s） / Timeout waiting for new archive file ({timeout}s)")
-            time.sleep(poll_interval)
+    # ----------- Run History -----------
+    @staticmethod
+    def _percentile(values: List[int], pct: float) -> float:
+        """最近秩法百分位数。"""
+        ordered = sorted(values)
+        return float(ordered[max(0, math.ceil(pct / 100 * len(ordered)) - 1)])
 
-    # ----------- Main Run Job API -----------
-    def run_job(
+    def _history_stats(self, cur: pyodbc.Cursor, job_name: str, start_step_id: int = 1) -> Optional[Dict[str, Any]]:
+        """
+        由 sysjobhistory 最近的成功执行估计本次耗时 {"p50_s", "p95_s", "runs"}：
+        从 Step 1 启动用作业结果行（step_id=0）；从中间 step 启动用该 step 及之后各 step 的 p50/p95 之和。
+        样本不足或无权限读取时返回 None。
+        """
+        key = (job_name.lower(), start_step_id)
+        cached = self._history.get(key)
+        if cached and time.time() - cached[0] < self.HISTORY_TTL:
+            return cached[1]
+        try:
+            rows = cur.execute(
+                """
+                SELECT TOP (500) h.step_id, h.run_duration
+                FROM msdb.dbo.sysjobhistory AS h WITH (NOLOCK)
+                JOIN msdb.dbo.sysjobs AS j WITH (NOLOCK) ON j.job_id = h.job_id
+                WHERE j.name = ? AND h.run_status = 1
+                ORDER BY h.instance_id DESC
+                """,
+                job_name,
+            ).fetchall()
+        except pyodbc.Error:
+            return None
+        by_step: Dict[int, List[int]] = {}
+        for step_id, run_duration in rows:
+            durations = by_step.setdefault(int(step_id), [])
+            if len(durations) < self.HISTORY_RUNS:
+                durations.append(self._run_duration_seconds(run_duration))
+
+        steps = [0] if start_step_id <= 1 else sorted(sid for sid in by_step if sid >= start_step_id)
+        stats = None
+        if steps and all(len(by_step.get(sid, [])) >= self.HISTORY_MIN_RUNS for sid in steps):
+            stats = {
+                "p50_s": sum(self._percentile(by_step[sid], 50) for sid in steps),
+                "p95_s": sum(self._percentile(by_step[sid], 95) for sid in steps),
+                "runs": min(len(by_step[sid]) for sid in steps),
+            }
+        self._history[key] = (time.time(), stats)
+        return stats
+
+    def _next_interval(self, run: _JobRun) -> float:
+        """
+        距下次检查的秒数。
+        - 无历史：从 FILE_WATCH_MIN_INTERVAL 起按 FILE_WATCH_BACKOFF 递增，最长 poll_interval × 4；
+        - 有历史：0.8 × p50 之前每次等剩余时间的一半（最长 HISTORY_SPARSE_MAX），
+          0.8 × p50 ~ 1.2 × p95 之间按密集间隔（p50 的 2%，不超过 poll_interval）检查，之后再退避。
+        """
+        min_interval = min(self.FILE_WATCH_MIN_INTERVAL, run.poll_interval)
+        if run.expected:
+            p50, p95 = run.expected["p50_s"], run.expected["p95_s"]
+            dense = max(min_interval, min(run.poll_interval, p50 * 0.02))
+            elapsed = time.time() - run.started
+            if elapsed < 0.8 * p50:
+                return min(max(dense, (0.8 * p50 - elapsed) / 2), self.HISTORY_SPARSE_MAX)
+            if elapsed <= 1.2 * p95:
+                run.interval = dense
+                return dense
+        if run.interval <= 0:
+            run.interval = min_interval
+        else:
+            run.interval = min(run.interval * self.FILE_WATCH_BACKOFF, max(run.poll_interval * 4, min_interval))
+        return run.interval
+
+    # ----------- Start / Watch -----------
+    def _begin_job(
         self,
+        cur: pyodbc.Cursor,
         job_name: str,
+        *,
+        key: Optional[str] = None,
         archive_dir: Optional[str] = None,
-        timeout: int = 1800,
+        timeout: Optional[int] = None,
         poll_interval: int = 5,
         fuzzy: bool = False,
         start_step: Optional[Union[int, str]] = None,
-        # ⬇️ 可选的文件检测参数（有默认）
         use_file_watch: Optional[bool] = None,
         archive_pattern: Optional[str] = None,
         file_watch_requires_new_file: Optional[bool] = None,
-    ) -> Dict[str, Any]:
-        """
-        启动并等待 SQL Agent Job 完成。
-        - 若提供 archive_dir，将自动启用“文件检测模式”作为成功判定；
-        - start_step:
-            * int  -> 按 step_id 解析为 step_name 并从该步启动；解析失败则报错退出；
-            * str  -> 视为 step_name，先校验存在性；不存在则报错退出；
-        """
+    ) -> _JobRun:
+        """解析 Job 名与 start_step、记录结束判定的基线，然后 sp_start_job；不等待结束。"""
 
         # ------- 默认逻辑（文件检测）-------
         if use_file_watch is None:
@@ -219,75 +815,390 @@ class SqlAgentTool:
             file_watch_requires_new_file = False
         # -----------------------------------
 
-        with self._connect() as conn:
-            cur = conn.cursor()
+        # 解析 Job 名
+        target_name = self._resolve_job_name(cur, job_name, fuzzy)
 
-            # 解析 Job 名
-            target_name = self._resolve_job_name(cur, job_name, fuzzy)
-
-            # 解析/校验 start_step
-            step_name_to_start: Optional[str] = None
-            if isinstance(start_step, int):
-                # 无论 1 或更大，均尝试解析为 step_name；失败直接退出
-                step_name_to_start = self._resolve_step_name_from_id(cur, target_name, start_step)
-                if not step_name_to_start:
-                    self._beep_fail()
-                    raise ValueError(
-                        f"指定的 step_id={start_step} 在 Job '{target_name}' 中不存在或不可访问。已停止执行。 / "
-                        f"step_id={start_step} not found or inaccessible in job '{target_name}'. Stopping."
-                    )
-                print(
-                    f"▶ 启动 SQL Job: {target_name}（按 step_id={start_step} → step_name='{step_name_to_start}'） / "
-                    f"Starting SQL Job: {target_name} (step_id={start_step} -> step_name='{step_name_to_start}')"
+        # 解析/校验 start_step
+        step_name_to_start: Optional[str] = None
+        if isinstance(start_step, int):
+            # 无论 1 或更大，均尝试解析为 step_name；失败直接退出
+            step_name_to_start = self._resolve_step_name_from_id(cur, target_name, start_step)
+            if not step_name_to_start:
+                self._beep_fail()
+                raise ValueError(
+                    f"指定的 step_id={start_step} 在 Job '{target_name}' 中不存在或不可访问。已停止执行。 / "
+                    f"step_id={start_step} not found or inaccessible in job '{target_name}'. Stopping."
                 )
+            print(
+                f"▶ 启动 SQL Job: {target_name}（按 step_id={start_step} → step_name='{step_name_to_start}'） / "
+                f"Starting SQL Job: {target_name} (step_id={start_step} -> step_name='{step_name_to_start}')"
+            )
 
-            elif isinstance(start_step, str) and start_step.strip():
-                step_name_to_start = start_step.strip()
-                if not self._step_exists_by_name(cur, target_name, step_name_to_start):
-                    self._beep_fail()
-                    raise ValueError(
-                        f"指定的 step_name='{step_name_to_start}' 在 Job '{target_name}' 中不存在。已停止执行。 / "
-                        f"step_name='{step_name_to_start}' not found in job '{target_name}'. Stopping."
-                    )
-                print(
-                    f"▶ 启动 SQL Job: {target_name}（按 step_name='{step_name_to_start}'） / "
-                    f"Starting SQL Job: {target_name} (step_name='{step_name_to_start}')"
+        elif isinstance(start_step, str) and start_step.strip():
+            step_name_to_start = start_step.strip()
+            if not self._step_exists_by_name(cur, target_name, step_name_to_start):
+                self._beep_fail()
+                raise ValueError(
+                    f"指定的 step_name='{step_name_to_start}' 在 Job '{target_name}' 中不存在。已停止执行。 / "
+                    f"step_name='{step_name_to_start}' not found in job '{target_name}'. Stopping."
                 )
+            print(
+                f"▶ 启动 SQL Job: {target_name}（按 step_name='{step_name_to_start}'） / "
+                f"Starting SQL Job: {target_name} (step_name='{step_name_to_start}')"
+            )
 
-            else:
-                print(f"▶ 启动 SQL Job: {target_name}（从 Step 1 开始） / Starting SQL Job: {target_name} (from Step 1)")
+        else:
+            print(f"▶ 启动 SQL Job: {target_name}（从 Step 1 开始） / Starting SQL Job: {target_name} (from Step 1)")
 
-            # 文件检测基线（若启用）
-            baseline_state = None
-            if use_file_watch and archive_dir:
-                baseline_state = self._latest_file_state(archive_dir, archive_pattern)
+        # 历史耗时 → 轮询安排、ETA，以及未指定时的超时
+        start_step_id: Optional[int] = start_step if isinstance(start_step, int) else 1
+        if isinstance(start_step, str) and step_name_to_start:
+            _, start_step_id = self._from_catalog(cur, lambda c: c.step_id(target_name, step_name_to_start))
+        expected = self._history_stats(cur, target_name, start_step_id) if start_step_id else None
+        if timeout is None:
+            timeout = int(max(expected["p95_s"] * 2, expected["p95_s"] + 300)) if expected else self.DEFAULT_TIMEOUT
 
-            # 启动 Job —— 注意：sp_start_job 只支持 @step_name，不支持 @step_id
-            if step_name_to_start:
-                cur.execute("EXEC msdb.dbo.sp_start_job @job_name = ?, @step_name = ?", target_name, step_name_to_start)
-            else:
-                cur.execute("EXEC msdb.dbo.sp_start_job @job_name = ?", target_name)
+        file_watch = bool(use_file_watch and archive_dir)
+        run = _JobRun(key=key or job_name, job=target_name, mode="file_watch" if file_watch else "job_status",
+                      timeout=timeout, poll_interval=poll_interval, archive_dir=archive_dir,
+                      pattern=archive_pattern, requires_new_file=file_watch_requires_new_file, expected=expected)
+        if file_watch:
+            # 文件检测基线（目录不存在时不启动 Job）
+            if not os.path.isdir(archive_dir):
+                raise FileNotFoundError(f"Archive 目录不存在：{archive_dir} / Archive directory not found: {archive_dir}")
+            run.file_baseline = self._latest_file_state(archive_dir, archive_pattern)
+        else:
+            # 作业状态基线（未启用文件检测时用 msdb 判定结束；无权限时只能等待超时）
+            run.job_baseline = self._job_status_baseline(cur, target_name)
+            if run.job_baseline is None:
+                run.mode = "timeout-fallback"
+
+        # 启动 Job —— 注意：sp_start_job 只支持 @step_name，不支持 @step_id
+        if step_name_to_start:
+            cur.execute("EXEC msdb.dbo.sp_start_job @job_name = ?, @step_name = ?", target_name, step_name_to_start)
+        else:
+            cur.execute("EXEC msdb.dbo.sp_start_job @job_name = ?", target_name)
+        run.started = time.time()
+
+        if expected:
+            eta = dt.datetime.fromtimestamp(run.eta).strftime("%H:%M:%S")
+            print(f"📈 历史耗时 p50≈{expected['p50_s']:.0f}s / p95≈{expected['p95_s']:.0f}s（近 {expected['runs']} 次），"
+                  f"预计 {eta} 完成，超时 {timeout}s / History p50≈{expected['p50_s']:.0f}s, "
+                  f"p95≈{expected['p95_s']:.0f}s ({expected['runs']} runs), ETA {eta}, timeout {timeout}s")
+        if run.mode == "file_watch":
+            print(f"⏳ 等待归档目录出现新文件（文件监控判定成功）：{archive_dir} | 模式：{archive_pattern} / "
+                  f"Waiting for new files in archive folder: {archive_dir} | Pattern: {archive_pattern}")
+        elif run.mode == "job_status":
+            print("⏳ 未启用文件检测模式，轮询 msdb 作业状态… / File watch disabled; polling job status in msdb...")
+        else:
+            print("ℹ️ 无法读取 msdb 作业状态，将等待超时后返回… / Job status unavailable; waiting for timeout...")
+        return run
+
+    def _check_run(self, cur: pyodbc.Cursor, run: _JobRun,
+                   snapshots: Dict[Tuple[str, str], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        检查一次 run 是否结束：结束返回结果 dict，超时抛 TimeoutError，否则返回 None。
+        snapshots 为本轮已扫描的目录快照（多个 Job 监控同一目录时每轮只扫描一次）。
+        """
+        if run.mode == "file_watch":
+            snap_key = (run.archive_dir, run.pattern)
+            if snap_key not in snapshots:
+                snapshots[snap_key] = self._latest_file_state(*snap_key)
+            cur_state = snapshots[snap_key]
+            changed = self._diff_file_state(run.file_baseline, cur_state, run.requires_new_file)
+            if changed:
+                detected = {k: v for k, v in cur_state.items() if k != "files"}
+                detected["changed"] = [os.path.join(run.archive_dir, n) for n in changed]
+                return {"ok": True, "job": run.job, "mode": "file_watch", "detected": detected}
+            if time.time() >= run.deadline:
+                raise TimeoutError(f"等待归档新文件超时（{run.timeout}s） / "
+                                   f"Timeout waiting for new archive file ({run.timeout}s)")
+            return None
+
+        if run.mode == "job_status":
+            try:
+                row = self._read_job_activity(cur, run.job_baseline)
+            except pyodbc.Error as e:
+                print(f"⚠️ 无法读取作业状态，改为等待超时 / Cannot read job status, waiting for timeout: {e}")
+                run.mode = "timeout-fallback"
+                return None
+            if row is not None and row.stop_execution_date is not None:
+                # 结束时间与作业结果行（step_id=0）几乎同时写入；结果行稍晚时下一轮再读
+                if row.run_status is None and run.missing_outcome < 2:
+                    run.missing_outcome += 1
+                    return None
+                duration = self._run_duration_seconds(row.run_duration)
+                if duration is None and row.start_execution_date is not None:
+                    duration = int((row.stop_execution_date - row.start_execution_date).total_seconds())
+                status = RUN_STATUS.get(row.run_status, "unknown")
+                return {
+                    "ok": status == "succeeded",
+                    "job": run.job,
+                    "mode": "job_status",
+                    "status": status,
+                    "duration_s": duration,
+                    "started": row.start_execution_date,
+                    "finished": row.stop_execution_date,
+                    "last_step_id": row.last_executed_step_id,
+                    "message": row.message,
+                }
+            if time.time() >= run.deadline:
+                raise TimeoutError(f"等待 Job 结束超时（{run.timeout}s） / Timeout waiting for job to finish ({run.timeout}s)")
+            return None
+
+        # timeout-fallback：无法判定结束，只能等到超时；结果未经确认，不算成功
+        if time.time() >= run.deadline:
+            return {"ok": False, "job": run.job, "mode": "timeout-fallback", "status": "unverified"}
+        return None
+
+    def _watch_runs(self, cursor: Callable[[], ContextManager[pyodbc.Cursor]],
+                    runs: List[_JobRun]) -> Iterator[Tuple[_JobRun, Union[Dict[str, Any], Exception]]]:
+        """
+        单一等待循环：每个 Job 按各自的计划（_next_interval）检查，结束的依次产出 (run, 结果 dict 或异常)
+        并移出 runs；调用方可在两次产出之间往 runs 追加新启动的 Job。
+        Linux 本地目录用 inotify，目录一有变化立即检查文件检测的 Job。
+        """
+        watched: set = set()
+        notifier: Optional[_Inotify] = None
+        try:
+            while runs:
+                snapshots: Dict[Tuple[str, str], Dict[str, Any]] = {}
+                for run in list(runs):
+                    now = time.time()
+                    if not run.next_check:
+                        run.next_check = run.started + self._next_interval(run)
+                    if now < run.next_check and now < run.deadline:
+                        continue
+                    try:
+                        with cursor() as cur:
+                            res = self._check_run(cur, run, snapshots)
+                    except Exception as e:
+                        res = e
+                    if res is None:
+                        run.next_check = time.time() + self._next_interval(run)
+                        continue
+                    if isinstance(res, dict) and run.expected:
+                        res["expected"] = run.expected
+                    runs.remove(run)
+                    yield run, res
+                if not runs:
+                    break
+
+                dirs = {r.archive_dir for r in runs if r.mode == "file_watch"}
+                if dirs != watched:
+                    if notifier is not None:
+                        notifier.close()
+                    notifier, watched = _Inotify.open(sorted(dirs)), dirs
 
-            # 文件检测模式（优先）
-            if use_file_watch and archive_dir:
-                print("⏳ 等待归档目录出现新文件（文件监控判定成功）... / Waiting for new files in archive folder...")
-                ok = self._poll_until_file_appears(
+                # 产出期间追加的 Job 尚未安排（next_check 为 0），立即进入下一轮安排
+                wake = min(min(r.next_check, r.deadline) for r in runs)
+                wait = max(0.0, wake - time.time())
+                if notifier is not None:
+                    if notifier.wait(wait):
+                        for r in runs:
+                            if r.mode == "file_watch":
+                                r.next_check = time.time()
+                else:
+                    time.sleep(wait)
+        finally:
+            if notifier is not None:
+                notifier.close()
+
+    def _report_run(self, run: _JobRun, result: Dict[str, Any], interactive: bool = True) -> None:
+        """打印结束信息；interactive 时按结果蜂鸣，文件检测成功后打开归档目录。"""
+        if run.mode == "job_status":
+            mark = "✅" if result["ok"] else "❌"
+            print(f"{mark} Job 结束：{result['status']}，耗时 {result['duration_s']}s / "
+                  f"Job finished: {result['status']} in {result['duration_s']}s")
+        elif run.mode == "timeout-fallback":
+            print(f"⚠️ 已等待 {run.timeout}s，无法读取 msdb 确认 Job 结果（status=unverified，ok=False） / "
+                  f"Waited {run.timeout}s; job outcome could not be verified in msdb (status=unverified, ok=False)")
+        if not interactive:
+            return
+        (self._beep_ok if result["ok"] else self._beep_fail)()
+        if run.mode == "file_watch" and os.path.isdir(run.archive_dir):
+            self._open_folder(run.archive_dir)
+
+    # ----------- Main Run Job API -----------
+    def run_job(
+        self,
+        job_name: str,
+        archive_dir: Optional[str] = None,
+        timeout: Optional[int] = None,
+        poll_interval: int = 5,
+        fuzzy: bool = False,
+        start_step: Optional[Union[int, str]] = None,
+        # ⬇️ 可选的文件检测参数（有默认）
+        use_file_watch: Optional[bool] = None,
+        archive_pattern: Optional[str] = None,
+        file_watch_requires_new_file: Optional[bool] = None,
+    ) -> Dict[str, Any]:
+        """
+        启动并等待 SQL Agent Job 完成。
+        - 若提供 archive_dir，将自动启用“文件检测模式”作为成功判定；
+        - 否则轮询 msdb（sysjobactivity / sysjobhistory），作业结束即返回：
+            ok 仅在 status == "succeeded" 时为 True，并带 duration_s / message；
+            无权限读取 msdb 时只能等待 timeout 秒（mode="timeout-fallback"），结果未经确认：
+            status="unverified"、ok=False，调用方应视为未成功；
+        - timeout 为 None 时按历史耗时推算（max(p95 × 2, p95 + 300)），无足够历史时为 1800 秒；
+          有历史时结果带 expected（p50_s / p95_s / runs），检查间隔也据此安排；
+        - start_step:
+            * int  -> 按 step_id 解析为 step_name 并从该步启动；解析失败则报错退出；
+            * str  -> 视为 step_name，先校验存在性；不存在则报错退出；
+        """
+        with self._cursors() as cursor:
+            with cursor() as cur:
+                run = self._begin_job(
+                    cur, job_name,
                     archive_dir=archive_dir,
-                    pattern=archive_pattern,
                     timeout=timeout,
                     poll_interval=poll_interval,
-                    requires_new_file=file_watch_requires_new_file,
-                    baseline_state=baseline_state,
+                    fuzzy=fuzzy,
+                    start_step=start_step,
+                    use_file_watch=use_file_watch,
+                    archive_pattern=archive_pattern,
+                    file_watch_requires_new_file=file_watch_requires_new_file,
                 )
-                if ok:
-                    self._beep_ok()
-                    if os.path.isdir(archive_dir):
-                        self._open_folder(archive_dir)
-                    return {"ok": True, "job": target_name, "mode": "file_watch", **ok}
-
-            # 兜底：未启用文件检测则简单等待 timeout 秒后返回
-            print("ℹ️ 未启用文件检测模式，将等待数据库任务状态返回（或超时）… / "
-                  "File watch disabled; waiting for job status (or timeout)...")
-            time.sleep(timeout)
-            self._beep_ok()
-            return {"ok": True, "job": target_name, "mode": "timeout-fallback"}
+            for _, result in self._watch_runs(cursor, [run]):
+                if isinstance(result, Exception):
+                    raise result
+                self._report_run(run, result)
+                return result
+
+    def start_job(
+        self,
+        job_name: str,
+        archive_dir: Optional[str] = None,
+        timeout: Optional[int] = None,
+        poll_interval: int = 5,
+        fuzzy: bool = False,
+        start_step: Optional[Union[int, str]] = None,
+        use_file_watch: Optional[bool] = None,
+        archive_pattern: Optional[str] = None,
+        file_watch_requires_new_file: Optional[bool] = None,
+    ) -> JobHandle:
+        """
+        启动 Job 后立即返回 JobHandle，不阻塞调用方（参数同 run_job）。
+        Job 名/step 解析失败、启动失败会在这里直接抛出；结束判定（文件检测 / msdb 状态）在后台线程中进行
+        （非会话模式用独立连接，会话模式与其他调用交替使用会话连接），
+        结束时同 run_job 蜂鸣/打开归档目录。调用方可在等待期间做其他准备工作，之后用 result() 取结果。
+        """
+        stack = ExitStack()
+        try:
+            cursor = stack.enter_context(self._cursors())
+            with cursor() as cur:
+                run = self._begin_job(
+                    cur, job_name,
+                    archive_dir=archive_dir,
+                    timeout=timeout,
+                    poll_interval=poll_interval,
+                    fuzzy=fuzzy,
+                    start_step=start_step,
+                    use_file_watch=use_file_watch,
+                    archive_pattern=archive_pattern,
+                    file_watch_requires_new_file=file_watch_requires_new_file,
+                )
+        except BaseException:
+            stack.close()
+            raise
+
+        future: Future = Future()
+
+        def watch() -> None:
+            try:
+                for _, result in self._watch_runs(cursor, [run]):
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        self._report_run(run, result)
+                        future.set_result(result)
+            except BaseException as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                stack.close()
+
+        threading.Thread(target=watch, name=f"sql-job-{run.key}", daemon=True).start()
+        return JobHandle(run, future)
+
+    def run_jobs(self, jobs: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+        """
+        并发运行多个 Job：没有依赖的立即启动，depends_on 的 Job 全部成功后再启动；
+        共用一个数据库连接与一个等待循环，总耗时约等于依赖链上的关键路径，而不是各 Job 耗时之和。
+
+        :param jobs: 每项为 run_job 的参数 dict（job_name 必填），另可带
+                     key（结果中的键，默认 job_name）与 depends_on（key 或 key 列表）。
+        :return:     {key: 结果 dict}，顺序同 jobs。结果同 run_job；启动失败或超时的为
+                     {"ok": False, "error": ...}，因依赖未成功而未启动的 mode 为 "skipped"。
+        """
+        specs: Dict[str, Dict[str, Any]] = {}
+        deps: Dict[str, List[str]] = {}
+        for spec in jobs:
+            spec = dict(spec)
+            key = spec.pop("key", None) or spec["job_name"]
+            if key in specs:
+                raise ValueError(f"Job key 重复 / Duplicate job key: {key}")
+            dep = spec.pop("depends_on", None) or []
+            deps[key] = [dep] if isinstance(dep, str) else list(dep)
+            specs[key] = spec
+        for key, ds in deps.items():
+            unknown = [d for d in ds if d not in specs]
+            if unknown:
+                raise ValueError(f"[{key}] depends_on 未知的 Job / unknown dependency: {', '.join(unknown)}")
+        # 拓扑检查：有环时任何顺序都无法启动
+        done: set = set()
+        while len(done) < len(specs):
+            ready = [k for k in specs if k not in done and all(d in done for d in deps[k])]
+            if not ready:
+                raise ValueError(f"depends_on 存在循环依赖 / Circular depends_on: "
+                                 f"{', '.join(k for k in specs if k not in done)}")
+            done.update(ready)
+
+        results: Dict[str, Dict[str, Any]] = {}
+        waiting = list(specs)
+        runs: List[_JobRun] = []
+        t0 = time.time()
+        with self._cursors() as cursor:
+
+            def launch() -> None:
+                """启动依赖已全部成功的 Job；依赖失败的标记为 skipped（可能连锁）。"""
+                progressed = True
+                while progressed:
+                    progressed = False
+                    for key in list(waiting):
+                        failed = [d for d in deps[key] if d in results and not results[d]["ok"]]
+                        if failed:
+                            waiting.remove(key)
+                            results[key] = {"ok": False, "job": specs[key]["job_name"], "mode": "skipped",
+                                            "error": f"依赖未成功 / dependency not successful: {', '.join(failed)}"}
+                            print(f"⏭️ [{key}] 跳过 / skipped: {results[key]['error']}")
+                            progressed = True
+                        elif all(d in results for d in deps[key]):
+                            waiting.remove(key)
+                            spec = dict(specs[key])
+                            try:
+                                with cursor() as cur:
+                                    runs.append(self._begin_job(cur, spec.pop("job_name"), key=key, **spec))
+                            except (ValueError, FileNotFoundError, pyodbc.Error) as e:
+                                results[key] = {"ok": False, "job": specs[key]["job_name"], "mode": "not_started",
+                                                "error": str(e)}
+                                print(f"❌ [{key}] 启动失败 / failed to start: {e}")
+                                progressed = True
+
+            launch()
+            for run, result in self._watch_runs(cursor, runs):
+                if isinstance(result, Exception):
+                    result = {"ok": False, "job": run.job, "mode": run.mode, "error": str(result)}
+                    print(f"❌ [{run.key}] {result['error']}")
+                else:
+                    self._report_run(run, result, interactive=False)
+                    result["elapsed_s"] = round(time.time() - run.started, 1)
+                    print(f"{'✅' if result['ok'] else '❌'} [{run.key}] 完成（{result['elapsed_s']}s） / "
+                          f"finished ({result['elapsed_s']}s)")
+                results[run.key] = result
+                launch()
+
+        ok = all(r["ok"] for r in results.values())
+        (self._beep_ok if ok else self._beep_fail)()
+        print(f"{'✅' if ok else '❌'} 全部 Job 结束，用时 {time.time() - t0:.0f}s / All jobs finished in {time.time() - t0:.0f}s")
+        return {key: results[key] for key in specs}
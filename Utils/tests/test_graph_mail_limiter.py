@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+_AdaptiveLimiter 回归测试：多次 429/503 把速率降到 1 rps 以下后，请求仍能拿到令牌（不会永久阻塞）。
+
+python -m pytest -q Utils/tests
+"""
+
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from graph_mail_attachment_tool import _AdaptiveLimiter  # noqa: E402
+
+
+def _acquire_within(limiter: _AdaptiveLimiter, timeout: float) -> bool:
+    done = threading.Event()
+
+    def run() -> None:
+        limiter.acquire()
+        limiter.release(200)
+        done.set()
+
+    threading.Thread(target=run, daemon=True).start()
+    return done.wait(timeout)
+
+
+def test_requests_pass_after_throttling_below_one_rps():
+    limiter = _AdaptiveLimiter(max_rps=4.0, max_concurrency=2, min_rps=0.5)
+    for _ in range(4):
+        limiter.note_throttle(retry_after=0)
+    assert limiter.rate < 1.0
+
+    # 0.5 rps 攒满一个令牌约需 2 秒；修复前桶容量被限制在 rate（< 1），这里会一直等下去
+    t0 = time.monotonic()
+    assert _acquire_within(limiter, timeout=5.0)
+    assert _acquire_within(limiter, timeout=5.0)
+    assert limiter.snapshot()["in_flight"] == 0
+    assert time.monotonic() - t0 < 10.0
+
+
+def test_bucket_never_exceeds_one_token_below_one_rps():
+    limiter = _AdaptiveLimiter(max_rps=1.0, min_rps=0.5)
+    limiter.note_throttle(retry_after=0)
+    time.sleep(0.1)
+    with limiter._cond:
+        limiter._last -= 60  # 模拟长时间空闲
+        limiter._refill()
+        assert limiter._tokens == 1.0
@@ -23,24 +23,28 @@ SUCCESS_BODY = "MRP Weekly Waterfall completed successfully."
 FAIL_SUBJECT = "MRP Weekly Waterfall - Failed"
 FAIL_BODY_PREFIX = "MRP Weekly Waterfall failed with error:\n"
 
-# 1) 先下载邮件附件到本地目录
-down = GraphMailAttachmentTool(
-    tenant_id="5c2be51b-4109-461d-a0e7-521be6237ce2",
-    client_id="09004044-1c60-48e5-b1eb-bb42b3892006"
-)
-downloaded_paths = down.download_latest_attachments(
-    contains="ZMRP_WATERFALL_Run",
-    ext=".xlsx",
-    need_count=2,
-    days_back=5,
-    save_dir=SRC_DIR,           # 直接用你后续脚本的源目录
-    mail_folder="inbox",        # 可不填；想限定收件箱就留着
-)
-
-print("[INFO] 下载到：", [p.name for p in downloaded_paths], "/ Downloaded:", [p.name for p in downloaded_paths])
+# ------------ 工具函数 ------------
 
+def fetch_waterfall_attachments():
+    """
+    在内存中拉取最新两份 ZMRP_WATERFALL_Run*.xlsx（直接交给 pandas 解析，不再回读共享盘）；
+    原始附件在后台另存到 SRC_DIR 归档。
+    """
+    down = GraphMailAttachmentTool(
+        tenant_id="5c2be51b-4109-461d-a0e7-521be6237ce2",
+        client_id="09004044-1c60-48e5-b1eb-bb42b3892006"
+    )
+    files = list(down.iter_attachments(
+        [{"contains": "ZMRP_WATERFALL_Run", "ext": ".xlsx", "need_count": 2}],
+        days_back=5,
+        mail_folder="inbox",        # 可不填；想限定收件箱就留着
+        archive_dir=SRC_DIR,        # 归档到原来的下载目录
+        wait_archive=False,         # 归档写盘与后续解析并行，main 结束前再确认
+    ))
+    names = [f.name for f in files]
+    print("[INFO] 已取到：", names, "/ Fetched:", names)
+    return files
 
-# ------------ 工具函数 ------------
 
 def most_recent_monday(today=None):
     """返回本周一（如果今天是周一就取今天）的日期对象"""
@@ -50,10 +54,9 @@ def most_recent_monday(today=None):
 
 
 def pick_big_small(files):
-    """按文件大小挑出(大, 小)两个文件"""
-    sizes = [(f, os.path.getsize(f)) for f in files]
-    sizes.sort(key=lambda x: x[1], reverse=True)
-    return sizes[0][0], sizes[1][0]
+    """按附件大小挑出(大, 小)两个附件"""
+    ordered = sorted(files, key=lambda f: f.size, reverse=True)
+    return ordered[0], ordered[1]
 
 
 def _notify(subject: str, body: str) -> None:
@@ -75,29 +78,27 @@ def main():
         print(f"[ERROR] 源目录不存在: {SRC_DIR} / Source directory not found: {SRC_DIR}")
         sys.exit(1)
 
-    # 1) 找到两份 ZMRP_WATERFALL_Run*.xlsx
-    candidates = list(src.glob("ZMRP_WATERFALL_Run*.xlsx"))
-    if len(candidates) < 2:
-        print(f"[ERROR] 没找到两份文件，当前匹配到 {len(candidates)}: {[f.name for f in candidates]} / "
-              f"Expected 2 files but found {len(candidates)}: {[f.name for f in candidates]}")
+    # 1) 取最新两份 ZMRP_WATERFALL_Run*.xlsx（内存中，最新在前）
+    files = fetch_waterfall_attachments()
+    if len(files) < 2:
+        print(f"[ERROR] 没找到两份文件，当前匹配到 {len(files)}: {[f.name for f in files]} / "
+              f"Expected 2 files but found {len(files)}: {[f.name for f in files]}")
         sys.exit(1)
 
-    # 只取最新的两份（按修改时间降序）
-    candidates.sort(key=lambda p: p.stat().st_mtime, reverse=True)
-    files_to_use = candidates[:2]
-
-    big_file, small_file = pick_big_small(files_to_use)
-    print(f"[INFO] 大文件: {Path(big_file).name}  ({os.path.getsize(big_file):,} bytes) / "
-          f"Big file: {Path(big_file).name} ({os.path.getsize(big_file):,} bytes)")
-    print(f"[INFO] 小文件: {Path(small_file).name}  ({os.path.getsize(small_file):,} bytes) / "
-          f"Small file: {Path(small_file).name} ({os.path.getsize(small_file):,} bytes)")
+    big_file, small_file = pick_big_small(files[:2])
+    print(f"[INFO] 大文件: {big_file.name}  ({big_file.size:,} bytes) / "
+          f"Big file: {big_file.name} ({big_file.size:,} bytes)")
+    print(f"[INFO] 小文件: {small_file.name}  ({small_file.size:,} bytes) / "
+          f"Small file: {small_file.name} ({small_file.size:,} bytes)")
 
     # 2) 读取并上下拼接：小文件去掉第一行
     #   - 默认取第一个工作表；保留大文件的列顺序
-    df_big = pd.read_excel(big_file, sheet_name=0, dtype=object, engine="openpyxl")
+    with big_file:
+        df_big = pd.read_excel(big_file.file, sheet_name=0, dtype=object, engine="openpyxl")
 
     # 小文件：把第一行当普通数据读进来，然后再去掉第一行
-    df_small_raw = pd.read_excel(small_file, sheet_name=0, dtype=object, header=None, engine="openpyxl")
+    with small_file:
+        df_small_raw = pd.read_excel(small_file.file, sheet_name=0, dtype=object, header=None, engine="openpyxl")
 
     # 去掉小文件首行（标题行），保留剩余数据
     df_small_no_header = df_small_raw.iloc[1:].copy()
@@ -127,15 +128,22 @@ def main():
     shutil.copy2(out_path, share_target)
     print(f"[OK] 已复制到共享盘: {share_target} / Copied to shared folder: {share_target}")
 
-    # 4) 触发 SQL Agent Job
+    # 4) 触发 SQL Agent Job（不阻塞：Job 运行期间继续做收尾检查）
     tool = SqlAgentTool(server="tcp:10.80.127.71,1433")
-    result = tool.run_job(
+    job = tool.start_job(
         job_name="Lumileds BI - SC MRP Waterfall",  # 用完整精确名最稳妥
         archive_dir=r"\\mygbynbyn1msis1\Supply-Chain-Analytics\Data Warehouse\Data Source\SAP\Transactional Data\MRP Waterfall\Archive",
         timeout=1800,
         poll_interval=3,
         fuzzy=False,  # 若你 later 拿到读 sysjobs 的权限，可改 True
     )
+
+    # 确认原始附件已归档到 SRC_DIR（后台写入失败会在这里抛出）
+    for f in files:
+        if f.archive is not None:
+            f.archive.result()
+
+    result = job.result()
     print(result)
 
     # 5) SQL 作业完成后，打开 Excel 宏文件
@@ -63,18 +63,20 @@ def main():
         token_cache=TOKEN_CACHE,  # 绝对路径，避免重复认证
     )
 
+    # 一次扫描邮箱同时拉取所有 KKAQ_*，避免每个关键字重复列举收件箱
+    print(f"\n=== 拉取 {', '.join(f'KKAQ_{k}_*' for k in JOBS)} 各最新一份 === / Fetch latest of each ===")
+    results = tool.download_many(
+        [{"contains": f"KKAQ_{keyword}_", "ext": ".xlsx", "need_count": 1, "key": keyword} for keyword in JOBS],
+        days_back=DAYS_BACK,
+        save_dir=TMP_DIR,
+        mail_folder=MAIL_FOLDER,
+    )
+
     for keyword, (target_name,) in JOBS.items():
         contains = f"KKAQ_{keyword}_"
-        print(f"\n=== 拉取 {contains}* 最新一份 === / Fetch latest {contains}* ===")
-
-        paths = tool.download_latest_attachments(
-            contains=contains,
-            ext=".xlsx",
-            need_count=1,
-            days_back=DAYS_BACK,
-            save_dir=TMP_DIR,
-            mail_folder=MAIL_FOLDER,
-        )
+        print(f"\n=== {contains}* ===")
+
+        paths = results.get(keyword, [])
         latest = newest([str(p) for p in paths])
         if not latest:
             print(f"⚠ 没找到附件：{contains}*.xlsx（请检查邮箱/关键字/时间窗口） / "
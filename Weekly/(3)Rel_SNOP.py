@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 import hashlib
 import tempfile
 import shutil
@@ -110,10 +111,25 @@ finally:
 
 tool = SqlAgentTool(server="tcp:10.80.127.71,1433")
 
-result = tool.run_job(
-    job_name="Lumileds BI - SC RelSNOP",  # 用完整精确名最稳妥
-    timeout=100,
-    poll_interval=3,
-    fuzzy=False,  # 若你 later 拿到读 sysjobs 的权限，可改 True
-)
+# 未传 archive_dir：轮询 msdb 作业状态直到 Job 结束（该 Job 通常约 100 秒）。
+# 显式给较短的 timeout：无权限读取 msdb 时只会等这么久并返回 status="unverified"（ok=False），
+# 不会按默认值空等 30 分钟
+try:
+    result = tool.run_job(
+        job_name="Lumileds BI - SC RelSNOP",  # 用完整精确名最稳妥
+        timeout=300,
+        poll_interval=3,
+        fuzzy=False,  # 若你 later 拿到读 sysjobs 的权限，可改 True
+    )
+except TimeoutError as e:
+    print(f"❌ SQL Job 未在超时内结束：{e} / SQL Job did not finish in time: {e}")
+    sys.exit(1)
 print(result)
+if result.get("status") == "unverified":
+    print("⚠️ 无法读取 msdb，Job 已启动但结果未确认，请在 SSMS 中检查 / "
+          "Cannot read msdb; the job was started but its outcome is unverified, check it in SSMS")
+    sys.exit(1)
+if not result["ok"]:
+    print(f"❌ SQL Job 未成功：{result.get('status')} {result.get('message') or ''} / "
+          f"SQL Job did not succeed: {result.get('status')} {result.get('message') or ''}")
+    sys.exit(1)